@@ -8,34 +8,196 @@ This module provides utility functions for interacting with XML files, logging m
 and writing/appending text to files. It includes functions to retrieve values from XML tags, update XML
 tag values, log messages to a specified file, and write or append text to files.
 
+The XML configuration is served by ParkitConfig: the file is parsed once per process, values are read
+from memory, and changes are marked dirty and written back atomically (temp file + rename) only when
+something changed. The original functions are kept as thin wrappers around it.
+
 
 '''
 
+import atexit
+import fcntl
 import os
+import tempfile
+import threading
+import time
 import xml.etree.ElementTree as ET
+from collections import deque
 from datetime import datetime
 
+DEFAULT_LOG_FILE = "src/data/parkit.log"
+
+class ParkitConfig:
+    """
+    In-memory view of an XML configuration file.
+
+    :param file_path: The path to the XML file.
+    :param flush_interval: Minimum seconds between two debounced writes, see maybe_flush().
+    :param check_interval: Seconds between checks for changes made to the file by another process.
+    """
+
+    def __init__(self, file_path, flush_interval=1.0, check_interval=1.0):
+        self.file_path = file_path
+        self.flush_interval = flush_interval
+        self.check_interval = check_interval
+        self.lock = threading.RLock()
+        self.tree = None
+        self.signature = None
+        self.last_check = 0
+        self.last_flush = 0
+        # (space index or None, tag) -> value that still has to be written
+        self.dirty = {}
+        self._load()
+
+    def _load(self):
+        stat = os.stat(self.file_path)
+        self.tree = ET.parse(self.file_path)
+        self.signature = (stat.st_mtime_ns, stat.st_size)
+        self.last_check = time.monotonic()
+
+        # Keep local changes that were not written yet
+        for (index, tag), value in self.dirty.items():
+            element = self._find(index, tag)
+            if element is not None:
+                element.text = value
+
+    def _refresh(self):
+        # Reload if another process (e.g. the watch dog) wrote the file since we read it
+        now = time.monotonic()
+        if now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return
+        if (stat.st_mtime_ns, stat.st_size) != self.signature:
+            self._load()
+
+    def _find(self, index, tag):
+        root = self.tree.getroot()
+        if index is None:
+            return root.find(f'.//{tag}')
+        spaces = root.findall('.//space-definition')
+        if index >= len(spaces):
+            return None
+        return spaces[index].find(tag)
+
+    def get(self, tag, type=str, default=None):
+        """
+        Returns the value of the first occurrence of a tag.
+
+        :param tag: The tag name to search for.
+        :param type: Conversion applied to the text, e.g. int.
+        :param default: Returned if the tag is missing or empty.
+        """
+        with self.lock:
+            self._refresh()
+            element = self._find(None, tag)
+            if element is None or element.text is None:
+                return default
+            return type(element.text)
+
+    def get_spaces(self):
+        """
+        :return: The <space-definition> elements, see get_space_definitions().
+        """
+        return self.get_elements('space-definition')
+
+    def get_elements(self, tag):
+        """
+        :return: Every element with the tag, in document order.
+        """
+        with self.lock:
+            self._refresh()
+            return self.tree.getroot().findall(f'.//{tag}')
+
+    def set(self, tag, value, index=None):
+        """
+        Changes a value in memory. Nothing is written until flush() or maybe_flush().
+
+        :param tag: The tag whose value is to be updated.
+        :param value: The new value as a string.
+        :param index: Position of the <space-definition> for space tags, None for the first occurrence.
+        :return: True if the tag was found, False otherwise.
+        """
+        with self.lock:
+            self._refresh()
+            element = self._find(index, tag)
+            if element is None:
+                return False
+            if element.text != value:
+                element.text = value
+                self.dirty[(index, tag)] = value
+            return True
+
+    def flush(self):
+        """
+        Writes the file if there are pending changes. The file is replaced atomically so readers
+        never see a partially written configuration.
+        """
+        with self.lock:
+            if not self.dirty:
+                return False
+            # Pick up changes from other processes before overwriting the file
+            self.last_check = 0
+            self._refresh()
+
+            directory = os.path.dirname(os.path.abspath(self.file_path))
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".parkit-config-")
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    self.tree.write(file)
+                # mkstemp creates the file private to the user, keep the original permissions
+                if os.path.exists(self.file_path):
+                    os.chmod(temp_path, os.stat(self.file_path).st_mode & 0o777)
+                os.replace(temp_path, self.file_path)
+            except Exception:
+                os.remove(temp_path)
+                raise
+
+            stat = os.stat(self.file_path)
+            self.signature = (stat.st_mtime_ns, stat.st_size)
+            self.dirty.clear()
+            self.last_flush = time.monotonic()
+            return True
+
+    def maybe_flush(self):
+        """
+        Debounced flush for hot loops: writes at most once per flush_interval.
+        """
+        if self.dirty and time.monotonic() - self.last_flush >= self.flush_interval:
+            return self.flush()
+        return False
+
+_configs = {}
+
+def get_config(file_path):
+    """
+    Returns the shared ParkitConfig of a file, loading it on first use.
+    """
+    config = _configs.get(file_path)
+    if config is None:
+        config = ParkitConfig(file_path)
+        _configs[file_path] = config
+    return config
+
 def get_value_from_tag(file_path, tag):
     """
-    Parses an XML file and returns the text content of the first occurrence of a specified tag.
+    Returns the text content of the first occurrence of a specified tag.
+    The file is only parsed on first use, see ParkitConfig.
     
     :param file_path: The path to the XML file.
     :param tag: The tag name to search for.
     :return: The text content of the first occurrence of the specified tag, or None if the tag is not found.
     """
     try:
-        # Parse the XML file
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-        
-        # Find the first occurrence of the tag
-        element = root.find(f'.//{tag}')
-        if element is not None:
-            log(f"get_value_from_tag: found {tag}={element.text}")
-            return element.text
+        value = get_config(file_path).get(tag)
+        if value is not None:
+            log(f"get_value_from_tag: found {tag}={value}", "DEBUG")
         else:
-            log(f"get_value_from_tag: Could not find {tag}")
-            return None
+            log(f"get_value_from_tag: Could not find {tag}", "WARNING")
+        return value
     except ET.ParseError:
         print("Error parsing XML file.")
         return None
@@ -43,24 +205,195 @@ def get_value_from_tag(file_path, tag):
         print(f"An error occurred: {e}")
         return None
 
-def log(message):
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+class ParkitLogger:
+    """
+    Non-blocking logger. Callers only add the record to an in-memory ring buffer; a background
+    thread writes the records in batches and rotates the file by size.
+
+    The watch dog and the detector can share one file: every batch is written with a single
+    O_APPEND write, and rotation is done under an exclusive lock file. A process that finds its
+    file rotated by the other one reopens it.
+
+    :param filename: The log file.
+    :param level: Records below this level (DEBUG, INFO, WARNING, ERROR) are ignored.
+    :param capacity: Size of the ring buffer. When it is full the oldest record is dropped.
+    :param flush_interval: Maximum seconds a record waits in the buffer.
+    :param max_bytes: Rotate the file once it grows past this size. 0 disables rotation.
+    :param backup_count: Number of rotated files kept (parkit.log.1 ... parkit.log.N).
     """
-    Logs a message to a specified file with a timestamp.
+
+    def __init__(self, filename, level="INFO", capacity=10000, flush_interval=0.5,
+                 max_bytes=5 * 1024 * 1024, backup_count=5):
+        self.filename = filename
+        self.level = LOG_LEVELS.get(level, 20)
+        self.buffer = deque(maxlen=capacity)
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.flushed = threading.Condition(self.lock)
+        self.fd = None
+        self.running = True
+
+        # Counters
+        self.records = 0
+        self.written = 0
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.batches = 0
+        self.write_errors = 0
+
+        self.thread = threading.Thread(target=self._run, name="ParkitLogger", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def log(self, message, level="INFO"):
+        if LOG_LEVELS.get(level, 20) < self.level:
+            return
+        record = (time.time(), level, message)
+        with self.lock:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(record)
+            self.records += 1
+
+    def _open(self):
+        if self.fd is None:
+            self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        else:
+            # Reopen if the other process rotated the file away from us
+            try:
+                if os.stat(self.filename).st_ino != os.fstat(self.fd).st_ino:
+                    os.close(self.fd)
+                    self.fd = None
+                    self._open()
+            except FileNotFoundError:
+                os.close(self.fd)
+                self.fd = None
+                self._open()
+
+    def _rotate(self):
+        with open(self.filename + ".lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Check again, the other process may have rotated while we waited for the lock
+                if os.path.getsize(self.filename) < self.max_bytes:
+                    return
+                for i in range(self.backup_count - 1, 0, -1):
+                    source = f"{self.filename}.{i}"
+                    if os.path.exists(source):
+                        os.replace(source, f"{self.filename}.{i + 1}")
+                if self.backup_count > 0:
+                    os.replace(self.filename, f"{self.filename}.1")
+                else:
+                    os.truncate(self.filename, 0)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, records, dropped):
+        lines = []
+        if dropped:
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            lines.append(f"[{timestamp}] [WARNING] Logger buffer overflow: {dropped} record(s) dropped\n")
+        for created, level, message in records:
+            timestamp = datetime.fromtimestamp(created).strftime("%Y-%m-%d %H:%M:%S")
+            lines.append(f"[{timestamp}] [{level}] {message}\n")
+
+        try:
+            self._open()
+            os.write(self.fd, "".join(lines).encode())
+            if self.max_bytes and os.fstat(self.fd).st_size >= self.max_bytes:
+                self._rotate()
+                self._open()
+            self.written += len(records)
+            self.batches += 1
+        except OSError as e:
+            self.write_errors += 1
+            print(f"Logger could not write to {self.filename}: {e}")
+
+    def _drain(self):
+        with self.lock:
+            records = list(self.buffer)
+            self.buffer.clear()
+            dropped = self.dropped - self.reported_dropped
+            self.reported_dropped = self.dropped
+        if records or dropped:
+            self._write(records, dropped)
+        with self.lock:
+            self.flushed.notify_all()
+
+    def _run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self._drain()
+        self._drain()
+
+    def flush(self, timeout=2.0):
+        """
+        Asks the writer for an immediate batch and waits until it is written.
+        """
+        with self.lock:
+            if not self.buffer or not self.thread.is_alive():
+                return
+            self.wakeup.set()
+            self.flushed.wait(timeout)
+
+    def stats(self):
+        """
+        :return: The logger counters, including the records dropped on overflow.
+        """
+        with self.lock:
+            return {"records": self.records, "written": self.written, "dropped": self.dropped,
+                    "queued": len(self.buffer), "batches": self.batches, "write_errors": self.write_errors}
+
+    def close(self):
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.thread.join(5)
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+_logger = None
+
+def configure_logger(filename=DEFAULT_LOG_FILE, level="INFO", **options):
+    """
+    Replaces the logger used by log(), e.g. with the <log-file-location> and <log-level> settings.
+    """
+    global _logger
+    previous = _logger
+    _logger = ParkitLogger(filename, level=level, **options)
+    if previous is not None:
+        previous.close()
+    return _logger
+
+def get_logger():
+    global _logger
+    if _logger is None:
+        _logger = ParkitLogger(DEFAULT_LOG_FILE)
+    return _logger
+
+def log(message, level="INFO"):
+    """
+    Logs a message to the Parkit log file with a timestamp. The call only queues the message;
+    it is written by the logger's background thread.
 
     :param message: The text message to log.
-    :param filename: The name of the file where the log should be written.
+    :param level: DEBUG, INFO, WARNING or ERROR.
     """
-    # Get the current timestamp
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    filename = "src/data/parkit.log"
-        
-    # Open the file in append mode and write the message
-    with open(filename, 'a') as log_file:
-        log_file.write(f"[{timestamp}] {message}\n")
+    get_logger().log(message, level)
 
 def update_xml_tag_value(file_path, tag, new_value):
     """
     Updates the value of a specified tag in an XML file.
+    The file is only written if the value changed.
 
     Parameters:
     - file_path: Path to the XML file.
@@ -71,17 +404,9 @@ def update_xml_tag_value(file_path, tag, new_value):
     - True if the tag was found and updated, False otherwise.
     """
     try:
-        # Parse the XML file
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-
-        # Find the first occurrence of the tag
-        element = root.find(f'.//{tag}')
-        if element is not None:
-            # Update the tag's value
-            element.text = new_value
-            # Write the changes back to the file
-            tree.write(file_path)
+        config = get_config(file_path)
+        if config.set(tag, new_value):
+            config.flush()
             return True
         else:
             return False
@@ -96,7 +421,7 @@ def write_text_to_file(file_path, text):
     # Check if the provided file path is valid
     if os.path.isdir(file_path):
         print(f"Error: The path '{file_path}' is a directory, not a file.")
-        log(f"Write error: {file_path} does not exist.")
+        log(f"Write error: {file_path} does not exist.", "ERROR")
         return
     if os.path.isfile(file_path):
         # Open the file in append mode and write the text to a new line
@@ -123,4 +448,115 @@ def append_text_to_file(file_path, text):
         # Open the file in write mode, which will create the file if it doesn't exist
         with open(file_path, 'w') as file:
             file.write(text)
-        log(f"File: {file_path} text written.")
\ No newline at end of file
+        log(f"File: {file_path} text written.")
+
+def get_space_definitions(file_path):
+    """
+    Returns every <space-definition> element of the configuration file.
+
+    A space may be named with a name attribute, e.g. <space-definition name="A1">, and watched by
+    another camera than the first one with a camera attribute holding the camera position, e.g.
+    camera="1". The move-dist and occupied-timer tags are optional after the first space and default
+    to the values of the first one.
+
+    :param file_path: The path to the XML file.
+    :return: A list of dictionaries with the keys name, camera, x, y, width, height, move-dist and
+             occupied-timer.
+    """
+    try:
+        elements = get_config(file_path).get_spaces()
+    except ET.ParseError:
+        print("Error parsing XML file.")
+        return []
+
+    spaces = []
+    defaults = {}
+    tags = {"x": "space-x", "y": "space-y", "width": "space-width", "height": "space-height",
+            "move-dist": "move-dist", "occupied-timer": "occupied-timer"}
+    for element in elements:
+        space = {"name": element.get("name"), "camera": int(element.get("camera", 0))}
+        for key, tag in tags.items():
+            child = element.find(tag)
+            if child is not None and child.text is not None:
+                space[key] = int(child.text)
+            else:
+                space[key] = defaults.get(key)
+        if not defaults:
+            defaults = space
+        spaces.append(space)
+    log(f"get_space_definitions: found {len(spaces)} space(s)")
+    return spaces
+
+def get_inference_model(file_path):
+    """
+    Returns the model of the <yolov5-settings>. The torch backend loads the <weights>, the onnx and
+    opencv backends the <exported-model> written by ModelExport.py.
+
+    :param file_path: The path to the XML file.
+    :return: A dictionary with the keys backend, model, device and input_size.
+    """
+    config = get_config(file_path)
+    backend = config.get("inference-backend", default="torch")
+    model = config.get("weights") if backend == "torch" else config.get("exported-model", default="yolov5/yolov5s.onnx")
+    return {"backend": backend, "model": model, "device": config.get("resource", default="cpu"),
+            "input_size": config.get("input-size", int, 0)}
+
+def get_camera_definitions(file_path):
+    """
+    Returns every <camera> of the configuration file. A camera is a device index or a video source
+    understood by cv2.VideoCapture, and may be named with a name attribute. Recordings may set
+    playback="native|fast" and an fps attribute.
+
+    :param file_path: The path to the XML file.
+    :return: A list of dictionaries with the keys index, name, source, playback and fps.
+    """
+    try:
+        elements = get_config(file_path).get_elements('camera')
+    except ET.ParseError:
+        print("Error parsing XML file.")
+        return []
+
+    cameras = []
+    for index, element in enumerate(elements):
+        name = element.get("name") or str(index)
+        fps = float(element.get("fps")) if element.get("fps") else None
+        cameras.append({"index": index, "name": name, "source": (element.text or "").strip(),
+                        "playback": element.get("playback", "native"), "fps": fps})
+    log(f"get_camera_definitions: found {len(cameras)} camera(s)", "DEBUG")
+    return cameras
+
+def update_space_value(file_path, index, tag, new_value, flush=True):
+    """
+    Updates the value of a tag inside the n-th <space-definition> element.
+
+    :param file_path: Path to the XML file.
+    :param index: The position of the space definition in the file.
+    :param tag: The tag whose value is to be updated.
+    :param new_value: The new value to assign to the tag.
+    :param flush: Write the file now. Otherwise the change is written by the next ParkitConfig flush.
+    :return: True if the tag was found and updated, False otherwise.
+    """
+    try:
+        config = get_config(file_path)
+        if not config.set(tag, new_value, index=index):
+            return False
+        if flush:
+            config.flush()
+        return True
+    except ET.ParseError:
+        print("Error parsing the XML file.")
+        return False
+
+def space_file_path(file_path, name):
+    """
+    Returns the output file of a named space. Unnamed spaces keep the configured path so the
+    web pages keep working with a single space.
+
+    :param file_path: The configured file path, e.g. src/appsrc/data.txt.
+    :param name: The space name or None.
+    :return: The path with the space name added before the extension, e.g. src/appsrc/data-A1.txt.
+    """
+    if not name:
+        return file_path
+    root, ext = os.path.splitext(file_path)
+    return f"{root}-{name}{ext}"
@@ -13,10 +13,13 @@ in time.
 
 from collections import defaultdict, deque
 import csv
-import matplotlib.pyplot as plt
+import threading
 from datetime import datetime, timedelta
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.dates import date2num
+from matplotlib.figure import Figure
 from matplotlib.lines import Line2D
-import pandas as pd  # Import this for custom legend handles
 from Adaptation import get_value_from_tag, log  # Assuming you have a function to get values from XML
 
 # Path to system configuration file
@@ -66,37 +69,157 @@ def read_csv(filename):
 
     return data
 
+# Persistent renderer for the occupancy graph.
+#
+# One figure is created once and reused for every render. Consecutive samples with the same
+# status are drawn as one run, so the graph is a single LineCollection with three vertices per
+# run instead of one plt.plot call per pair of samples. Renders happen on a background thread
+# and only when new samples arrived, so a slow savefig never delays the capture loop.
+class GraphRenderer:
+    """
+    :param max_runs: Maximum number of status runs kept per graph. Older runs are dropped.
+    """
+
+    def __init__(self, max_runs=2000):
+        self.max_runs = max_runs
+        self.series = {}
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.render_lock = threading.Lock()
+        self.thread = None
+        self.running = False
+
+        self.figure = Figure(figsize=(13, 6))  # Increased resolution for clearer output
+        FigureCanvasAgg(self.figure)
+        ax = self.figure.add_subplot()
+        self.ax = ax
+        self.collection = LineCollection([], linewidths=4)
+        ax.add_collection(self.collection)
+        ax.xaxis_date()
+
+        ax.set_xlabel('Time', fontsize=24)  # x-axis
+        ax.set_ylabel('Space Occupancy', fontsize=24)  # y-axis
+        ax.set_title('Parking Space Status', fontsize=36)  # title label
+        ax.set_yticks([0, 1])
+        ax.set_yticklabels(['Space Vacant', 'Space Occupied'], fontsize=18)  # Adjusted font size for better fit
+        ax.set_ylim(-0.1, 1.1)  # Adjust y-axis limits to close gap
+        ax.grid(True)
+
+        # Create custom legend with thicker lines
+        legend_elements = [Line2D([0], [0], color='green', lw=4, label='Space Vacant'),
+                           Line2D([0], [0], color='red', lw=4, label='Space Occupied')]
+
+        ax.legend(handles=legend_elements, fontsize=18, loc='lower left', bbox_to_anchor=(1, 1))  # legend
+
+        # Adjust layout to not cut off legend since it needs to be outside of the graph.
+        self.figure.tight_layout()
+
+    def _update_series(self, filename, data, count):
+        """
+        Folds the samples that arrived since the last render into the runs of the graph.
+        :return: True if there is something new to draw.
+        """
+        series = self.series.get(filename)
+        if series is None or count < series["count"] or (count and data[0] is not series["first"]):
+            series = {"count": 0, "first": data[0] if count else None, "runs": deque(maxlen=self.max_runs)}
+            self.series[filename] = series
+        if count == series["count"]:
+            return False
+
+        runs = series["runs"]
+        for entry in data[series["count"]:count]:
+            status = 1 if entry[0] else 0
+            time = date2num(entry[1])
+            if runs and runs[-1][0] == status:
+                runs[-1][2] = time
+            else:
+                if runs:
+                    # The last segment of a run connects to the first sample of the next one
+                    runs[-1][3] = (time, status)
+                runs.append([status, time, time, None])
+        series["count"] = count
+        return True
+
+    def _draw(self, filename):
+        runs = self.series[filename]["runs"]
+        segments = []
+        colors = []
+        for status, start, end, next_point in runs:
+            points = [(start, status), (end, status)]
+            if next_point is not None:
+                points.append(next_point)
+            segments.append(points)
+            colors.append('red' if status == 1 else 'green')
+        self.collection.set_segments(segments)
+        self.collection.set_color(colors)
+
+        if runs:
+            first = runs[0][1]
+            last = runs[-1][2]
+            if last <= first:
+                last = first + 1 / 86400
+            self.ax.set_xlim(first, last)
+
+        # Save the plot as a PNG file
+        self.figure.savefig(filename)
+
+    def render(self, data, filename):
+        """
+        Renders the graph on the calling thread if new samples arrived.
+        """
+        with self.render_lock:
+            if self._update_series(filename, data, len(data)):
+                self._draw(filename)
+
+    def submit(self, data, filename):
+        """
+        Queues a render on the background thread. Only the latest request per file is kept.
+        The data list may keep growing; only the samples present now are drawn.
+        """
+        with self.condition:
+            self.pending[filename] = (data, len(data))
+            if self.thread is None:
+                self.running = True
+                self.thread = threading.Thread(target=self._run, name="GraphRenderer", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                filename, (data, count) = self.pending.popitem()
+
+            # Render outside of the condition so submit() never waits for savefig
+            with self.render_lock:
+                try:
+                    if self._update_series(filename, data, count):
+                        self._draw(filename)
+                except Exception as e:
+                    log(f"GraphRenderer: could not render {filename}: {e}")
+
+    def close(self):
+        """
+        Renders the queued graphs and stops the background thread.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+_renderer = None
+
 # Function to plot graph and save it to a PNG file
 def plot_and_save_graph(data, filename):
-    # Extract data for plotting
-    times = [entry[1] for entry in data]
-    car_presence = [1 if entry[0] else 0 for entry in data]  # 1 if car is in space, 0 if not
-
-    # Create the plot
-    plt.figure(figsize=(13, 6))  # Increased resolution for clearer output
-
-    # Plot each point, color it based on car presence, with thicker lines
-    for i in range(len(times)-1):
-        plt.plot(times[i:i+2], car_presence[i:i+2], color='red' if car_presence[i] == 1 else 'green', lw=4)
-
-    plt.xlabel('Time', fontsize=24)  # x-axis
-    plt.ylabel('Space Occupancy', fontsize=24)  # y-axis
-    plt.title('Parking Space Status', fontsize=36)  # title label
-    plt.yticks([0, 1], ['Space Vacant', 'Space Occupied'], fontsize=18)  # Adjusted font size for better fit
-    plt.ylim(-0.1, 1.1)  # Adjust y-axis limits to close gap
-    plt.grid(True)
-
-    # Create custom legend with thicker lines
-    legend_elements = [Line2D([0], [0], color='green', lw=4, label='Space Vacant'),
-                       Line2D([0], [0], color='red', lw=4, label='Space Occupied')]
-
-    plt.legend(handles=legend_elements, fontsize=18, loc='lower left', bbox_to_anchor=(1, 1))  # legend
-
-    # Adjust layout to not cut off legend since it needs to be outside of the graph.
-    plt.tight_layout()
-
-    # Save the plot as a PNG file
-    plt.savefig(filename)
+    global _renderer
+    if _renderer is None:
+        _renderer = GraphRenderer()
+    _renderer.render(data, filename)
 
 # This function will parse the CSV file and determine the longest streak of
 # the parking space being occupied
@@ -197,12 +320,11 @@ def find_best_time_to_park_and_analytics(csv_file):
 
 
 def append_file_to_file(source_path, dest_path):
-    # Initialize a list to hold the rows of data to be appended
-    data_to_append = []
-
-    # Open the source file and read data, skipping comments and the header
-    with open(source_path, mode='r', newline='', encoding='utf-8') as source_file:
+    # Copy the rows one at a time instead of reading the whole file first
+    with open(source_path, mode='r', newline='', encoding='utf-8') as source_file, \
+         open(dest_path, mode='a', newline='', encoding='utf-8') as dest_file:
         reader = csv.reader(source_file)
+        writer = csv.writer(dest_file)
         header_skipped = False
 
         for row in reader:
@@ -215,10 +337,5 @@ def append_file_to_file(source_path, dest_path):
                 header_skipped = True
                 continue
 
-            # Append non-header, non-comment rows to the list
-            data_to_append.append(row)
-
-    # Open the destination file in append mode and write the data
-    with open(dest_path, mode='a', newline='', encoding='utf-8') as dest_file:
-        writer = csv.writer(dest_file)
-        writer.writerows(data_to_append)
\ No newline at end of file
+            # Append non-header, non-comment rows
+            writer.writerow(row)
\ No newline at end of file
@@ -0,0 +1,130 @@
+'''
+
+        +----------------------------+
+        |   DetectorCheckpoint.py    |
+        +----------------------------+
+
+This module saves the runtime state of a detector, so a detector that the watch dog restarts
+after a crash continues where the crashed one stopped instead of starting over:
+
+    - the reference frame or background model of the camera
+    - the occupied timers and confirmed states of its spaces, so a crash does not reset the
+      occupancy clock of a parked car
+    - the last status and detected cars of every space
+    - the session analytics of every space (streaks, 15-minute buckets, the number of smoothed
+      samples) and the position in the session CSV file they have read up to
+
+Every analysed camera has its own checkpoint file (an uncompressed .npz archive of NumPy arrays and
+a JSON header), written to a temporary file and renamed, so a crash during a write leaves the last
+complete checkpoint. A checkpoint of another version is ignored. Restoring it takes milliseconds;
+only the CSV rows written after it are read again.
+
+The smoothed samples grow with the session, so they are not rewritten by every checkpoint. They
+are appended to a records file next to it, only the samples added since the last checkpoint,
+before the checkpoint that counts them is renamed into place. Records after that count are left
+over from a crash and are cut off by the next save.
+
+'''
+
+import json
+import os
+import time
+
+import numpy as np
+
+from Adaptation import log
+
+CHECKPOINT_VERSION = 2
+META_KEY = "meta"
+# Bytes before the saved position that must still be there, to recognize the same CSV file
+TAIL_BYTES = 64
+
+def write_checkpoint(path, meta, arrays):
+    """
+    Atomically replaces the checkpoint.
+
+    :param path: The checkpoint file.
+    :param meta: JSON values. The version and the time are added.
+    :param arrays: NumPy arrays by name.
+    """
+    meta = dict(meta, version=CHECKPOINT_VERSION, time=time.time())
+    arrays = dict(arrays)
+    arrays[META_KEY] = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        np.savez(file, **arrays)
+    os.replace(temp_path, path)
+
+def read_checkpoint(path):
+    """
+    :param path: The checkpoint file.
+    :return: (meta, arrays), or None if there is no usable checkpoint.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as archive:
+            arrays = {name: archive[name] for name in archive.files}
+        meta = json.loads(arrays.pop(META_KEY).tobytes().decode())
+    except (OSError, ValueError, KeyError) as e:
+        log(f"Checkpoint {path} could not be read: {e}", "WARNING")
+        return None
+    if meta.get("version") != CHECKPOINT_VERSION:
+        log(f"Checkpoint {path} has version {meta.get('version')}, expected {CHECKPOINT_VERSION}. Ignored.", "WARNING")
+        return None
+    return meta, arrays
+
+def file_position(path):
+    """
+    :return: The end of a file that is appended to, for read_after(). None if it does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as file:
+        offset = file.seek(0, os.SEEK_END)
+        file.seek(max(0, offset - TAIL_BYTES))
+        tail = file.read(TAIL_BYTES)
+    return {"inode": os.stat(path).st_ino, "offset": offset, "tail": tail.hex()}
+
+def read_after(path, position):
+    """
+    :param position: A position from file_position().
+    :return: The lines appended to the file since, or None if the file was replaced or shortened.
+    """
+    if position is None or not os.path.exists(path) or os.stat(path).st_ino != position["inode"]:
+        return None
+    offset = position["offset"]
+    tail = bytes.fromhex(position["tail"])
+    with open(path, "rb") as file:
+        file.seek(max(0, offset - len(tail)))
+        if file.read(len(tail)) != tail:
+            return None
+        appended = file.read()
+    return [line for line in appended.decode().split("\n") if line]
+
+def save_records(path, records, saved, dtype):
+    """
+    Brings a file of fixed-size records up to date by appending the records it is missing.
+
+    :param path: The records file.
+    :param records: Function that returns the records from an index on, as an array of dtype.
+    :param saved: The number of records the file holds, or None to write all of them.
+    :return: The number of records in the file, to pass as saved next time.
+    """
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if saved is None or size < saved * dtype.itemsize:
+        saved = 0
+    appended = records(saved)
+    with open(path, "r+b" if os.path.exists(path) else "wb") as file:
+        file.truncate(saved * dtype.itemsize)
+        file.seek(saved * dtype.itemsize)
+        appended.tofile(file)
+    return saved + len(appended)
+
+def read_records(path, dtype, count):
+    """
+    :return: The first count records of a file of save_records(), or None if it has less.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) < count * dtype.itemsize:
+        return None
+    return np.fromfile(path, dtype=dtype, count=count)
@@ -0,0 +1,98 @@
+'''
+
+        +----------------------------+
+        |        EventLog.py         |
+        +----------------------------+
+
+This module contains the change-only recording mode of the Parkit system. Instead of one CSV row
+every 2 seconds, the data file holds one row per run of identical samples:
+
+    occupancyStatus,vehicleStatus,dateTime,spaceX,spaceY,spaceWidth,spaceHeight,endDateTime,samples
+
+The first seven columns are the first sample of the run, so the file can still be read like a
+sample CSV. endDateTime is the time of the last sample and samples the number of samples.
+
+A run is closed when the status or the space changes, when a new 15-minute slot starts, when
+more than 5 minutes pass between two samples (a gap), and at least every heartbeat interval. A
+crash therefore loses at most one heartbeat of data, and the restart marker is written as usual.
+
+Because a run never spans a gap or a slot boundary, the longest streak and the 15-minute buckets
+computed from the runs are identical to the ones computed from every sample. expand_event()
+turns a run back into its samples, with the sample times spread evenly between the first and
+the last one.
+
+'''
+
+from datetime import datetime, timedelta
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def is_event(row):
+    return len(row) >= 9 and not row[0].startswith('#')
+
+def expand_event(row):
+    """
+    :param row: A run as a list of strings.
+    :return: The samples of the run as lists of strings, like the rows of a sample CSV.
+    """
+    start = datetime.strptime(row[2].strip(), TIME_FORMAT)
+    end = datetime.strptime(row[7].strip(), TIME_FORMAT)
+    count = int(row[8])
+    duration = (end - start).total_seconds()
+    samples = []
+    for i in range(count):
+        offset = round(i * duration / (count - 1)) if count > 1 else 0
+        time = start + timedelta(seconds=offset)
+        samples.append([row[0], row[1], time.strftime(TIME_FORMAT)] + row[3:7])
+    return samples
+
+class EventRecorder:
+    """
+    Turns the 2-second samples of one space into runs.
+
+    :param heartbeat: Maximum seconds covered by one run.
+    """
+
+    def __init__(self, heartbeat=300):
+        self.heartbeat = heartbeat
+        self.run = None
+        self.runs = 0
+        self.samples = 0
+
+    def add(self, row):
+        """
+        :param row: A sample as a comma separated string.
+        :return: The runs that were closed by this sample, as CSV lines.
+        """
+        fields = row.split(',')
+        key = (fields[0], fields[1], tuple(fields[3:7]))
+        time = datetime.strptime(fields[2].strip(), TIME_FORMAT)
+        slot = time.hour * 4 + time.minute // 15
+        self.samples += 1
+
+        closed = []
+        if self.run is not None:
+            gap = time - self.run["end"]
+            if (key != self.run["key"] or slot != self.run["slot"] or gap < timedelta(0)
+                    or gap.seconds > 300 or (time - self.run["start"]).total_seconds() >= self.heartbeat):
+                closed = self.flush()
+
+        if self.run is None:
+            self.run = {"key": key, "slot": slot, "start": time, "end": time, "count": 1, "fields": fields}
+        else:
+            self.run["end"] = time
+            self.run["count"] += 1
+        return closed
+
+    def flush(self):
+        """
+        Closes the current run, e.g. before the system shuts down.
+
+        :return: The closed run as a list with one CSV line, or an empty list.
+        """
+        if self.run is None:
+            return []
+        run = self.run
+        self.run = None
+        self.runs += 1
+        return [",".join(run["fields"][:7] + [run["end"].strftime(TIME_FORMAT), str(run["count"])])]
@@ -0,0 +1,300 @@
+'''
+
+        +----------------------------+
+        |        FrameBus.py         |
+        +----------------------------+
+
+This module is the shared-memory frame bus between the capture processes and the analysis
+workers started by the watch dog. Every camera has one ring buffer: a memory-mapped file (in
+/dev/shm by default) holding a small header and a fixed number of frame slots.
+
+    header  | magic | epoch | slots | width | height | channels | write seq | heartbeat | frames |
+    slot n  | seq | timestamp | width * height * channels bytes of pixels |
+
+The capture process is the only writer. It copies every frame into the next slot and publishes
+it by updating the slot and header sequence numbers. Readers copy the newest slot straight out
+of the mapping and check that the slot sequence did not change while copying (a seqlock), so
+there is no locking, no pickling and no pipe between the processes.
+
+Run as a capture process:
+
+    python src/FrameBus.py <camera> <ring file> [slots]
+
+'''
+
+import mmap
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+MAGIC = b"PKRING1\0"
+HEADER = struct.Struct("<8sQIIIIQdQ")
+SLOT_HEADER = struct.Struct("<Qd")
+HEADER_SIZE = 64
+SLOT_HEADER_SIZE = 16
+
+# Offset of the write seq, heartbeat and frames fields that change after the ring is created
+WRITE_SEQ_OFFSET = 32
+
+def ring_path(directory, camera_index):
+    return os.path.join(directory, f"parkit-camera-{camera_index}.ring")
+
+class FrameRingWriter:
+    """
+    Creates a ring buffer file and publishes frames into it.
+
+    :param path: The ring buffer file.
+    :param width: Frame width in pixels.
+    :param height: Frame height in pixels.
+    :param channels: Bytes per pixel, 3 for BGR frames.
+    :param slots: Number of frames kept in the ring.
+    """
+
+    def __init__(self, path, width, height, channels=3, slots=4):
+        self.path = path
+        self.slots = slots
+        self.frame_shape = (height, width, channels)
+        self.frame_size = width * height * channels
+        self.slot_size = SLOT_HEADER_SIZE + self.frame_size
+        self.seq = 0
+
+        # Build the file next to its final name and rename it, so readers never see a half
+        # initialised header. A new epoch tells readers that the capture process restarted.
+        epoch = int.from_bytes(os.urandom(8), "little")
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.truncate(HEADER_SIZE + slots * self.slot_size)
+            file.write(HEADER.pack(MAGIC, epoch, slots, width, height, channels, 0, time.time(), 0))
+        os.replace(temp_path, path)
+
+        with open(path, "r+b") as file:
+            self.map = mmap.mmap(file.fileno(), 0)
+        self.views = [np.ndarray(self.frame_shape, dtype=np.uint8, buffer=self.map,
+                                 offset=HEADER_SIZE + i * self.slot_size + SLOT_HEADER_SIZE)
+                      for i in range(slots)]
+
+    def publish(self, frame, timestamp=None):
+        """
+        Copies a frame into the next slot and makes it visible to the readers.
+        """
+        self.seq += 1
+        slot = self.seq % self.slots
+        slot_offset = HEADER_SIZE + slot * self.slot_size
+
+        # Sequence 0 marks the slot as being written
+        SLOT_HEADER.pack_into(self.map, slot_offset, 0, 0.0)
+        np.copyto(self.views[slot], frame)
+        timestamp = time.time() if timestamp is None else timestamp
+        SLOT_HEADER.pack_into(self.map, slot_offset, self.seq, timestamp)
+
+        struct.pack_into("<QdQ", self.map, WRITE_SEQ_OFFSET, self.seq, timestamp, self.seq)
+
+    def close(self):
+        self.views = []
+        self.map.close()
+
+class FrameRingReader:
+    """
+    Reads the newest frames of a ring buffer. Has the same read() interface as FrameGrabber,
+    so the detector can use either one.
+
+    :param path: The ring buffer file.
+    :param stale_after: Seconds without a new frame after which the ring is reopened, because
+                        the capture process may have restarted with a new ring.
+    """
+
+    def __init__(self, path, stale_after=3.0):
+        self.path = path
+        self.stale_after = stale_after
+        self.map = None
+        self.epoch = None
+        self.last_seq = 0
+        self.ended = False
+        self.frame_width = 0
+        self.frame_height = 0
+
+        # Counters
+        self.processed = 0
+        self.missed = 0
+        self.retries = 0
+        self.reopened = 0
+        self.last_latency = 0.0
+        self.last_frame_time = time.time()
+        self.last_restart_check = 0.0
+
+    def open(self, timeout=30.0):
+        """
+        Waits until the capture process created the ring.
+
+        :return: True if the ring is open.
+        """
+        deadline = time.time() + timeout
+        while True:
+            if self._attach():
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.1)
+
+    def _attach(self):
+        try:
+            with open(self.path, "rb") as file:
+                new_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return False
+        magic, epoch, slots, width, height, channels, write_seq, _, _ = HEADER.unpack_from(new_map, 0)
+        if magic != MAGIC:
+            new_map.close()
+            return False
+        if self.map is not None:
+            self.map.close()
+            self.reopened += 1
+        self.map = new_map
+        self.epoch = epoch
+        self.slots = slots
+        self.frame_width = width
+        self.frame_height = height
+        self.frame_shape = (height, width, channels)
+        self.slot_size = SLOT_HEADER_SIZE + width * height * channels
+        # Frames are copied into two reused buffers, the one returned last stays untouched
+        self.buffers = [np.empty(self.frame_shape, dtype=np.uint8) for _ in range(2)]
+        self.next_buffer = 0
+        self.last_seq = 0
+        self.last_frame_time = time.time()
+        return True
+
+    def _restarted(self):
+        # The capture process writes a new file with a new epoch when it restarts
+        try:
+            with open(self.path, "rb") as file:
+                header = file.read(HEADER.size)
+        except FileNotFoundError:
+            return False
+        return len(header) == HEADER.size and HEADER.unpack(header)[1] != self.epoch
+
+    def header(self):
+        """
+        :return: The published sequence number, the last heartbeat and the number of frames.
+        """
+        return struct.unpack_from("<QdQ", self.map, WRITE_SEQ_OFFSET)
+
+    def read(self, timeout=5.0):
+        """
+        Waits for a frame newer than the last one returned.
+
+        :return: (ret, frame, captured_at). ret is False if no new frame arrived within the timeout.
+        """
+        if self.map is None and not self.open(timeout):
+            return False, None, None
+
+        deadline = time.time() + timeout
+        while True:
+            write_seq = self.header()[0]
+            if write_seq > self.last_seq:
+                frame, captured_at, seq = self._copy_newest(write_seq)
+                if frame is not None:
+                    if self.last_seq and seq > self.last_seq + 1:
+                        self.missed += seq - self.last_seq - 1
+                    self.last_seq = seq
+                    self.last_frame_time = time.time()
+                    self.processed += 1
+                    return True, frame, captured_at
+
+            now = time.time()
+            if now - self.last_frame_time > self.stale_after and now - self.last_restart_check > 0.5:
+                self.last_restart_check = now
+                if self._restarted():
+                    self._attach()
+                    continue
+            if now >= deadline:
+                return False, None, None
+            time.sleep(0.002)
+
+    def _copy_newest(self, write_seq):
+        for _ in range(3):
+            slot_offset = HEADER_SIZE + (write_seq % self.slots) * self.slot_size
+            seq, captured_at = SLOT_HEADER.unpack_from(self.map, slot_offset)
+            if seq == write_seq:
+                pixels = np.frombuffer(self.map, dtype=np.uint8, count=self.slot_size - SLOT_HEADER_SIZE,
+                                       offset=slot_offset + SLOT_HEADER_SIZE)
+                frame = self.buffers[self.next_buffer]
+                np.copyto(frame, pixels.reshape(self.frame_shape))
+                # The writer may have lapped us while we were copying
+                if SLOT_HEADER.unpack_from(self.map, slot_offset)[0] == seq:
+                    self.next_buffer = 1 - self.next_buffer
+                    return frame, captured_at, seq
+            self.retries += 1
+            write_seq = self.header()[0]
+        return None, None, None
+
+    def mark_done(self, captured_at):
+        self.last_latency = time.time() - captured_at
+
+    def stats(self):
+        write_seq, heartbeat, frames = self.header() if self.map is not None else (0, 0.0, 0)
+        return {"published": frames, "processed": self.processed, "missed": self.missed,
+                "retries": self.retries, "reopened": self.reopened, "latency": self.last_latency,
+                "heartbeat_age": round(time.time() - heartbeat, 3) if heartbeat else None}
+
+    def stop(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+def read_ring_status(path):
+    """
+    Reads the header of a ring buffer without mapping the frames, used for health reports.
+
+    :return: A dictionary with frames, width, height and the age of the last frame, or None.
+    """
+    try:
+        with open(path, "rb") as file:
+            header = file.read(HEADER.size)
+    except FileNotFoundError:
+        return None
+    if len(header) != HEADER.size:
+        return None
+    magic, epoch, slots, width, height, channels, write_seq, heartbeat, frames = HEADER.unpack(header)
+    if magic != MAGIC:
+        return None
+    return {"frames": frames, "width": width, "height": height,
+            "last_frame_age": round(time.time() - heartbeat, 3)}
+
+def capture_main(camera, path, slots):
+    """
+    Capture process: reads a camera and publishes every frame into its ring buffer.
+    """
+    from Adaptation import log
+    from FrameGrabber import open_source
+
+    cap = open_source(camera)
+    if not cap.isOpened():
+        log(f"Capture {camera}: could not open camera.", "ERROR")
+        return 1
+
+    ret, frame = cap.read()
+    if not ret:
+        log(f"Capture {camera}: could not read frame from camera.", "ERROR")
+        return 1
+
+    height, width = frame.shape[:2]
+    channels = frame.shape[2] if frame.ndim == 3 else 1
+    writer = FrameRingWriter(path, width, height, channels, slots)
+    log(f"Capture {camera}: publishing {width}x{height} frames to {path}")
+
+    try:
+        while ret:
+            writer.publish(frame)
+            # The frame was copied into the ring, its buffer is read into again
+            ret, frame = cap.read(frame)
+        log(f"Capture {camera}: could not read frame from camera.", "ERROR")
+        return 1
+    finally:
+        cap.release()
+        writer.close()
+
+if __name__ == "__main__":
+    sys.exit(capture_main(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 4))
@@ -0,0 +1,309 @@
+'''
+
+        +----------------------------+
+        |      FrameGrabber.py       |
+        +----------------------------+
+
+This module contains the capture stage of the Parkit pipeline. A FrameGrabber reads the camera on
+its own thread and keeps only the newest frames in a small bounded queue. When the processing stage
+falls behind (YOLO, plotting, ...) the oldest frame is dropped, so the processing stage always works
+on the most recent picture and the latency from capture to status update stays within one
+processing iteration.
+
+open_source() opens the frame source of a <camera>: a device index, a stream URL, a recorded
+video file or a directory of images. Recordings are replayed at their native rate like a live
+camera, or as fast as possible without dropping frames, which is used for benchmarks.
+
+A SamplingScheduler lowers the rate at which a camera is checked while its spaces are steady.
+
+'''
+
+import os
+import threading
+import time
+from collections import deque
+
+import cv2
+
+from Adaptation import log
+
+class FrameGrabber:
+    """
+    Threaded capture stage with a drop-oldest frame queue.
+
+    :param cap: An opened cv2.VideoCapture (or any object with read(), get() and release()).
+    :param max_queue: Number of frames kept for the processing stage. 1 keeps only the newest one.
+    :param block: Wait for the processing stage instead of dropping frames, for recordings that
+                  are replayed as fast as possible.
+    """
+
+    def __init__(self, cap, max_queue=1, block=False):
+        self.cap = cap
+        self.block = block
+        self.frames = deque(maxlen=max_queue)
+        # Frames are read into reused buffers: one being read, the queued ones and the one the
+        # processing stage works on. A buffer is only read into again once it is free, i.e. its
+        # frame was dropped or the processing stage asked for the next frame.
+        self.buffers = [None] * (max_queue + 2)
+        self.free = deque(range(len(self.buffers)))
+        self.held = None
+        self.condition = threading.Condition()
+        self.running = False
+        self.ended = False
+        self.thread = None
+
+        # Frame size is queried once instead of on every frame
+        self.frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+        # Counters
+        self.captured = 0
+        self.dropped = 0
+        self.processed = 0
+        self.last_latency = 0.0
+        self.cpu_time = 0.0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="FrameGrabber", daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while self.running:
+            with self.condition:
+                # There is always a free buffer: at most one is held and maxlen are queued
+                index = self.free.popleft()
+            ret, frame = self.cap.read(self.buffers[index])
+            if not ret:
+                with self.condition:
+                    self.free.append(index)
+                    self.ended = True
+                    self.condition.notify_all()
+                return
+            captured_at = time.time()
+            self.cpu_time = time.thread_time()
+            self.buffers[index] = frame
+            with self.condition:
+                if self.block:
+                    self.condition.wait_for(lambda: len(self.frames) < self.frames.maxlen or not self.running)
+                if len(self.frames) == self.frames.maxlen:
+                    self.free.append(self.frames.popleft()[0])
+                    self.dropped += 1
+                self.frames.append((index, captured_at))
+                self.captured += 1
+                self.condition.notify()
+
+    def read(self, timeout=5.0):
+        """
+        Waits for the next frame that was not handed out yet. The frame stays unchanged until the
+        next call.
+
+        :param timeout: Seconds to wait for the camera.
+        :return: (ret, frame, captured_at) like cv2.VideoCapture.read(), plus the capture time.
+                 ret is False once the camera stopped delivering frames.
+        """
+        with self.condition:
+            if not self.frames and not self.ended:
+                self.condition.wait_for(lambda: self.frames or self.ended, timeout)
+            if not self.frames:
+                return False, None, None
+            index, captured_at = self.frames.popleft()
+            # The frame handed out before is free again
+            if self.held is not None:
+                self.free.append(self.held)
+            self.held = index
+            self.processed += 1
+            self.condition.notify_all()
+        return True, self.buffers[index], captured_at
+
+    def mark_done(self, captured_at):
+        """
+        Records the latency from capture until the processing stage finished with the frame.
+        """
+        self.last_latency = time.time() - captured_at
+
+    def stats(self):
+        with self.condition:
+            return {"captured": self.captured, "dropped": self.dropped, "processed": self.processed,
+                    "queued": len(self.frames), "latency": self.last_latency}
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(2)
+            self.thread = None
+        self.cap.release()
+        log(f"FrameGrabber: captured={self.captured} dropped={self.dropped} processed={self.processed}")
+
+class RateLimiter:
+    """
+    Limits the processing stage to a target rate. The FrameGrabber keeps capturing while the
+    processing stage sleeps, so the frames in between are skipped and the next iteration still
+    gets the newest picture.
+
+    :param target_fps: Iterations per second. 0 disables the limit.
+    """
+
+    def __init__(self, target_fps):
+        self.interval = 1.0 / target_fps if target_fps > 0 else 0.0
+        self.next_time = None
+        self.slept = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self.next_time is None:
+            self.next_time = now
+        delay = self.next_time - now
+        if delay > 0:
+            time.sleep(delay)
+            self.slept += delay
+        # Do not try to catch up after a slow iteration
+        self.next_time = max(self.next_time + self.interval, time.monotonic())
+
+class SamplingScheduler:
+    """
+    Decides when the occupancy of a camera is checked. While nothing changes in any space of the
+    camera, the frames are only checked at the steady rate. As soon as a space changes, is waiting
+    for its occupied timer or for a detection, every frame is checked again.
+
+    :param steady_fps: Checks per second in the steady state. 0 checks every frame.
+    :param steady_after: Seconds without a change before the steady state starts.
+    """
+
+    def __init__(self, steady_fps=2.0, steady_after=10.0):
+        self.interval = 1.0 / steady_fps if steady_fps > 0 else 0.0
+        self.steady_after = steady_after
+        self.last_change = time.time()
+        self.next_check = 0.0
+
+        # Counters since the last stats() call
+        self.window_start = time.time()
+        self.checks = 0
+        self.inferences = 0
+
+    def steady(self, now):
+        return self.interval > 0 and now - self.last_change >= self.steady_after
+
+    def due(self, now):
+        return not self.steady(now) or now >= self.next_check
+
+    def checked(self, now, active):
+        """
+        :param now: The time of the check.
+        :param active: Something changed, or a space is waiting for its timer or a detection.
+        """
+        if active:
+            self.last_change = now
+        self.next_check = now + self.interval
+        self.checks += 1
+
+    def stats(self, now):
+        """
+        :return: The mode and the effective check and inference rates since the last call.
+        """
+        elapsed = max(now - self.window_start, 1e-6)
+        stats = {"mode": "steady" if self.steady(now) else "full",
+                 "check_rate": round(self.checks / elapsed, 2),
+                 "inference_rate": round(self.inferences / elapsed, 2)}
+        self.window_start = now
+        self.checks = 0
+        self.inferences = 0
+        return stats
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+class ImageSequenceCapture:
+    """
+    Reads the images of a directory in name order, with the read() interface of cv2.VideoCapture.
+
+    :param directory: The directory of the images.
+    :param fps: Frame rate reported for the sequence.
+    """
+
+    def __init__(self, directory, fps=10.0):
+        self.paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                            if name.lower().endswith(IMAGE_EXTENSIONS))
+        self.position = 0
+        self.fps = fps
+        first = cv2.imread(self.paths[0]) if self.paths else None
+        self.shape = first.shape if first is not None else (0, 0)
+
+    def isOpened(self):
+        return bool(self.paths)
+
+    def read(self, image=None):
+        if self.position >= len(self.paths):
+            return False, None
+        frame = cv2.imread(self.paths[self.position])
+        self.position += 1
+        return frame is not None, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.shape[1]
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.shape[0]
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self.paths)
+        return 0
+
+    def release(self):
+        self.paths = []
+
+class PacedCapture:
+    """
+    Replays a recording at its native rate, like a live camera would deliver it.
+
+    :param cap: The opened recording.
+    :param fps: Frame rate, the rate of the recording if None.
+    """
+
+    def __init__(self, cap, fps=None):
+        self.cap = cap
+        self.interval = 1.0 / (fps or cap.get(cv2.CAP_PROP_FPS) or 30.0)
+        self.next_time = None
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def read(self, image=None):
+        now = time.monotonic()
+        if self.next_time is None:
+            self.next_time = now
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+        self.next_time += self.interval
+        return self.cap.read(image)
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def release(self):
+        self.cap.release()
+
+def is_recording(source):
+    return os.path.isfile(source) or os.path.isdir(source)
+
+def open_source(source, playback="native", fps=None):
+    """
+    Opens the frame source of a camera.
+
+    :param source: A device index, a stream URL, a video file or a directory of images.
+    :param playback: "native" replays recordings at their frame rate, "fast" as fast as possible.
+    :param fps: Frame rate of a recording, overrides the rate stored in the file.
+    :return: An object with the read(), get(), isOpened() and release() methods of cv2.VideoCapture.
+    """
+    if os.path.isdir(source):
+        cap = ImageSequenceCapture(source, fps or 10.0)
+    else:
+        cap = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if playback == "native" and is_recording(source):
+        cap = PacedCapture(cap, fps)
+    return cap
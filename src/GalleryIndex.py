@@ -0,0 +1,234 @@
+'''
+
+        +----------------------------+
+        |      GalleryIndex.py       |
+        +----------------------------+
+
+This module keeps the manifest of the graph gallery, so the gallery pages list the snapshots
+without scanning the directory and only load small thumbnails:
+
+    <gallery-location>/
+        manifest.json       one entry per snapshot, oldest first
+        manifest.lock       taken while the manifest is changed (also by delete_graph.php)
+        thumbs/             a small copy of every snapshot, same file name
+        <graph>-<space>-YYYY-MM-DD-HH-MM-SS.png
+
+An entry holds the file, the time and space of the snapshot, its size in bytes and the summary
+of the session it shows (samples, occupied and vacant percentages, best time to park and the
+longest streak). The watch dog adds a snapshot for every space when the system stops and then
+applies the retention policy: the oldest snapshots are removed while there are more than
+<gallery-max-snapshots>, they take more than <gallery-max-megabytes> or they are older than
+<gallery-max-days> (0 turns a limit off).
+
+A gallery of an older version is indexed once, with thumbnails, when the manifest is missing:
+
+    python src/GalleryIndex.py rebuild <gallery dir>
+
+'''
+
+import fcntl
+import json
+import os
+import re
+import shutil
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import cv2
+
+from Adaptation import log
+
+MANIFEST_VERSION = 1
+THUMBNAIL_DIRECTORY = "thumbs"
+
+# The date and time at the end of a snapshot file name
+SNAPSHOT_TIME = re.compile(r"(\d{4})-(\d{2})-(\d{2})-(\d{2})-(\d{2})-(\d{2})\.png$")
+
+def snapshot_time(file_name):
+    """
+    :return: The time in the file name as "YYYY-MM-DD HH:MM:SS", or None.
+    """
+    match = SNAPSHOT_TIME.search(file_name)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second = match.groups()
+    return f"{year}-{month}-{day} {hour}:{minute}:{second}"
+
+class GalleryIndex:
+    """
+    The manifest of the snapshots in a gallery directory.
+
+    :param directory: The gallery directory. It is created if it does not exist.
+    :param thumbnail_width: Width of the thumbnails in pixels.
+    """
+
+    def __init__(self, directory, thumbnail_width=320):
+        self.directory = directory
+        self.thumbnail_width = thumbnail_width
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.lock_path = os.path.join(directory, "manifest.lock")
+        os.makedirs(os.path.join(directory, THUMBNAIL_DIRECTORY), exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def entries(self):
+        """
+        :return: Every entry of the manifest, oldest first. An empty list without a manifest.
+        """
+        if not os.path.exists(self.manifest_path):
+            return []
+        with open(self.manifest_path, "r") as file:
+            return json.load(file)["snapshots"]
+
+    def _write(self, entries):
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"version": MANIFEST_VERSION, "snapshots": entries}, file, indent=1)
+        os.replace(temp_path, self.manifest_path)
+
+    def _thumbnail(self, file_name):
+        image = cv2.imread(os.path.join(self.directory, file_name))
+        if image is None:
+            return None
+        height, width = image.shape[:2]
+        scale = min(1.0, self.thumbnail_width / width)
+        thumbnail = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+        cv2.imwrite(os.path.join(self.directory, THUMBNAIL_DIRECTORY, file_name), thumbnail)
+        return f"{THUMBNAIL_DIRECTORY}/{file_name}"
+
+    def _entry(self, file_name, space, time, summary):
+        return {"file": file_name,
+                "thumbnail": self._thumbnail(file_name),
+                "time": time or snapshot_time(file_name),
+                "space": space or "",
+                "bytes": os.path.getsize(os.path.join(self.directory, file_name)),
+                "summary": summary or {}}
+
+    def add(self, source, file_name, space=None, time=None, summary=None):
+        """
+        Copies a graph into the gallery and indexes it.
+
+        :param source: The graph PNG.
+        :param file_name: File name of the snapshot in the gallery.
+        :param space: The space name, None for the unnamed space.
+        :param time: "YYYY-MM-DD HH:MM:SS", by default the time in the file name.
+        :param summary: Statistics of the session the graph shows.
+        :return: The new entry, or None if the graph does not exist.
+        """
+        if not os.path.exists(source):
+            return None
+        shutil.copy(source, os.path.join(self.directory, file_name))
+        entry = self._entry(file_name, space, time, summary)
+        with self._locked():
+            entries = [existing for existing in self.entries() if existing["file"] != file_name]
+            entries.append(entry)
+            entries.sort(key=lambda existing: existing["time"] or "")
+            self._write(entries)
+        log(f"Gallery: added {file_name} ({entry['bytes']} bytes)")
+        return entry
+
+    def _remove_files(self, entry):
+        for path in (os.path.join(self.directory, entry["file"]),
+                     os.path.join(self.directory, entry["thumbnail"]) if entry.get("thumbnail") else None):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    def remove(self, file_name):
+        """
+        Deletes a snapshot and its thumbnail.
+
+        :return: True if the snapshot was in the manifest.
+        """
+        file_name = os.path.basename(file_name)
+        with self._locked():
+            entries = self.entries()
+            kept = [entry for entry in entries if entry["file"] != file_name]
+            for entry in entries:
+                if entry["file"] == file_name:
+                    self._remove_files(entry)
+            if len(kept) == len(entries):
+                return False
+            self._write(kept)
+        log(f"Gallery: removed {file_name}")
+        return True
+
+    def enforce_retention(self, max_snapshots=0, max_bytes=0, max_days=0, now=None):
+        """
+        Removes the oldest snapshots until every limit holds. A limit of 0 is no limit.
+
+        :return: The number of removed snapshots.
+        """
+        oldest_kept = ((now or datetime.now()) - timedelta(days=max_days)).strftime("%Y-%m-%d %H:%M:%S") if max_days else None
+        with self._locked():
+            entries = self.entries()
+            total = sum(entry["bytes"] for entry in entries)
+            removed = 0
+            while entries and ((max_snapshots and len(entries) > max_snapshots) or (max_bytes and total > max_bytes)
+                               or (oldest_kept and (entries[0]["time"] or "") < oldest_kept)):
+                entry = entries.pop(0)
+                total -= entry["bytes"]
+                self._remove_files(entry)
+                removed += 1
+            if removed:
+                self._write(entries)
+        if removed:
+            log(f"Gallery: retention removed {removed} snapshot(s), {len(entries)} left ({total} bytes)")
+        return removed
+
+    def page(self, page=1, per_page=12, start=None, end=None, space=None):
+        """
+        One page of the snapshots, newest first.
+
+        :param start: First time included, "YYYY-MM-DD" or "YYYY-MM-DD HH:MM:SS".
+        :param end: Last day or time included.
+        :param space: Only the snapshots of this space.
+        :return: A dictionary with the keys total, page, pages and items.
+        """
+        entries = self.entries()
+        if start:
+            entries = [entry for entry in entries if (entry["time"] or "") >= start]
+        if end:
+            # A day includes all of its times
+            end = end + " 23:59:59" if len(end) == 10 else end
+            entries = [entry for entry in entries if (entry["time"] or "") <= end]
+        if space is not None:
+            entries = [entry for entry in entries if entry["space"] == space]
+        per_page = max(1, per_page)
+        pages = max(1, -(-len(entries) // per_page))
+        page = min(max(1, page), pages)
+        newest_first = entries[::-1]
+        return {"total": len(entries), "page": page, "pages": pages,
+                "items": newest_first[(page - 1) * per_page:page * per_page]}
+
+    def rebuild(self):
+        """
+        Indexes every PNG in the directory that is not in the manifest yet and drops the entries
+        whose file is gone.
+
+        :return: The number of entries.
+        """
+        with self._locked():
+            entries = [entry for entry in self.entries()
+                       if os.path.exists(os.path.join(self.directory, entry["file"]))]
+            known = {entry["file"] for entry in entries}
+            for file_name in sorted(os.listdir(self.directory)):
+                if file_name.endswith(".png") and file_name not in known:
+                    entries.append(self._entry(file_name, None, None, None))
+            entries.sort(key=lambda entry: entry["time"] or "")
+            self._write(entries)
+        log(f"Gallery: indexed {len(entries)} snapshot(s) in {self.directory}")
+        return len(entries)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "rebuild":
+        print("Usage: python src/GalleryIndex.py rebuild <gallery dir>")
+        sys.exit(1)
+    GalleryIndex(sys.argv[2]).rebuild()
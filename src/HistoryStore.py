@@ -0,0 +1,280 @@
+'''
+
+        +----------------------------+
+        |      HistoryStore.py       |
+        +----------------------------+
+
+This module contains the occupancy history of the Parkit system. It replaces the ever-growing
+total-parkit.csv with an append-only binary store that is queried without parsing text:
+
+    <history-location>/
+        spaces.txt          one space name per line, the line number is the space id
+        2024-05/            one partition per month
+            time.i8         epoch seconds of every row (local wall clock time)
+            space.u2        space id of every row
+            status.u1       OCCUPIED_BIT | CAR_BIT
+            rect.i4         x, y, width, height of the space at the time of the row
+
+The columns are plain little-endian arrays, memory-mapped with NumPy when queried. A range query
+only opens the partitions of the requested months and uses a binary search on the time column,
+so a query over a year of 2-second samples takes milliseconds.
+
+The watch dog is the only writer: it merges each finished session CSV into the store. Rows keep
+the CSV format on import and export:
+
+    python src/HistoryStore.py import <history dir> <csv file> [space name]
+    python src/HistoryStore.py export <history dir> <csv file> [space name]
+
+'''
+
+import csv
+import os
+import re
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+from Adaptation import log
+from EventLog import expand_event, is_event
+
+OCCUPIED_BIT = 1
+CAR_BIT = 2
+
+COLUMNS = {
+    "time": np.dtype("<i8"),
+    "space": np.dtype("<u2"),
+    "status": np.dtype("u1"),
+    "rect": np.dtype("<i4"),
+}
+RECT_WIDTH = 4
+PARTITION_NAME = re.compile(r"\d{4}-\d{2}")
+
+# Rows returned by a query. time is datetime64[s], rect has one [x, y, width, height] per row.
+HistoryRows = namedtuple("HistoryRows", ["time", "space", "status", "rect"])
+
+def encode_status(msg_occu, msg_car):
+    return (OCCUPIED_BIT if msg_occu == "OCCUPIED" else 0) | (CAR_BIT if msg_car == "CAR PRESENT" else 0)
+
+def to_datetime64(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return np.datetime64(value.strip(), "s")
+    return np.datetime64(value, "s")
+
+class HistoryStore:
+    """
+    Append-only columnar occupancy history.
+
+    :param directory: The directory of the store. It is created if it does not exist.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.spaces_path = os.path.join(directory, "spaces.txt")
+        self.space_names = []
+        if os.path.exists(self.spaces_path):
+            with open(self.spaces_path, "r") as file:
+                self.space_names = file.read().split("\n")[:-1]
+
+    def space_id(self, name, create=False):
+        """
+        :param name: The space name, None or "" for the unnamed space.
+        :param create: Add the space if it is not known yet.
+        :return: The id of the space, or None if it is unknown.
+        """
+        name = name or ""
+        if name in self.space_names:
+            return self.space_names.index(name)
+        if not create:
+            return None
+        with open(self.spaces_path, "a") as file:
+            file.write(f"{name}\n")
+        self.space_names.append(name)
+        return len(self.space_names) - 1
+
+    def partitions(self):
+        """
+        :return: The month keys ("YYYY-MM") of every partition, oldest first.
+        """
+        # Other directories, like the rollups (RollupStore.py), are not partitions
+        return sorted(entry for entry in os.listdir(self.directory)
+                      if PARTITION_NAME.fullmatch(entry) and os.path.isdir(os.path.join(self.directory, entry)))
+
+    def _column_path(self, month, column):
+        return os.path.join(self.directory, month, f"{column}.{COLUMNS[column].str[1:]}")
+
+    def _row_count(self, month):
+        # Rows are complete once every column has them, a crash during an append leaves extra bytes
+        counts = []
+        for column, dtype in COLUMNS.items():
+            path = self._column_path(month, column)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            width = RECT_WIDTH if column == "rect" else 1
+            counts.append(size // (dtype.itemsize * width))
+        return min(counts)
+
+    def append(self, space, times, statuses, rects):
+        """
+        Appends rows of one space.
+
+        :param space: The space name.
+        :param times: The row times, datetime64 or anything np.datetime64 accepts.
+        :param statuses: The status codes, see encode_status().
+        :param rects: One [x, y, width, height] per row.
+        :return: The number of rows appended.
+        """
+        times = np.asarray(times, dtype="datetime64[s]")
+        if len(times) == 0:
+            return 0
+        space_id = self.space_id(space, create=True)
+        statuses = np.asarray(statuses, dtype=COLUMNS["status"])
+        rects = np.asarray(rects, dtype=COLUMNS["rect"]).reshape(-1, RECT_WIDTH)
+
+        months = times.astype("datetime64[M]")
+        for month in np.unique(months):
+            rows = months == month
+            self._append_partition(str(month), times[rows].astype(COLUMNS["time"]),
+                                   np.full(np.count_nonzero(rows), space_id, dtype=COLUMNS["space"]),
+                                   statuses[rows], rects[rows])
+        return len(times)
+
+    def _append_partition(self, month, times, spaces, statuses, rects):
+        os.makedirs(os.path.join(self.directory, month), exist_ok=True)
+        rows = self._row_count(month)
+        for column, values in (("time", times), ("space", spaces), ("status", statuses), ("rect", rects)):
+            path = self._column_path(month, column)
+            with open(path, "ab") as file:
+                # Drop the tail of an interrupted append before adding new rows
+                width = RECT_WIDTH if column == "rect" else 1
+                file.truncate(rows * COLUMNS[column].itemsize * width)
+                file.write(np.ascontiguousarray(values, dtype=COLUMNS[column]).tobytes())
+
+    def _map(self, month, column, rows):
+        if rows == 0:
+            return np.empty(0, dtype=COLUMNS[column])
+        width = RECT_WIDTH if column == "rect" else 1
+        values = np.memmap(self._column_path(month, column), dtype=COLUMNS[column], mode="r",
+                           shape=(rows * width,))
+        return values.reshape(rows, RECT_WIDTH) if column == "rect" else values
+
+    def query(self, space=None, start=None, end=None):
+        """
+        Returns the rows of a space (or every space) in a time range.
+
+        :param space: The space name, or None for every space.
+        :param start: First time included, datetime, datetime64 or "YYYY-MM-DD HH:MM:SS".
+        :param end: First time excluded.
+        :return: HistoryRows in the order they were appended within every month.
+        """
+        start = to_datetime64(start)
+        end = to_datetime64(end)
+        space_id = None
+        if space is not None:
+            space_id = self.space_id(space)
+            if space_id is None:
+                return self._rows([])
+
+        parts = []
+        for month in self.partitions():
+            month_start = np.datetime64(month, "M").astype("datetime64[s]")
+            month_end = (np.datetime64(month, "M") + 1).astype("datetime64[s]")
+            if (start is not None and month_end <= start) or (end is not None and month_start >= end):
+                continue
+
+            rows = self._row_count(month)
+            times = self._map(month, "time", rows)
+            selection = slice(0, rows)
+            if start is not None or end is not None:
+                first = start.astype(np.int64) if start is not None else np.iinfo(np.int64).min
+                last = end.astype(np.int64) if end is not None else np.iinfo(np.int64).max
+                if rows and np.all(times[1:] >= times[:-1]):
+                    selection = slice(np.searchsorted(times, first, "left"), np.searchsorted(times, last, "left"))
+                else:
+                    selection = np.flatnonzero((times >= first) & (times < last))
+
+            spaces = self._map(month, "space", rows)[selection]
+            columns = [times[selection], spaces, self._map(month, "status", rows)[selection],
+                       self._map(month, "rect", rows)[selection]]
+            if space_id is not None:
+                rows_of_space = spaces == space_id
+                columns = [values[rows_of_space] for values in columns]
+            parts.append(columns)
+        return self._rows(parts)
+
+    def _rows(self, parts):
+        if not parts:
+            return HistoryRows(np.empty(0, dtype="datetime64[s]"), np.empty(0, dtype=COLUMNS["space"]),
+                               np.empty(0, dtype=COLUMNS["status"]), np.empty((0, RECT_WIDTH), dtype=COLUMNS["rect"]))
+        if len(parts) == 1:
+            columns = parts[0]
+        else:
+            columns = [np.concatenate(values) for values in zip(*parts)]
+        return HistoryRows(columns[0].view("datetime64[s]"), *columns[1:])
+
+    def count(self):
+        return sum(self._row_count(month) for month in self.partitions())
+
+    def import_csv(self, csv_path, space, chunk_rows=50000):
+        """
+        Streams a data CSV into the store. The header and comment rows are skipped, runs of the
+        change-only recording mode are expanded into their samples.
+
+        :param csv_path: A session CSV or a total-parkit.csv.
+        :param space: The space the rows belong to.
+        :return: The number of rows imported.
+        """
+        imported = 0
+        with open(csv_path, "r", newline="", encoding="utf-8") as file:
+            chunk = []
+            for row in csv.reader(file):
+                # Only data rows start with a status, which skips the header and the comments
+                if len(row) < 7 or row[0] not in ("OCCUPIED", "NOT OCCUPIED"):
+                    continue
+                chunk.extend(expand_event(row) if is_event(row) else [row])
+                if len(chunk) >= chunk_rows:
+                    imported += self._append_csv_rows(space, chunk)
+                    chunk = []
+            imported += self._append_csv_rows(space, chunk)
+        log(f"HistoryStore: imported {imported} rows of {space or 'space'} from {csv_path}")
+        return imported
+
+    def _append_csv_rows(self, space, rows):
+        if not rows:
+            return 0
+        times = np.array([row[2].strip() for row in rows], dtype="datetime64[s]")
+        statuses = [encode_status(row[0], row[1]) for row in rows]
+        rects = [[int(float(value)) for value in row[3:7]] for row in rows]
+        return self.append(space, times, statuses, rects)
+
+    def export_csv(self, csv_path, space=None, start=None, end=None, header=None):
+        """
+        Writes rows in the data CSV format.
+
+        :param header: Optional header line, e.g. the csv-column-names setting.
+        :return: The number of rows written.
+        """
+        rows = self.query(space, start, end)
+        times = np.datetime_as_string(rows.time, unit="s")
+        with open(csv_path, "w", newline="", encoding="utf-8") as file:
+            if header:
+                file.write(f"{header}\n")
+            writer = csv.writer(file)
+            for time, status, rect in zip(times, rows.status, rows.rect):
+                writer.writerow(["OCCUPIED" if status & OCCUPIED_BIT else "NOT OCCUPIED",
+                                 "CAR PRESENT" if status & CAR_BIT else "NO CAR PRESENT",
+                                 time.replace("T", " "), *rect.tolist()])
+        return len(times)
+
+if __name__ == "__main__":
+    command, directory, csv_path = sys.argv[1:4]
+    space_name = sys.argv[4] if len(sys.argv) > 4 else None
+    if command == "import":
+        print(HistoryStore(directory).import_csv(csv_path, space_name))
+    elif command == "export":
+        print(HistoryStore(directory).export_csv(csv_path, space_name))
+    else:
+        print(f"Unknown command '{command}'")
+        sys.exit(1)
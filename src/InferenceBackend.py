@@ -0,0 +1,155 @@
+'''
+
+        +----------------------------+
+        |    InferenceBackend.py     |
+        +----------------------------+
+
+This module contains the interchangeable implementations of the car detector. Every backend has
+the same detect() method, which returns the car boxes of a picture as a BOX_DTYPE array (see
+VehicleDetection.py), so the inference pool does not care which one runs:
+
+    torch       the YOLOv5 package on PyTorch, loaded from the <weights>
+    onnx        ONNX Runtime on the CPU, loaded from the <exported-model>
+    opencv      the OpenCV DNN module, loaded from the <exported-model>
+
+The exported model is written by ModelExport.py, together with a small JSON file holding the
+class names and the input size. An int8-quantized export runs with the onnx backend.
+
+The input size is the side of the square the picture is scaled to. Parking space pictures are
+small, so a smaller size than the default 640 is often as accurate and much faster. An exported
+model with a fixed input size always uses its own size.
+
+'''
+
+import json
+import os
+
+import cv2
+import numpy as np
+
+from VehicleDetection import class_ids, detect_cars, filter_detections
+
+BACKENDS = ("torch", "onnx", "opencv")
+
+# The classes of the pretrained YOLOv5 models, used when an exported model has no names file
+COCO_CAR = {2: "car"}
+
+def load_backend(backend, model_path, device="cpu", input_size=0, threads=0):
+    """
+    :param backend: One of BACKENDS.
+    :param model_path: The YOLOv5 weights for torch, the exported model otherwise.
+    :param device: Torch device, only used by the torch backend.
+    :param input_size: Side of the square input, 0 for the default of the model.
+    :param threads: CPU threads of one inference, 0 for the default of the runtime.
+    """
+    if backend == "torch":
+        return TorchBackend(model_path, device, input_size)
+    if backend == "onnx":
+        return OnnxBackend(model_path, input_size, threads)
+    if backend == "opencv":
+        return OpenCVBackend(model_path, input_size, threads)
+    raise ValueError(f"Unknown inference backend '{backend}', expected one of {', '.join(BACKENDS)}")
+
+def names_path(model_path):
+    return os.path.splitext(model_path)[0] + ".json"
+
+class TorchBackend:
+    def __init__(self, weights, device="cpu", input_size=0):
+        from yolov5 import YOLOv5
+        self.model = YOLOv5(weights, device=device)
+        self.input_size = input_size or 640
+
+    def detect(self, roi, min_confidence=0.0):
+        return detect_cars(self.model, roi, min_confidence, self.input_size)
+
+class ExportedBackend:
+    """
+    Pre- and post-processing of an exported YOLOv5 model, whose output holds one row per anchor:
+    center x, center y, width, height, objectness and the score of every class. The thresholds
+    of the non-maximum suppression are the defaults of YOLOv5.
+    """
+
+    conf_threshold = 0.25
+    iou_threshold = 0.45
+
+    def __init__(self, model_path, input_size=0):
+        self.model_path = model_path
+        names = COCO_CAR
+        if os.path.exists(names_path(model_path)):
+            with open(names_path(model_path), "r") as file:
+                info = json.load(file)
+            names = {int(key): value for key, value in info["names"].items()}
+            input_size = info.get("input_size") or input_size
+        self.car_ids = class_ids(names, ("car",))
+        self.input_size = input_size or 640
+
+    def _forward(self, blob):
+        raise NotImplementedError
+
+    def detect(self, roi, min_confidence=0.0):
+        size = self.input_size
+        height, width = roi.shape[:2]
+        scale = min(size / height, size / width)
+        resized = cv2.resize(roi, (max(1, round(width * scale)), max(1, round(height * scale))),
+                             interpolation=cv2.INTER_LINEAR)
+        # Letterbox: the picture keeps its aspect ratio, the rest of the square is grey
+        padded = np.full((size, size, 3), 114, dtype=np.uint8)
+        padded[:resized.shape[0], :resized.shape[1]] = resized
+        blob = cv2.dnn.blobFromImage(padded, 1 / 255.0, swapRB=True)
+
+        output = np.asarray(self._forward(blob), dtype=np.float32)
+        output = output.reshape(-1, output.shape[-1])
+        return filter_detections(self._boxes(output, scale, width, height), self.car_ids, min_confidence)
+
+    def _boxes(self, output, scale, width, height):
+        # Confidence of the best class of every anchor, then non-maximum suppression per class
+        scores = output[:, 5:] * output[:, 4:5]
+        classes = scores.argmax(axis=1)
+        confidence = scores.max(axis=1)
+        keep = confidence >= self.conf_threshold
+        output, classes, confidence = output[keep], classes[keep], confidence[keep]
+        if len(output) == 0:
+            return np.empty((0, 6), dtype=np.float32)
+
+        xyxy = np.empty((len(output), 4), dtype=np.float32)
+        xyxy[:, :2] = output[:, :2] - output[:, 2:4] / 2
+        xyxy[:, 2:] = output[:, :2] + output[:, 2:4] / 2
+        # Boxes of different classes never suppress each other
+        offset = classes[:, None].astype(np.float32) * 4096
+        shifted = xyxy + offset
+        chosen = cv2.dnn.NMSBoxes(np.column_stack([shifted[:, :2], shifted[:, 2:] - shifted[:, :2]]).tolist(),
+                                  confidence.tolist(), self.conf_threshold, self.iou_threshold)
+        chosen = np.asarray(chosen, dtype=np.int64).reshape(-1)
+
+        boxes = xyxy[chosen] / scale
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+        return np.column_stack([boxes, confidence[chosen], classes[chosen]]).astype(np.float32)
+
+class OnnxBackend(ExportedBackend):
+    def __init__(self, model_path, input_size=0, threads=0):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        super().__init__(model_path, input_size)
+        # A model exported with a fixed size only accepts that size
+        if isinstance(model_input.shape[2], int):
+            self.input_size = model_input.shape[2]
+
+    def _forward(self, blob):
+        return self.session.run(None, {self.input_name: blob})[0]
+
+class OpenCVBackend(ExportedBackend):
+    def __init__(self, model_path, input_size=0, threads=0):
+        if threads:
+            cv2.setNumThreads(threads)
+        self.net = cv2.dnn.readNetFromONNX(model_path)
+        super().__init__(model_path, input_size)
+
+    def _forward(self, blob):
+        self.net.setInput(blob)
+        return self.net.forward()
@@ -0,0 +1,378 @@
+'''
+
+        +----------------------------+
+        |      InferencePool.py      |
+        +----------------------------+
+
+This module moves YOLOv5 inference out of the capture/display loop. An InferencePool starts a
+number of worker processes, each with its own model loaded by the configured inference backend
+(InferenceBackend.py). The main loop submits the picture of a space and receives the detected car boxes
+through a future, while the occupancy check and the UI keep running at camera rate.
+
+    - At most max_in_flight pictures are processed at the same time.
+    - Latest wins per space: a space has at most one picture in flight and one waiting. A newer
+      picture of the same space replaces the waiting one, whose future is cancelled.
+    - workers=0 runs the model in the calling process, like before.
+    - With a host socket the pool starts no workers and connects to the model host of the watch
+      dog instead (ModelHost.py), whose models stay loaded while detectors crash and restart.
+    - A worker that exits is started again. Workers that exit before their model is ready (missing
+      weights, a broken backend) are started again WORKER_START_ATTEMPTS times in a row, then the
+      pool fails with their exit code: submit() and check() raise it.
+
+Workers are started as separate Python processes (the same way the watch dog starts the
+detector) and exchange pictures and results over a local Unix socket:
+
+    python src/InferencePool.py <socket> <backend> <model> <device> <input-size> <threads> <min-confidence>
+
+'''
+
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from InferenceBackend import load_backend
+
+AUTHKEY_VARIABLE = "PARKIT_INFERENCE_KEY"
+HOST_AUTHKEY_VARIABLE = "PARKIT_MODEL_HOST_KEY"
+WORKER_START_ATTEMPTS = 3
+
+class InferencePool:
+    """
+    Pool of YOLOv5 worker processes.
+
+    :param weights: Path of the YOLOv5 weights, or of the exported model for the onnx and opencv backends.
+    :param resource: Torch device, e.g. cpu.
+    :param workers: Number of worker processes. None uses one per CPU core, 0 runs in-process.
+    :param max_in_flight: Maximum number of pictures processed at once. Defaults to the worker count.
+    :param min_confidence: Minimum confidence of a returned car box.
+    :param host: Socket of a model host. The pool opens one connection per worker to it instead of
+                 starting workers.
+    :param backend: The inference backend, see InferenceBackend.BACKENDS.
+    :param input_size: Side of the square the pictures are scaled to, 0 for the default of the model.
+    """
+
+    def __init__(self, weights, resource, workers=None, max_in_flight=None, min_confidence=0.0, host=None,
+                 backend="torch", input_size=0):
+        self.weights = weights
+        self.resource = resource
+        self.backend = backend
+        self.input_size = input_size
+        self.min_confidence = min_confidence
+        self.host = host
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_in_flight = max_in_flight or max(1, self.workers)
+        # Split the cores between the workers instead of letting every worker use all of them
+        self.threads_per_worker = max(1, (os.cpu_count() or 1) // max(1, self.workers))
+
+        self.lock = threading.Lock()
+        self.model = None
+        self.listener = None
+        self.processes = []
+        # Worker processes that connected, by process id
+        self.ready_pids = set()
+        self.start_failures = 0
+        # Set when the workers keep exiting before they are ready
+        self.error = None
+        self.idle = deque()
+        self.connections = []
+        self.in_flight = {}
+        self.busy_keys = set()
+        self.pending = OrderedDict()
+        self.completed = deque()
+        self.next_job = 0
+        self.closing = False
+        # Time the first worker (or the in-process model) became ready
+        self.ready_at = None
+
+        # Metrics
+        self.submitted = 0
+        self.finished = 0
+        self.replaced = 0
+        self.failed = 0
+
+    def start(self):
+        if self.host is not None:
+            self.authkey = bytes.fromhex(os.environ[HOST_AUTHKEY_VARIABLE])
+            for _ in range(max(1, self.workers)):
+                self._connect_host()
+            return self
+
+        if self.workers == 0:
+            self.model = load_backend(self.backend, self.weights, self.resource, self.input_size)
+            self.ready_at = time.time()
+            return self
+
+        self.authkey = os.urandom(16)
+        self.socket_path = os.path.join(tempfile.mkdtemp(prefix="parkit-inference-"), "pool.sock")
+        self.listener = Listener(self.socket_path, family='AF_UNIX', authkey=self.authkey)
+        threading.Thread(target=self._accept, name="InferencePool-accept", daemon=True).start()
+        for _ in range(self.workers):
+            self._spawn_worker()
+        threading.Thread(target=self._watch, name="InferencePool-watch", daemon=True).start()
+        return self
+
+    def _spawn_worker(self):
+        env = dict(os.environ)
+        env[AUTHKEY_VARIABLE] = self.authkey.hex()
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), self.socket_path, self.backend,
+                                    self.weights, self.resource, str(self.input_size),
+                                    str(self.threads_per_worker), str(self.min_confidence)], env=env)
+        with self.lock:
+            self.processes.append(process)
+
+    def _watch(self):
+        # A crashed worker also loses its connection, but a worker that exits before it connected
+        # is only noticed by its process
+        while not self.closing:
+            time.sleep(0.2)
+            with self.lock:
+                exited = [process for process in self.processes if process.poll() is not None]
+                self.processes = [process for process in self.processes if process not in exited]
+            for process in exited:
+                self._worker_exited(process)
+
+    def _worker_exited(self, process):
+        from Adaptation import log
+        with self.lock:
+            if self.closing or self.error is not None:
+                return
+            if process.pid in self.ready_pids:
+                self.ready_pids.discard(process.pid)
+                log(f"InferencePool: worker {process.pid} exited with code {process.returncode}, starting a new one",
+                    "WARNING")
+            else:
+                self.start_failures += 1
+                if self.start_failures >= WORKER_START_ATTEMPTS:
+                    self.error = RuntimeError(f"inference worker exited with code {process.returncode} before its model "
+                                              f"was ready, {self.start_failures} times in a row")
+                    log(f"InferencePool: {self.error}", "ERROR")
+                    # Nobody is going to process the waiting pictures
+                    for _, _, future in self.pending.values():
+                        future.cancel()
+                    self.pending.clear()
+                    return
+                log(f"InferencePool: worker {process.pid} exited with code {process.returncode} before its model "
+                    f"was ready, starting a new one ({self.start_failures}/{WORKER_START_ATTEMPTS})", "WARNING")
+        self._spawn_worker()
+
+    def _connect_host(self):
+        # Connect in the background, the model host may still be starting
+        threading.Thread(target=self._connect_host_loop, name="InferencePool-connect", daemon=True).start()
+
+    def _connect_host_loop(self):
+        while not self.closing:
+            try:
+                connection = Client(self.host, family='AF_UNIX', authkey=self.authkey)
+            except OSError:
+                time.sleep(0.2)
+                continue
+            self._add_connection(connection)
+            return
+
+    def _accept(self):
+        # Workers connect once their model is loaded
+        while not self.closing:
+            try:
+                connection = self.listener.accept()
+                # A worker first sends its process id
+                pid = connection.recv()
+            except (EOFError, OSError):
+                if self.closing:
+                    return
+                continue
+            with self.lock:
+                self.ready_pids.add(pid)
+                self.start_failures = 0
+            self._add_connection(connection)
+
+    def _add_connection(self, connection):
+        with self.lock:
+            if self.ready_at is None:
+                self.ready_at = time.time()
+            self.connections.append(connection)
+            self.idle.append(connection)
+            self._dispatch()
+        threading.Thread(target=self._receive, args=(connection,), name="InferencePool-receive",
+                         daemon=True).start()
+
+    def _receive(self, connection):
+        while True:
+            try:
+                job_id, boxes, error = connection.recv()
+            except (EOFError, OSError):
+                self._worker_lost(connection)
+                return
+            with self.lock:
+                key, tag, future, _ = self.in_flight.pop(job_id)
+                self.busy_keys.discard(key)
+                self.idle.append(connection)
+                if error is None:
+                    self.finished += 1
+                    future.set_result(boxes)
+                    self.completed.append((key, tag, boxes))
+                else:
+                    self.failed += 1
+                    future.set_exception(RuntimeError(error))
+                self._dispatch()
+
+    def _worker_lost(self, connection):
+        with self.lock:
+            if connection in self.idle:
+                self.idle.remove(connection)
+            if connection in self.connections:
+                self.connections.remove(connection)
+            # Fail the picture the worker was processing; the space will simply submit again
+            lost = [job_id for job_id, job in self.in_flight.items() if job[3] is connection]
+            for job_id in lost:
+                key, tag, future, _ = self.in_flight.pop(job_id)
+                self.busy_keys.discard(key)
+                self.failed += 1
+                future.set_exception(RuntimeError("inference worker exited"))
+            closing = self.closing
+        # A lost worker is started again once its process has exited, see _watch()
+        if closing or self.host is None:
+            return
+        from Adaptation import log
+        log("InferencePool: lost the model host, reconnecting", "WARNING")
+        self._connect_host()
+
+    def _dispatch(self):
+        # Called with the lock held: hand waiting pictures to idle workers
+        while self.idle and self.pending and len(self.in_flight) < self.max_in_flight:
+            key = next((k for k in self.pending if k not in self.busy_keys), None)
+            if key is None:
+                return
+            roi, tag, future = self.pending.pop(key)
+            connection = self.idle.popleft()
+            job_id = self.next_job
+            self.next_job += 1
+            future.set_running_or_notify_cancel()
+            self.in_flight[job_id] = (key, tag, future, connection)
+            self.busy_keys.add(key)
+            try:
+                connection.send((job_id, roi))
+            except (OSError, ValueError):
+                # The receiving thread notices the lost worker and fails the job
+                pass
+
+    def submit(self, key, roi, tag=None):
+        """
+        Queues the picture of a space for detection.
+
+        :param key: The space the picture belongs to.
+        :param roi: The picture. It is copied if it is a view into a larger frame.
+        :param tag: Any value returned with the result, e.g. the fingerprint of the picture.
+        :return: A Future with the car boxes, see VehicleDetection.detect_cars().
+        """
+        self.check()
+        future = Future()
+        self.submitted += 1
+        if self.model is not None:
+            future.set_running_or_notify_cancel()
+            boxes = self.model.detect(roi, self.min_confidence)
+            self.finished += 1
+            future.set_result(boxes)
+            self.completed.append((key, tag, boxes))
+            return future
+
+        if roi.base is not None:
+            roi = roi.copy()
+        with self.lock:
+            previous = self.pending.pop(key, None)
+            if previous is not None:
+                self.replaced += 1
+                previous[2].cancel()
+            self.pending[key] = (roi, tag, future)
+            self._dispatch()
+        return future
+
+    def check(self):
+        """
+        Raises the error of a pool whose workers keep exiting before their model is ready.
+        """
+        if self.error is not None:
+            raise self.error
+
+    def busy(self, key):
+        """
+        :return: True if a picture of the space is in flight or waiting.
+        """
+        with self.lock:
+            return key in self.busy_keys or key in self.pending
+
+    def in_flight_for(self, key):
+        """
+        :return: True if a worker is processing a picture of the space. A waiting picture does not
+                 count, so it can still be replaced by a newer one.
+        """
+        with self.lock:
+            return key in self.busy_keys
+
+    def results(self):
+        """
+        :return: The (key, tag, boxes) results that finished since the last call.
+        """
+        results = []
+        while self.completed:
+            results.append(self.completed.popleft())
+        return results
+
+    def stats(self):
+        with self.lock:
+            return {"workers": len(self.connections) if self.model is None else 0,
+                    "in_flight": len(self.in_flight), "pending": len(self.pending),
+                    "submitted": self.submitted, "finished": self.finished,
+                    "replaced": self.replaced, "failed": self.failed}
+
+    def close(self):
+        self.closing = True
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections.clear()
+        if self.listener is None:
+            return
+        self.listener.close()
+        for process in self.processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        os.rmdir(os.path.dirname(self.socket_path))
+
+def worker_main(address, backend, weights, resource, input_size, threads, min_confidence):
+    """
+    Worker process: loads its own model, then answers detection requests until the pool closes.
+    """
+    if backend == "torch":
+        import torch
+        torch.set_num_threads(threads)
+    model = load_backend(backend, weights, resource, input_size, threads)
+    # The first inference is much slower than the next ones, pay it before taking requests
+    model.detect(np.zeros((64, 64, 3), dtype=np.uint8), min_confidence)
+    connection = Client(address, family='AF_UNIX', authkey=bytes.fromhex(os.environ[AUTHKEY_VARIABLE]))
+    connection.send(os.getpid())
+
+    while True:
+        try:
+            job_id, roi = connection.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            connection.send((job_id, model.detect(roi, min_confidence), None))
+        except Exception as e:
+            connection.send((job_id, None, f"{type(e).__name__}: {e}"))
+
+if __name__ == "__main__":
+    worker_main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], int(sys.argv[5]), int(sys.argv[6]),
+                float(sys.argv[7]))
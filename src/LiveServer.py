@@ -0,0 +1,453 @@
+'''
+
+        +----------------------------+
+        |       LiveServer.py        |
+        +----------------------------+
+
+This script serves the web pages and pushes the live status of every space to the browsers, so
+the pages do not poll PHP scripts and the detector does not render the graph every 2 seconds.
+The watch dog starts it once when <live-server> is enabled:
+
+    python src/LiveServer.py [configuration file]
+
+Detectors and the watch dog send small JSON events to the <live-server-socket> (a Unix datagram
+socket, see LivePublisher). Sending never blocks, events are dropped while the server is down.
+The server keeps the latest status and the smoothed samples of the current session of every
+space and answers:
+
+    GET /api/status                         the status of every space, from the status record
+                                            (StatusRecord.py)
+    GET /api/events                         Server-Sent Events: "status" on every change and
+                                            "point" for every new sample
+    GET /api/history?space=&start=&end=&points=
+                                            car present ratio of the history store and the
+                                            current session, in at most <points> time buckets
+    GET /api/gallery?page=&per_page=&start=&end=&space=
+                                            one page of the gallery manifest, see GalleryIndex.py
+    DELETE /api/gallery/<file>              delete a snapshot of the gallery, only from this
+                                            host or with the <live-server-token> in the
+                                            X-Parkit-Token header
+    GET /api/rollup?space=&start=&end=&weekday=
+                                            best time to park and occupied fraction per day of
+                                            the week and hour, from the rollups (RollupStore.py)
+    GET /<file>                             the pages, styles, scripts, pictures and CSV files
+                                            of the web pages (src/appsrc), see STATIC_TYPES
+
+Times are epoch seconds of the local wall clock, like the history store. start and end also take
+"YYYY-MM-DD HH:MM:SS". The history covers the current session, or the last day, by default.
+
+The server listens on <live-server-host>, 127.0.0.1 by default, so only this computer sees the
+pages. Set it to 0.0.0.0 to serve the network.
+
+'''
+
+import asyncio
+import calendar
+import hmac
+import ipaddress
+import json
+import mimetypes
+import os
+import socket
+import sys
+import time
+from array import array
+from datetime import datetime
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import numpy as np
+
+from Adaptation import configure_logger, get_config, get_space_definitions, get_value_from_tag, log, space_file_path
+from GalleryIndex import GalleryIndex
+from HistoryStore import CAR_BIT, HistoryStore
+from RollupStore import WEEKDAYS, RollupStore
+from StatusRecord import StatusRecord, status_record_location
+from ParkitAnalytics import OccupancyAnalytics
+
+# Queued events of one browser, a browser that falls further behind is disconnected
+CLIENT_QUEUE = 256
+KEEPALIVE_SECONDS = 15
+# Files of the web root that are served, the PHP scripts and data files are not
+STATIC_TYPES = {".html", ".css", ".js", ".png", ".jpg", ".jpeg", ".gif", ".svg", ".ico", ".csv"}
+
+def wall_clock_seconds(value):
+    """
+    :param value: A naive datetime or "YYYY-MM-DD HH:MM:SS".
+    :return: Epoch seconds of the local wall clock time.
+    """
+    if isinstance(value, str):
+        value = datetime.strptime(value.strip(), '%Y-%m-%d %H:%M:%S')
+    return calendar.timegm(value.timetuple())
+
+class LivePublisher:
+    """
+    Sends events to the live server without ever waiting for it.
+
+    :param address: The socket of the live server, None to publish nothing.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.socket = None
+        self.dropped = 0
+        if address:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.socket.setblocking(False)
+
+    def publish(self, kind, space, **fields):
+        if self.socket is None:
+            return
+        message = json.dumps({"type": kind, "space": space or "", **fields}).encode()
+        try:
+            self.socket.sendto(message, self.address)
+        except OSError:
+            # No server yet, or its buffer is full
+            self.dropped += 1
+
+def downsample(times, values, start, end, points):
+    """
+    Averages the values in equal time buckets.
+
+    :param times: Epoch seconds of the samples, int64.
+    :param values: The value of every sample.
+    :param points: Maximum number of buckets.
+    :return: The bucket width in seconds and [start of the bucket, mean] of every non-empty bucket.
+    """
+    step = max(1, -(-(end - start) // max(1, points)))
+    if len(times) == 0:
+        return step, []
+    slots = (times - start) // step
+    counts = np.bincount(slots)
+    sums = np.bincount(slots, weights=values)
+    used = np.flatnonzero(counts)
+    return step, [[int(start + slot * step), round(float(sums[slot] / counts[slot]), 3)] for slot in used]
+
+class SpaceFeed:
+    """
+    Latest status and the samples of the current session of one space.
+    """
+
+    def __init__(self, name, files):
+        self.name = name
+        self.files = files
+        self.data = None
+        self.streak = None
+        self.optimal = None
+        # Smoothed car status of the session, the samples of the graph
+        self.times = array('q')
+        self.cars = array('B')
+
+    def read_record(self, record):
+        # The values of the last write of the status record, see StatusRecord.py
+        status = record.read(self.name) if record is not None else None
+        if status is None or not status["updated"]:
+            return False
+        self.data, self.streak, self.optimal = status["data"], status["streak"], status["optimal"]
+        return True
+
+    def read_files(self, record=None):
+        # The status the detector wrote before this server (re)started, the text files are only
+        # read without a status record
+        if not self.read_record(record):
+            for attribute in ("data", "streak", "optimal"):
+                path = self.files[attribute]
+                if os.path.exists(path):
+                    with open(path, "r") as file:
+                        setattr(self, attribute, file.read().strip())
+        if os.path.exists(self.files["csv"]):
+            analytics = OccupancyAnalytics()
+            analytics.bootstrap(self.files["csv"])
+            for status_car, sample_time, *_ in analytics.read_csv():
+                self.add_point(wall_clock_seconds(sample_time), status_car)
+
+    def add_point(self, seconds, car):
+        # Samples the server already read from the session file arrive again after a restart
+        if self.times and seconds <= self.times[-1]:
+            return False
+        self.times.append(seconds)
+        self.cars.append(1 if car else 0)
+        return True
+
+    def snapshot(self):
+        # Same fields as scripts/get_latest_data.php
+        fields = self.optimal.split(",") if self.optimal else []
+        fields += ["NULL"] * (3 - len(fields))
+        return {"space": self.name,
+                "data": self.data if self.data is not None else "N/A - N/A",
+                "sysstatus": "Online" if self.data is not None else "Offline",
+                "streak": self.streak if self.streak else "N/A",
+                "occupiedPercentage": fields[0],
+                "unoccupiedPercentage": fields[1],
+                "optimalTime": fields[2],
+                "started": time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self.times[0])) if self.times else None}
+
+class EventProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, address):
+        try:
+            event = json.loads(data)
+        except ValueError:
+            log("Live server: dropped a malformed event", "WARNING")
+            return
+        self.server.handle_event(event)
+
+class LiveServer:
+    """
+    :param feeds: One SpaceFeed per space, in the order of the configuration.
+    :param history: The HistoryStore of the previous sessions.
+    :param web_root: Directory of the web pages.
+    :param gallery: The GalleryIndex of the graph gallery, below the web root.
+    :param rollups: The RollupStore of the history, updated by the watch dog.
+    :param status_record: The StatusRecord of the detectors, or None.
+    :param token: Token that allows other hosts to delete snapshots of the gallery, "" for none.
+    """
+
+    def __init__(self, feeds, history, web_root, gallery, rollups, status_record=None, token=""):
+        self.feeds = {feed.name: feed for feed in feeds}
+        self.token = token
+        self.history = history
+        self.rollups = rollups
+        self.status_record = status_record
+        self.web_root = os.path.abspath(web_root)
+        self.gallery = gallery
+        self.gallery_url = os.path.relpath(os.path.abspath(gallery.directory), self.web_root).replace(os.sep, "/")
+        self.clients = set()
+
+    def handle_event(self, event):
+        feed = self.feeds.get(event.get("space", ""))
+        if feed is None:
+            return
+        kind = event.get("type")
+        if kind == "status":
+            feed.data = event.get("data")
+            if feed.data is None:
+                # The watch dog removed the status files of a stopped detector
+                feed.streak = None
+            self.broadcast("status", feed.snapshot())
+        elif kind == "analytics":
+            feed.streak = event.get("streak", feed.streak)
+            feed.optimal = event.get("optimal", feed.optimal)
+            self.broadcast("status", feed.snapshot())
+        elif kind == "point":
+            seconds = wall_clock_seconds(event["time"])
+            if feed.add_point(seconds, event.get("car")):
+                self.broadcast("point", {"space": feed.name, "time": seconds, "car": 1 if event.get("car") else 0})
+
+    def broadcast(self, kind, payload):
+        message = f"event: {kind}\ndata: {json.dumps(payload)}\n\n".encode()
+        for queue in list(self.clients):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # A slow browser only gets a closed connection and reconnects
+                self.clients.discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    def history_points(self, query):
+        name = query.get("space", [next(iter(self.feeds))])[0]
+        feed = self.feeds.get(name)
+        if feed is None:
+            return 404, {"error": f"Unknown space '{name}'"}
+        now = wall_clock_seconds(datetime.now())
+        end = self._time(query, "end", now)
+        start = self._time(query, "start", feed.times[0] if feed.times else end - 86400)
+        points = min(int(query.get("points", ["500"])[0]), 5000)
+
+        past = self.history.query(name, np.datetime64(start, "s"), np.datetime64(end, "s"))
+        order = np.argsort(past.time, kind="stable")
+        times = [past.time[order].view(np.int64)]
+        cars = [((past.status[order] & CAR_BIT) > 0).astype(np.uint8)]
+        session_times = np.frombuffer(feed.times, dtype=np.int64) if feed.times else np.empty(0, np.int64)
+        session_cars = np.frombuffer(feed.cars, dtype=np.uint8) if feed.cars else np.empty(0, np.uint8)
+        selected = (session_times >= start) & (session_times < end)
+        times.append(session_times[selected])
+        cars.append(session_cars[selected])
+
+        step, buckets = downsample(np.concatenate(times), np.concatenate(cars), start, end, points)
+        return 200, {"space": name, "start": start, "end": end, "step": step, "points": buckets}
+
+    def gallery_page(self, query):
+        listing = self.gallery.page(int(query.get("page", ["1"])[0]), int(query.get("per_page", ["12"])[0]),
+                                    query.get("start", [None])[0], query.get("end", [None])[0],
+                                    query.get("space", [None])[0])
+        for item in listing["items"]:
+            item["url"] = f"{self.gallery_url}/{item['file']}"
+            item["thumbnail_url"] = f"{self.gallery_url}/{item['thumbnail']}" if item["thumbnail"] else item["url"]
+        return listing
+
+    def rollup_summary(self, query):
+        name = query.get("space", [next(iter(self.feeds))])[0]
+        if name not in self.feeds:
+            return 404, {"error": f"Unknown space '{name}'"}
+        start = query.get("start", [None])[0]
+        end = query.get("end", [None])[0]
+        weekdays = [int(day) for day in query["weekday"]] if "weekday" in query else None
+        occupied, vacant, best_time = self.rollups.best_time(name, start, end, weekdays).split(",")
+        profile = self.rollups.weekday_profile(name, start, end)
+        return 200, {"space": name, "occupied": float(occupied), "vacant": float(vacant), "best_time": best_time,
+                     "weekdays": WEEKDAYS,
+                     "profile": [[None if np.isnan(value) else round(float(value), 4) for value in hours] for hours in profile]}
+
+    def may_change(self, writer, headers):
+        """
+        :return: True if the request may change files: it comes from this host or has the token.
+        """
+        token = headers.get("x-parkit-token", "")
+        if self.token and hmac.compare_digest(token.encode(), self.token.encode()):
+            return True
+        peer = writer.get_extra_info("peername")
+        if not peer:
+            # A Unix socket
+            return True
+        address = ipaddress.ip_address(peer[0].split("%")[0])
+        return address.is_loopback or (address.version == 6 and address.ipv4_mapped is not None and address.ipv4_mapped.is_loopback)
+
+    @staticmethod
+    def _time(query, key, default):
+        if key not in query:
+            return int(default)
+        value = query[key][0]
+        return int(value) if value.isdigit() else wall_clock_seconds(value.replace("T", " "))
+
+    async def handle_client(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+            lines = request.decode("latin-1").split("\r\n")
+            method, target = lines[0].split(" ")[:2]
+            headers = {name.strip().lower(): value.strip() for name, _, value in
+                       (line.partition(":") for line in lines[1:] if ":" in line)}
+            url = urlsplit(target)
+            query = parse_qs(url.query)
+            if method == "DELETE" and url.path.startswith("/api/gallery/") and not self.may_change(writer, headers):
+                await self._respond(writer, 403, {"error": "Deleting is only allowed from this host or with the token"})
+            elif method == "DELETE" and url.path.startswith("/api/gallery/"):
+                loop = asyncio.get_running_loop()
+                removed = await loop.run_in_executor(None, self.gallery.remove, unquote(url.path[len("/api/gallery/"):]))
+                await self._respond(writer, 200 if removed else 404, {"success": True} if removed else {"error": "File does not exist"})
+            elif method != "GET":
+                await self._respond(writer, 405, {"error": "Only GET is supported"})
+            elif url.path == "/api/events":
+                await self._stream(writer)
+            elif url.path == "/api/status":
+                for feed in self.feeds.values():
+                    feed.read_record(self.status_record)
+                await self._respond(writer, 200, {"spaces": [feed.snapshot() for feed in self.feeds.values()]})
+            elif url.path in ("/api/gallery", "/api/history", "/api/rollup"):
+                try:
+                    if url.path == "/api/gallery":
+                        status, body = 200, self.gallery_page(query)
+                    elif url.path == "/api/history":
+                        status, body = self.history_points(query)
+                    else:
+                        status, body = self.rollup_summary(query)
+                except ValueError as e:
+                    status, body = 400, {"error": str(e)}
+                await self._respond(writer, status, body)
+            else:
+                await self._static(writer, unquote(url.path))
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        reason = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed"}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def _static(self, writer, path):
+        if path == "/":
+            path = "/dataAnalytics.html"
+        file_path = os.path.abspath(os.path.join(self.web_root, path.lstrip("/")))
+        # Only the web files below the web root, no hidden files
+        relative = os.path.relpath(file_path, self.web_root)
+        if (not file_path.startswith(self.web_root + os.sep) or os.path.splitext(file_path)[1].lower() not in STATIC_TYPES
+                or any(part.startswith(".") for part in relative.split(os.sep)) or not os.path.isfile(file_path)):
+            await self._respond(writer, 404, {"error": "Not found"})
+            return
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(None, lambda: open(file_path, "rb").read())
+        await self._respond(writer, 200, body, mimetypes.guess_type(file_path)[0] or "application/octet-stream")
+
+    async def _stream(self, writer):
+        queue = asyncio.Queue(CLIENT_QUEUE)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: keep-alive\r\n\r\n")
+        # A new browser starts with the current status of every space
+        for feed in self.feeds.values():
+            writer.write(f"event: status\ndata: {json.dumps(feed.snapshot())}\n\n".encode())
+        await writer.drain()
+        self.clients.add(queue)
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    message = b": keepalive\n\n"
+                if message is None:
+                    break
+                writer.write(message)
+                await writer.drain()
+        finally:
+            self.clients.discard(queue)
+
+async def serve(server, event_socket, host, port):
+    loop = asyncio.get_running_loop()
+    await loop.create_datagram_endpoint(lambda: EventProtocol(server), sock=event_socket)
+    http = await asyncio.start_server(server.handle_client, host, port)
+    log(f"Live server: listening on http://{host}:{port} for {len(server.feeds)} space(s)")
+    async with http:
+        await http.serve_forever()
+
+def main(config_path):
+    config = get_config(config_path)
+    configure_logger(config.get("log-file-location", default="src/data/parkit.log"), config.get("log-level", default="INFO"))
+    address = config.get("live-server-socket", default="src/data/parkit-live.sock")
+
+    # Bind first: events sent while the session files are read wait in the socket
+    if os.path.exists(address):
+        os.remove(address)
+    event_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    event_socket.bind(address)
+    event_socket.setblocking(False)
+
+    # Created by the watch dog before it starts this server
+    status_record = None
+    record_location = status_record_location(config)
+    if os.path.exists(record_location):
+        try:
+            status_record = StatusRecord(record_location)
+        except ValueError as e:
+            log(f"Live server: {e}", "WARNING")
+
+    feeds = []
+    for definition in get_space_definitions(config_path):
+        name = definition["name"]
+        feed = SpaceFeed(name or "", {
+            "data": space_file_path(get_value_from_tag(config_path, "system-output-location"), name),
+            "streak": space_file_path(get_value_from_tag(config_path, "streak-file-location"), name),
+            "optimal": space_file_path(get_value_from_tag(config_path, "optimal-file-location"), name),
+            "csv": space_file_path(get_value_from_tag(config_path, "csv-file-location"), name)})
+        feed.read_files(status_record)
+        feeds.append(feed)
+    history = HistoryStore(get_value_from_tag(config_path, "history-location"))
+    server = LiveServer(feeds, history, config.get("live-server-root", default="src/appsrc"),
+                        GalleryIndex(get_value_from_tag(config_path, "gallery-location")), RollupStore(history), status_record,
+                        config.get("live-server-token", default=""))
+    try:
+        asyncio.run(serve(server, event_socket, config.get("live-server-host", default="127.0.0.1"),
+                          config.get("live-server-port", int, 8080)))
+    finally:
+        event_socket.close()
+        if os.path.exists(address):
+            os.remove(address)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1] if len(sys.argv) > 1 else "src/ParkitConfiguration.xml"))
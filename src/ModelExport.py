@@ -0,0 +1,185 @@
+'''
+
+        +----------------------------+
+        |       ModelExport.py       |
+        +----------------------------+
+
+This script converts the configured YOLOv5 weights for the onnx and opencv inference backends and
+checks that the converted models find the same cars as the original one:
+
+    python src/ModelExport.py --size 320 --quantize
+    python src/ModelExport.py --check clips/day.mp4 crops/
+
+The export writes the <exported-model> (an ONNX file with a fixed input size) and a JSON file with
+the class names next to it. --quantize also writes an int8 version (<name>-int8.onnx) with
+dynamic quantization of ONNX Runtime, which only the onnx backend can run.
+
+--check runs every available backend on sample pictures: image files, directories of images, or
+videos whose configured spaces are cut out about once per second. The torch backend is the
+reference. For every other backend the report shows how often it agrees on whether a car is
+present, how many reference boxes it finds again (IoU >= 0.5) and its time per picture. The
+script fails if a backend agrees on less than --min-agreement of the pictures.
+
+'''
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from Adaptation import get_config, get_inference_model, get_space_definitions
+from FrameGrabber import IMAGE_EXTENSIONS, open_source
+from InferenceBackend import load_backend, names_path
+from VehicleDetection import space_overlap
+
+def quantized_path(model_path):
+    stem, extension = os.path.splitext(model_path)
+    return f"{stem}-int8{extension}"
+
+def export(weights, output, size):
+    """
+    Exports the weights to an ONNX model with a fixed input size.
+    """
+    from yolov5 import YOLOv5
+    from yolov5.export import run
+
+    exported = [str(path) for path in run(weights=weights, imgsz=(size, size), include=("onnx",), device="cpu")]
+    exported = next(path for path in exported if path.endswith(".onnx"))
+    if os.path.abspath(exported) != os.path.abspath(output):
+        shutil.move(exported, output)
+
+    names = YOLOv5(weights, device="cpu").model.names
+    names = names if isinstance(names, dict) else dict(enumerate(names))
+    with open(names_path(output), "w") as file:
+        json.dump({"names": {str(key): value for key, value in names.items()}, "input_size": size}, file, indent=2)
+    print(f"Exported {weights} to {output} ({size}x{size})")
+
+def quantize(model_path):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    output = quantized_path(model_path)
+    quantize_dynamic(model_path, output, weight_type=QuantType.QUInt8)
+    shutil.copy(names_path(model_path), names_path(output))
+    print(f"Quantized {model_path} to {output}")
+
+def sample_crops(sources, config_path, limit):
+    """
+    :return: Up to limit pictures from image files, image directories and videos.
+    """
+    rects = [[space["x"], space["y"], space["width"], space["height"]] for space in get_space_definitions(config_path)]
+    crops = []
+    for source in sources:
+        if os.path.isdir(source) or source.lower().endswith(IMAGE_EXTENSIONS):
+            paths = [source] if os.path.isfile(source) else sorted(
+                os.path.join(source, name) for name in os.listdir(source) if name.lower().endswith(IMAGE_EXTENSIONS))
+            crops.extend(image for image in map(cv2.imread, paths) if image is not None)
+            continue
+        cap = open_source(source, "fast")
+        step = max(1, int(round(cap.get(cv2.CAP_PROP_FPS) or 1)))
+        position = 0
+        while len(crops) < limit:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if position % step == 0:
+                crops.extend(frame[y:y+h, x:x+w].copy() for x, y, w, h in rects)
+            position += 1
+        cap.release()
+    return crops[:limit]
+
+def matched_boxes(reference, boxes, threshold=0.5):
+    # Reference boxes with a box of the other backend that overlaps it enough
+    matched = 0
+    for box in reference:
+        rect = [box['xmin'], box['ymin'], box['xmax'] - box['xmin'], box['ymax'] - box['ymin']]
+        iou, _ = space_overlap(boxes, rect)
+        if len(iou) and iou.max() >= threshold:
+            matched += 1
+    return matched
+
+def run_backend(backend, crops, min_confidence):
+    backend.detect(crops[0], min_confidence)
+    results = []
+    started = time.perf_counter()
+    for crop in crops:
+        results.append(backend.detect(crop, min_confidence))
+    return results, (time.perf_counter() - started) / len(crops)
+
+def check(config_path, sources, size, limit, min_confidence):
+    """
+    :return: One report per backend, the first one is the torch reference.
+    """
+    model = get_inference_model(config_path)
+    config = get_config(config_path)
+    exported = config.get("exported-model", default="yolov5/yolov5s.onnx")
+    crops = sample_crops(sources, config_path, limit)
+    if not crops:
+        print("No sample pictures found.")
+        return []
+
+    # The float export and its int8 version, whichever of them is configured
+    base = exported[:-len("-int8.onnx")] + ".onnx" if exported.endswith("-int8.onnx") else exported
+    candidates = [("torch", config.get("weights")), ("onnx", base), ("opencv", base), ("onnx", quantized_path(base))]
+    candidates = [(name, path) for name, path in candidates if name == "torch" or os.path.exists(path)]
+
+    reports = []
+    reference = None
+    for name, path in candidates:
+        try:
+            backend = load_backend(name, path, model["device"], size)
+        except Exception as e:
+            print(f"{name} ({path}): not available, {type(e).__name__}: {e}")
+            continue
+        results, seconds = run_backend(backend, crops, min_confidence)
+        report = {"backend": name, "model": path, "input_size": backend.input_size, "pictures": len(crops),
+                  "ms_per_picture": round(seconds * 1000, 2)}
+        if reference is None:
+            reference = (results, seconds)
+        else:
+            reference_results, reference_seconds = reference
+            total = sum(len(boxes) for boxes in reference_results)
+            report["presence_agreement"] = round(np.mean([(len(a) > 0) == (len(b) > 0)
+                                                          for a, b in zip(reference_results, results)]), 4)
+            report["box_recall"] = round(sum(matched_boxes(a, b) for a, b in zip(reference_results, results)) / total, 4) if total else None
+            report["speedup"] = round(reference_seconds / seconds, 2) if seconds > 0 else None
+        reports.append(report)
+        print(", ".join(f"{key}={value}" for key, value in report.items()))
+    return reports
+
+def main():
+    parser = argparse.ArgumentParser(description="Park It! model export")
+    parser.add_argument("--config", default="src/ParkitConfiguration.xml", help="configuration to read the model settings from")
+    parser.add_argument("--size", type=int, help="input size of the export (default: the input-size setting or 640)")
+    parser.add_argument("--output", help="the exported model (default: the exported-model setting)")
+    parser.add_argument("--quantize", action="store_true", help="also write an int8-quantized model")
+    parser.add_argument("--check", nargs="+", metavar="SAMPLE", help="only compare the backends on these images, directories or videos")
+    parser.add_argument("--pictures", type=int, default=200, help="number of sample pictures to compare")
+    parser.add_argument("--min-agreement", type=float, default=0.95, help="required car present agreement with torch")
+    parser.add_argument("--report", help="write the comparison as JSON to this file")
+    args = parser.parse_args()
+
+    config = get_config(args.config)
+    size = args.size or config.get("input-size", int, 0) or 640
+    if args.check:
+        reports = check(args.config, args.check, size, args.pictures, 0.0)
+        if args.report:
+            with open(args.report, "w") as file:
+                json.dump({"created": time.strftime("%Y-%m-%d %H:%M:%S"), "runs": reports}, file, indent=2)
+        failed = [report for report in reports if report.get("presence_agreement", 1.0) < args.min_agreement]
+        for report in failed:
+            print(f"Parity: {report['backend']} ({report['model']}) agrees on {report['presence_agreement']:.1%} of the pictures")
+        return 1 if failed or not reports else 0
+
+    output = args.output or config.get("exported-model", default="yolov5/yolov5s.onnx")
+    export(config.get("weights"), output, size)
+    if args.quantize:
+        quantize(output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
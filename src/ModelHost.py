@@ -0,0 +1,92 @@
+'''
+
+        +----------------------------+
+        |        ModelHost.py        |
+        +----------------------------+
+
+This script keeps the YOLOv5 models loaded while detectors crash and restart. The watch dog starts
+it once, before the detectors:
+
+    python src/ModelHost.py <socket> <backend> <model> <device> <input-size> <workers> <min-confidence> <load-timeout>
+
+The host runs an InferencePool whose workers load the model and warm up with a dummy inference
+once, then it opens its socket. If the workers keep exiting while they load the model, or are not
+ready after <load-timeout> seconds, the host exits with code 1, so the watch dog reports it. Detectors started with --model-host open one connection per
+worker to the socket and send the pictures of their spaces with the same messages a pool worker
+understands, so a restarted detector only has to open its cameras again.
+
+The socket is protected with the key in the PARKIT_MODEL_HOST_KEY environment variable, which the
+watch dog creates and passes to the host and to every detector.
+
+'''
+
+import os
+import sys
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+
+from Adaptation import log
+from InferencePool import HOST_AUTHKEY_VARIABLE, InferencePool
+
+def serve(connection, pool):
+    """
+    Answers the requests of one detector connection until the detector closes it.
+    """
+    # Every connection has at most one picture in flight, so it is its own key in the pool
+    key = id(connection)
+    while True:
+        try:
+            job_id, roi = connection.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            reply = (job_id, pool.submit(key, roi).result(), None)
+        except Exception as e:
+            reply = (job_id, None, f"{type(e).__name__}: {e}")
+        try:
+            connection.send(reply)
+        except (OSError, ValueError):
+            break
+    connection.close()
+
+def host_main(address, backend, model, resource, input_size, workers, min_confidence, load_timeout):
+    started = time.time()
+    pool = InferencePool(model, resource, max(1, workers or os.cpu_count() or 1), min_confidence=min_confidence,
+                         backend=backend, input_size=input_size).start()
+
+    # Detectors keep retrying to connect, so they only find the host once every model is warm
+    try:
+        while pool.stats()["workers"] < pool.workers:
+            pool.check()
+            if time.time() - started > load_timeout:
+                raise TimeoutError(f"{pool.stats()['workers']} of {pool.workers} worker(s) ready after {load_timeout:.0f}s")
+            time.sleep(0.1)
+    except (RuntimeError, TimeoutError) as e:
+        log(f"Model host: could not load the {backend} model {model}: {e}", "ERROR")
+        pool.close()
+        return 1
+
+    # A host that crashed leaves its socket behind
+    if os.path.exists(address):
+        os.remove(address)
+    listener = Listener(address, family='AF_UNIX', authkey=bytes.fromhex(os.environ[HOST_AUTHKEY_VARIABLE]))
+    log(f"Model host: {pool.workers} {backend} worker(s) ready after {time.time() - started:.2f}s, listening on {address}")
+
+    try:
+        while True:
+            try:
+                connection = listener.accept()
+            except AuthenticationError:
+                log("Model host: rejected a connection with a wrong key", "WARNING")
+                continue
+            threading.Thread(target=serve, args=(connection, pool), name="ModelHost-serve", daemon=True).start()
+    finally:
+        listener.close()
+        pool.close()
+
+if __name__ == "__main__":
+    workers = sys.argv[6]
+    sys.exit(host_main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], int(sys.argv[5]),
+                       None if workers == "auto" else int(workers), float(sys.argv[7]), float(sys.argv[8])))
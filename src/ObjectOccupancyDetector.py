@@ -21,109 +21,331 @@ This Python program contains all application "Park It!" system components:
 '''
 
 from datetime import datetime
+import argparse
+import os
 import cv2
 import time
 import numpy as np
-from yolov5 import YOLOv5
 
 # Custom libraries
-from Adaptation import get_value_from_tag, update_xml_tag_value, log, write_text_to_file, append_text_to_file
-
-from CSVConvertGraphs import parse_datetime, plot_and_save_graph, read_csv, find_longest_streak, find_best_time_to_park_and_analytics
+from Adaptation import configure_logger, get_config, get_value_from_tag, get_camera_definitions, get_inference_model, get_space_definitions, update_space_value, space_file_path, log, append_text_to_file
+
+from CSVConvertGraphs import parse_datetime, GraphRenderer
+from ParkitAnalytics import SAMPLE_DTYPE, OccupancyAnalytics
+from HistoryStore import HistoryStore
+from RollupStore import RollupStore
+from EventLog import EventRecorder
+from SpaceOccupancy import ParkingSpace, SpaceOccupancyEngine
+from FrameGrabber import FrameGrabber, RateLimiter, SamplingScheduler, is_recording, open_source
+from FrameBus import FrameRingReader, ring_path
+from ParkitControl import ControlFile, key_command
+from VehicleDetection import DetectionCache, context_window, shift_boxes, space_overlap
+from InferencePool import InferencePool
+from ParkitMetrics import Metrics, Profiler
+from LiveServer import LivePublisher
+from DetectorCheckpoint import file_position, read_after, read_checkpoint, read_records, save_records, write_checkpoint
+from StatusRecord import StatusPublisher, StatusRecord, status_record_location
+
+# Start of this process, the time until the first status is logged after every (re)start
+process_started = time.time()
+first_status_at = None
+inference_ready_logged = False
+
+# Command line - the watch dog starts one analysis worker per group of cameras.
+# Without arguments the detector opens and analyses every configured camera itself.
+parser = argparse.ArgumentParser(description="Park It! occupancy detector")
+parser.add_argument("--cameras", help="comma separated positions of the cameras to analyse (default: all)")
+parser.add_argument("--frame-bus", help="read frames from the frame bus in this directory instead of the cameras")
+parser.add_argument("--model-host", help="send the pictures to the model host on this socket instead of starting inference workers")
+parser.add_argument("--restart", action="store_true", help="the watch dog restarted this worker after a crash")
+parser.add_argument("--config", default="src/ParkitConfiguration.xml", help="the configuration file")
+parser.add_argument("--benchmark", help="write the performance of this run as JSON to this file, see ParkitBenchmark.py")
+args = parser.parse_args()
 
 # System Configuration File
-sys_config = "src/ParkitConfiguration.xml"
+sys_config = args.config
+config = get_config(sys_config)
+configure_logger(config.get("log-file-location", default="src/data/parkit.log"), config.get("log-level", default="INFO"))
+
+# Data - input and save locations, one entry per <camera>
+camera_definitions = get_camera_definitions(sys_config)
+all_cameras = len(camera_definitions)
+if args.cameras:
+    wanted = [int(index) for index in args.cameras.split(",")]
+    camera_definitions = [camera for camera in camera_definitions if camera["index"] in wanted]
+camera_indexes = [camera["index"] for camera in camera_definitions]
 
 # Read all configuration data by parsing XML file...
-# Space Dimensions & Properties
-rectx     = int(get_value_from_tag(sys_config, "space-x"))
-recty     = int(get_value_from_tag(sys_config, "space-y"))
-rectw     = int(get_value_from_tag(sys_config, "space-width"))
-recth     = int(get_value_from_tag(sys_config, "space-height"))
-move_dist = int(get_value_from_tag(sys_config, "move-dist"))
-log(f"Space Dimensions: x={rectx}, y={recty}, width={rectw}, height={recth}, move-dist={move_dist}")
+# Space Dimensions & Properties, one entry per <space-definition> watched by our cameras
+space_definitions = get_space_definitions(sys_config)
+all_space_names = [definition["name"] for definition in space_definitions]
+for position, definition in enumerate(space_definitions):
+    definition["index"] = position
+space_definitions = [definition for definition in space_definitions if definition["camera"] in camera_indexes]
+for definition in space_definitions:
+    log(f"Space Dimensions: name={definition['name']}, camera={definition['camera']}, x={definition['x']}, y={definition['y']}, "
+        f"width={definition['width']}, height={definition['height']}, move-dist={definition['move-dist']}")
 
 # YOLOv5 data
-weights   = get_value_from_tag(sys_config, "weights")
-resource  = get_value_from_tag(sys_config, "resource")
-log(f"YOLOv5: weights={weights}, device={resource}")
-
-# Timers - used to track how long the space has been occupied
-occupied_timer     = int(get_value_from_tag(sys_config, "occupied-timer"))
-occupied_start_time = None
-
-# Data - input and save locations
-camera = int(get_value_from_tag(sys_config, "camera"))
-
-
-# Variables and objects used in application...
-# Rectangle parameters: [x, y, width, height]
-# This is the rectangle box used for determining occupancy on a parking space
-rect = [rectx, recty, rectw, recth]
-
-# Load a pre-trained YOLOv5 model on the application server CPU
-yolov5_model = YOLOv5(weights, device=resource)  
+inference_model = get_inference_model(sys_config)
+log(f"YOLOv5: backend={inference_model['backend']}, model={inference_model['model']}, "
+    f"device={inference_model['device']}, input-size={inference_model['input_size']}")
+
+# Detection cache - a parked car is not re-detected until its space changes or the result expires
+detection_cache = DetectionCache(config.get("cache-threshold", float, 8.0), config.get("cache-max-age", float, 30.0))
+log(f"Detection cache: threshold={detection_cache.threshold}, max-age={detection_cache.max_age}")
+
+# Server settings - headless mode skips all drawing and GUI calls, commands come from the control file
+headless     = config.get("headless", default="false").lower() == "true"
+target_fps   = config.get("target-fps", float, 0.0)
+control_file = ControlFile(config.get("control-file", default="src/data/parkit-control.txt"))
+log(f"Server: headless={headless}, target-fps={target_fps}, control-file={control_file.file_path}")
+
+# Sampling - a camera whose spaces did not change for steady-after seconds is only checked
+# steady-check-fps times per second. A space asks YOLOv5 at most once per inference-interval.
+steady_check_fps   = config.get("steady-check-fps", float, 2.0)
+steady_after       = config.get("steady-after", float, 10.0)
+inference_interval = config.get("inference-interval", float, 1.0)
+log(f"Sampling: steady-check-fps={steady_check_fps}, steady-after={steady_after}, inference-interval={inference_interval}")
+
+# Load the pre-trained YOLOv5 model in a pool of worker processes on the application server CPU.
+# "auto" starts one worker per core, 0 runs the model inside this process. With the model host of
+# the watch dog the models are already loaded and the pool only connects to it.
+inference_workers = config.get("inference-workers", default="auto")
+min_confidence    = config.get("min-confidence", float, 0.0)
+# A car only counts if at least min-space-coverage of its box lies inside the space. The model then
+# sees the space padded by detection-margin on every side, so cars of the neighbouring spaces are
+# found as such instead of being cut off at the edge of the space.
+min_coverage      = config.get("min-space-coverage", float, 0.0)
+detection_margin  = config.get("detection-margin", float, 0.5) if min_coverage > 0 else 0.0
+inference = InferencePool(inference_model["model"], inference_model["device"],
+                          None if inference_workers == "auto" else int(inference_workers),
+                          min_confidence=min_confidence, host=args.model_host,
+                          backend=inference_model["backend"], input_size=inference_model["input_size"]).start()
+log(f"Inference pool: workers={inference.workers}, max-in-flight={inference.max_in_flight}, "
+    f"min-confidence={min_confidence}, min-space-coverage={min_coverage}, detection-margin={detection_margin}, "
+    f"model-host={args.model_host}")
+
+# Instrumentation of the main loop. A worker that analyses only some of the cameras writes its own files.
+worker_suffix = None if len(camera_definitions) == all_cameras else "cameras-" + "-".join(map(str, camera_indexes))
+prometheus_location = config.get("metrics-prometheus-location", default="")
+metrics = Metrics(config.get("metrics", default="false").lower() == "true",
+                  space_file_path(config.get("metrics-file-location", default="src/appsrc/metrics.json"), worker_suffix),
+                  space_file_path(prometheus_location, worker_suffix) if prometheus_location else None,
+                  config.get("metrics-interval", float, 5.0))
+profiler = Profiler(space_file_path(config.get("profile-location", default="src/data/parkit-profile"), worker_suffix))
+log(f"Metrics: enabled={metrics.enabled}, file={metrics.file_path}, prometheus={metrics.prometheus_path}")
+
+# Live server - status changes and new samples are pushed to the browsers, the graph PNG is only
+# rendered every graph-snapshot-interval seconds for the gallery
+live_server    = config.get("live-server", default="false").lower() == "true"
+live           = LivePublisher(config.get("live-server-socket", default="src/data/parkit-live.sock") if live_server else None)
+graph_interval = config.get("graph-snapshot-interval", float, 60.0) if live_server else 0.0
+log(f"Live server: enabled={live_server}, socket={live.address}, graph-snapshot-interval={graph_interval}")
+
+# Status record - the latest status of every space in shared memory, the text files of the older
+# readers are written at most every status-files-interval seconds
+record_location        = status_record_location(config)
+status_files_interval  = config.get("status-files-interval", float, 2.0)
+status_record          = StatusRecord.open(record_location, all_space_names)
+log(f"Status record: {record_location}, status-files-interval={status_files_interval}")
 
 prev_saved_rframe     = get_value_from_tag(sys_config, "rframe-save-location")
+# Crash recovery - the state of every camera is saved every checkpoint-interval seconds. The
+# occupied timers and statuses of a checkpoint older than checkpoint-max-age seconds start over.
+checkpoint_location   = config.get("checkpoint-location", default="src/data/parkit-checkpoint.npz")
+checkpoint_interval   = config.get("checkpoint-interval", float, 10.0)
+checkpoint_max_age    = config.get("checkpoint-max-age", float, 120.0)
 data_output_fd        = get_value_from_tag(sys_config, "system-output-location")
 csv_file_location     = get_value_from_tag(sys_config, "csv-file-location")
 graph_file_location   = get_value_from_tag(sys_config, "data-analytics-graph")
 streak_file_location  = get_value_from_tag(sys_config, "streak-file-location")
 optimal_file_location = get_value_from_tag(sys_config, "optimal-file-location")
-total_csv_location    = get_value_from_tag(sys_config, "total-csv-location")
-
-# Reference frame used when checking occupancy
-# Use previously loaded reference frame if the status is marked as failed
-reference_frame = None
-if get_value_from_tag(sys_config, "status") == "failed":
-    reference_frame = np.load(prev_saved_rframe)
-    append_text_to_file(csv_file_location, "### SYSTEM RESTART ###")
-    log(f"Previous reference frame found. Loading {prev_saved_rframe}")
-else:
-    log("Using new reference frame.")
-
-# Occupancy flag used for coloring the rectangle
-confirmed_occupied = False
-
-# System Status Messages
-msg_occu = ""
-msg_car = ""
-last_car = ""
-last_occu = ""
+history_location      = get_value_from_tag(sys_config, "history-location")
+recording_mode        = config.get("recording-mode", default="samples")
+event_heartbeat       = config.get("event-heartbeat", float, 300.0)
+# Background model - a learning rate of 0 keeps the static reference frame
+background_learning_rate = config.get("background-learning-rate", float, 0.0)
+background_noise_factor  = config.get("background-noise-factor", float, 3.0)
+exposure_compensation    = config.get("exposure-compensation", default="true").lower() == "true"
+occupancy_downscale      = config.get("occupancy-downscale", int, 1)
+log(f"Background model: learning-rate={background_learning_rate}, noise-factor={background_noise_factor}, "
+    f"exposure-compensation={exposure_compensation}, downscale={occupancy_downscale}")
+
+restarted             = args.restart or get_value_from_tag(sys_config, "status") == "failed"
+
+# Occupancy history of all previous sessions, merged and rolled up by the watch dog
+history = HistoryStore(history_location)
+rollups = RollupStore(history)
 
-csv_write_timer = time.time()
-longest_streak  = 0
-
-# check_occupation - Check if live video frame is occupied
-def check_occupation(frame, rect, reference_frame):
-    global occupied_start_time, confirmed_occupied
+# Variables and objects used in application...
+# Rectangle parameters: [x, y, width, height]
+# These are the rectangle boxes used for determining occupancy on the parking spaces
+spaces = []
+for definition in space_definitions:
+    space = ParkingSpace(definition["name"],
+                         [definition["x"], definition["y"], definition["width"], definition["height"]],
+                         definition["move-dist"], definition["occupied-timer"])
+    # Position of the space in the configuration file and the camera that watches it
+    space.index = definition["index"]
+    space.camera = definition["camera"]
+
+    # Every space has its own data files. An unnamed space uses the configured paths.
+    space.data_output_fd        = space_file_path(data_output_fd, space.name)
+    space.csv_file_location     = space_file_path(csv_file_location, space.name)
+    space.graph_file_location   = space_file_path(graph_file_location, space.name)
+    space.streak_file_location  = space_file_path(streak_file_location, space.name)
+    space.optimal_file_location = space_file_path(optimal_file_location, space.name)
+
+    if restarted:
+        append_text_to_file(space.csv_file_location, "### SYSTEM RESTART ###")
+
+    # In the change-only recording mode the data file gets one row per run of identical samples
+    space.recorder = EventRecorder(event_heartbeat) if recording_mode == "events" else None
+
+    # Session analytics are loaded once, from the checkpoint or the CSV file, and then updated with
+    # every new row. The history only changes when the watch dog merges a finished session into it.
+    space.session_analytics = OccupancyAnalytics()
+    space.analytics_restored = False
+    # Smoothed samples in the samples file of the checkpoint, None until it is written
+    space.samples_saved = None
+    space.besttime = rollups.best_time(space.name)
+
+    # What the live server has already been sent
+    space.analytics_published = None
+    space.graph_rendered_at = 0.0
+    spaces.append(space)
+
+status = StatusPublisher(status_record, {space.name: {"data": space.data_output_fd, "streak": space.streak_file_location,
+                                                      "optimal": space.optimal_file_location} for space in spaces},
+                         status_files_interval)
+
+# One view per analysed camera: its spaces, the occupancy engine that checks them in one pass
+# per frame, and the source of its frames
+class CameraView:
+    def __init__(self, definition, space_ids):
+        self.index = definition["index"]
+        self.name = definition["name"]
+        self.source = definition["source"]
+        self.playback = definition["playback"]
+        self.fps = definition["fps"]
+        self.space_ids = space_ids
+        self.occupancy = SpaceOccupancyEngine([spaces[i].rect for i in space_ids],
+                                              [spaces[i].occupied_timer for i in space_ids],
+                                              learning_rate=background_learning_rate,
+                                              noise_factor=background_noise_factor,
+                                              exposure_compensation=exposure_compensation,
+                                              downscale=occupancy_downscale)
+        self.checkpoint_saved_at = time.time()
+        # A recording replayed as fast as possible checks every frame
+        self.scheduler = SamplingScheduler(0 if self.playback == "fast" else steady_check_fps, steady_after)
+        self.last_occupied = None
+        # The first camera keeps the configured reference frame file
+        self.rframe_location = prev_saved_rframe if self.index == 0 else space_file_path(prev_saved_rframe, f"camera{self.index}")
+        self.checkpoint_location = space_file_path(checkpoint_location, None if self.index == 0 else f"camera{self.index}")
+        # The smoothed samples of every space are appended to a file of their own
+        self.samples_locations = [f"{self.checkpoint_location}.space{slot}.samples" for slot in range(len(space_ids))]
+        self.window = 'frame' if len(camera_definitions) == 1 else f'frame {self.name}'
+        self.frames = None
+
+# Save everything a restarted detector needs to continue with the spaces of a camera
+def save_checkpoint(view):
+    occupancy = view.occupancy
+    meta = {"camera": view.index, "rects": [spaces[i].rect for i in view.space_ids], "spaces": []}
+    arrays = {"occupied_start_time": occupancy.occupied_start_time, "confirmed_occupied": occupancy.confirmed_occupied}
+    reference = occupancy.state()
+    if reference is not None:
+        arrays["reference"] = reference
+    for slot, i in enumerate(view.space_ids):
+        space = spaces[i]
+        entry = {"name": space.name, "msg_occu": space.msg_occu, "msg_car": space.msg_car}
+        if space.car_boxes is not None:
+            arrays[f"space{slot}_car_boxes"] = space.car_boxes
+        # The open run of the change-only recording mode is not in the CSV file yet, those
+        # analytics are loaded from the file again
+        if space.recorder is None:
+            entry["csv"] = file_position(space.csv_file_location)
+            entry["analytics"], analytics_arrays = space.session_analytics.checkpoint()
+            arrays.update({f"space{slot}_{name}": values for name, values in analytics_arrays.items()})
+            # Only the samples added since the last checkpoint are written, before the checkpoint
+            # that counts them
+            space.samples_saved = save_records(view.samples_locations[slot], space.session_analytics.samples,
+                                               space.samples_saved, SAMPLE_DTYPE)
+        meta["spaces"].append(entry)
+    write_checkpoint(view.checkpoint_location, meta, arrays)
+    view.checkpoint_saved_at = time.time()
+
+# Continue with the checkpoint of a crashed detector. Returns True if a reference was restored.
+def restore_checkpoint(view):
+    restore_started = time.perf_counter()
+    checkpoint = read_checkpoint(view.checkpoint_location)
+    if checkpoint is None:
+        return False
+    meta, arrays = checkpoint
+    occupancy = view.occupancy
+    same_spaces = (meta["rects"] == [spaces[i].rect for i in view.space_ids] and
+                   [entry["name"] for entry in meta["spaces"]] == [spaces[i].name for i in view.space_ids])
+    restored = same_spaces and "reference" in arrays and occupancy.load_reference(arrays["reference"])
+    age = time.time() - meta["time"]
+    recent = restored and age <= checkpoint_max_age
+    if recent:
+        occupancy.occupied_start_time[:] = arrays["occupied_start_time"]
+        occupancy.confirmed_occupied[:] = arrays["confirmed_occupied"]
+
+    for slot, entry in enumerate(meta["spaces"] if same_spaces else []):
+        space = spaces[view.space_ids[slot]]
+        if recent:
+            space.msg_occu, space.msg_car = entry["msg_occu"], entry["msg_car"]
+            space.car_boxes = arrays.get(f"space{slot}_car_boxes")
+        if "analytics" in entry and space.recorder is None:
+            # Only the rows written after the checkpoint are read, including the restart marker
+            appended = read_after(space.csv_file_location, entry["csv"])
+            samples = read_records(view.samples_locations[slot], SAMPLE_DTYPE, entry["analytics"]["samples"])
+            if appended is not None and samples is not None:
+                prefix = f"space{slot}_"
+                space.session_analytics.restore(entry["analytics"], {name[len(prefix):]: values for name, values in arrays.items()
+                                                                      if name.startswith(prefix)}, samples)
+                space.samples_saved = len(samples)
+                for row in appended:
+                    space.session_analytics.add_row(row)
+                space.analytics_restored = True
+    log(f"Checkpoint of camera {view.name} restored in {(time.perf_counter() - restore_started) * 1000:.1f}ms: "
+        f"age={age:.1f}s, reference={restored}, timers={recent}, analytics={sum(spaces[i].analytics_restored for i in view.space_ids)}/{len(view.space_ids)}")
+    return restored
+
+cameras = []
+for definition in camera_definitions:
+    space_ids = [i for i, space in enumerate(spaces) if space.camera == definition["index"]]
+    if not space_ids:
+        log(f"Camera {definition['name']} has no spaces and is not analysed.", "WARNING")
+        continue
+    view = CameraView(definition, space_ids)
+    for slot, i in enumerate(space_ids):
+        spaces[i].view = view
+        spaces[i].slot = slot
+    cameras.append(view)
+
+    # Reference frame used when checking occupancy
+    # Continue with the checkpoint, or the reference frame of an older version, if the status is marked as failed
+    if restarted and restore_checkpoint(view):
+        log(f"Checkpoint found. Continuing with {view.checkpoint_location}")
+    elif restarted and os.path.exists(view.rframe_location) and view.occupancy.load_reference(np.load(view.rframe_location)):
+        log(f"Previous reference frame found. Loading {view.rframe_location}")
+    else:
+        log(f"Using new reference frame for camera {view.name}.")
 
-    # Obtain parking space rectangle location on frame
-    x, y, w, h = rect
+for space in spaces:
+    if not space.analytics_restored and os.path.exists(space.csv_file_location):
+        space.session_analytics.bootstrap(space.csv_file_location)
+    space.points_published = len(space.session_analytics.read_csv())
 
-    # Reference of Interest: The video frame inside the space
-    roi = frame[y:y+h, x:x+w]
-    if reference_frame is not None:
-        # Get the difference & convert to grey scale
-        diff = cv2.absdiff(roi, reference_frame)
-        gray = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
-        
-        # Count the number of pixels above a certain insensity threshold
-        _, thresh = cv2.threshold(gray, 25, 255, cv2.THRESH_BINARY)
-        count = cv2.countNonZero(thresh)
-        occupied = count > (w * h * 0.1) 
-
-        # Start timer, this is used later in the main loop
-        if occupied:
-            if occupied_start_time is None:
-                occupied_start_time = time.time()
-        else:
-            occupied_start_time = None
-            confirmed_occupied = False
+# Space that is moved by the keyboard
+selected_space = 0
 
-        return occupied, reference_frame
+csv_write_timer = time.time()
 
-    return False, reference_frame
+# Graphs are rendered on a background thread, one figure shared by all spaces
+graph_renderer = GraphRenderer()
 
 # Ensure rectangle stays within frame boundaries
 def validate_position(rect, frame_width, frame_height):
@@ -134,152 +356,374 @@ def validate_position(rect, frame_width, frame_height):
     if y + h > frame_height: y = frame_height - h
     return [x, y, w, h]
 
-def reset_reference_frame():
-    global reference_frame, confirmed_occupied
-    reference_frame = None
-    confirmed_occupied = False
-
-# Capture video from the webcam
-cap = cv2.VideoCapture(camera)
-if not cap.isOpened():
-    print("Error: Could not open webcam.")
-    log("ERROR: Could not open webcam.")
-    exit()
-
-while True:
-    ret, frame = cap.read()
-    if not ret:
-        print("Error: Could not read frame from webcam.")
-        log("ERROR: Could not read frame from webcam.")
-        break
-    
-    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+def reset_reference_frame(index=None):
+    if index is None:
+        for view in cameras:
+            view.occupancy.reset_reference()
+    else:
+        spaces[index].view.occupancy.reset_reference(spaces[index].slot)
+    forget_detection(index)
+
+# Drop the detection of a space (or all spaces). Results still in flight are ignored.
+def forget_detection(index=None):
+    for i in (range(len(spaces)) if index is None else [index]):
+        spaces[i].car_boxes = None
+        spaces[i].generation += 1
+        spaces[i].next_inference = 0.0
+    detection_cache.invalidate(index)
+
+# Apply the detections that finished since the last call.
+# Only cars that lie far enough inside the space count, their boxes are kept relative to the space.
+def collect_detections():
+    for i, (generation, fingerprint, window), car_boxes in inference.results():
+        if generation == spaces[i].generation:
+            rect = spaces[i].rect
+            # The space in the coordinates of the picture the model saw
+            stall = [rect[0] - window[0], rect[1] - window[1], rect[2], rect[3]]
+            if min_coverage > 0:
+                _, coverage = space_overlap(car_boxes, stall)
+                car_boxes = car_boxes[coverage >= min_coverage]
+            if stall[0] or stall[1]:
+                car_boxes = shift_boxes(car_boxes, -stall[0], -stall[1])
+            spaces[i].car_boxes = car_boxes
+            detection_cache.store(i, fingerprint, car_boxes)
+
+def move_space(index, dx, dy):
+    space = spaces[index]
+    view = space.view
+    rect = [space.rect[0] + dx, space.rect[1] + dy, space.rect[2], space.rect[3]]
+    space.rect = validate_position(rect, view.frames.frame_width, view.frames.frame_height)
+    view.occupancy.set_rects([spaces[i].rect for i in view.space_ids])
+    reset_reference_frame(index)
+    # Written by the debounced config flush in the main loop
+    update_space_value(sys_config, space.index, "space-x", str(space.rect[0]), flush=False)
+    update_space_value(sys_config, space.index, "space-y", str(space.rect[1]), flush=False)
+
+# Run a control command, from a key press or the control file.
+# Returns False if the system should shut down.
+def handle_command(command):
+    global selected_space
+    words = command.lower().split()
+    if not words:
+        return True
+    name, args = words[0], words[1:]
+
+    moves = {"up": (0, -1, "Move Up"), "down": (0, 1, "Move Down"),
+             "left": (-1, 0, "Move Left"), "right": (1, 0, "Move Right")}
+
+    if name == "quit":
+        log("User requested system shutdown. Shutting down...")
+        return False
+    elif name == "select" and args:
+        if args[0] == "next":
+            selected_space = (selected_space + 1) % len(spaces)
+        elif args[0].isdigit() and 0 < int(args[0]) <= len(spaces):
+            selected_space = int(args[0]) - 1
+        else:
+            names = [str(space.name).lower() for space in spaces]
+            if args[0] not in names:
+                log(f"Unknown space '{args[0]}'", "WARNING")
+                return True
+            selected_space = names.index(args[0])
+        log(f"Selected {spaces[selected_space].label} ({selected_space + 1} of {len(spaces)})")
+    elif name in moves:
+        dx, dy, label = moves[name]
+        dist = spaces[selected_space].move_dist
+        move_space(selected_space, dx * dist, dy * dist)
+        log(f"{label}: Space at X:{spaces[selected_space].rect[0]} Y:{spaces[selected_space].rect[1]}")
+    elif name == "reset":
+        reset_reference_frame()
+        log("User requests reference frame reset.")
+    elif name == "profile":
+        seconds = float(args[0]) if args and args[0].replace(".", "", 1).isdigit() else 30.0
+        profiler.start(seconds, "sampling" if "sampling" in args else "cprofile")
+    elif name == "error":
+        log("User throws an error. This is normal.", "WARNING")
+        raise ValueError('A planned error event is being requested. This is ok.')
+    else:
+        log(f"Unknown command '{command}'", "WARNING")
+    return True
+
+# Check the spaces of one camera on a new frame and update their status.
+# Returns True while a space changes or waits for its occupied timer or a detection.
+def process_frame(view, frame, captured_at):
+    global first_status_at
+    occupancy = view.occupancy
 
     # Update the reference frame
-    if reference_frame is None:
-        x, y, w, h = rect
-        reference_frame = frame[y:y+h, x:x+w].copy()
+    active = occupancy.update_reference(frame)
+    if active:
         # Save reference frame in case system crashes
-        np.save(prev_saved_rframe, reference_frame)
-
-    # Draw the rectangle and determine rectangle color
-    rect_color = (0, 0, 255) if confirmed_occupied else (0, 255, 0)
-    cv2.rectangle(frame, (rect[0], rect[1]), (rect[0]+rect[2], rect[1]+rect[3]), rect_color, 2)
-
-    # Check if the space is occupied
-    occupied, _ = check_occupation(frame, rect, reference_frame)
-    if occupied and occupied_start_time:
-        if time.time() - occupied_start_time > occupied_timer:
-            msg_occu = "OCCUPIED"
-            cv2.putText(frame, msg_occu, (rect[0], rect[1]-10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,0,255), 2)
-            confirmed_occupied = True
-            
-            # Grab the Reference of Interest frame & run the pre-trained model on
-            # the frame
-            roi = frame[rect[1]:rect[1]+rect[3], rect[0]:rect[0]+rect[2]]
-            results = yolov5_model.predict(roi)
+        with metrics.stage("checkpoint"):
+            save_checkpoint(view)
+
+    # Check if the spaces are occupied, all spaces of the camera at once
+    with metrics.stage("occupancy"):
+        # The capture time keeps the occupied timers exact when frames are checked less often
+        occupied, timed_out = occupancy.check_occupation(frame, captured_at)
+    if view.last_occupied is None or (occupied != view.last_occupied).any() or (occupied & ~timed_out).any():
+        active = True
+    view.last_occupied = occupied
+
+    for slot, i in enumerate(view.space_ids):
+        space = spaces[i]
+        rect = space.rect
+
+        # Draw the rectangle and determine rectangle color
+        if not headless:
+            rect_color = (0, 0, 255) if occupancy.confirmed_occupied[slot] else (0, 255, 0)
+            cv2.rectangle(frame, (rect[0], rect[1]), (rect[0]+rect[2], rect[1]+rect[3]), rect_color, 4 if len(spaces) > 1 and i == selected_space else 2)
+
+        if occupied[slot] and timed_out[slot]:
+            occupancy.confirmed_occupied[slot] = True
             
-            # Convert the results to a Pandas DataFrame for post-processing
-            predictions_df = results.pandas().xyxy[0]  
-
-            # Filter predictions for 'car' detections
-            car_detections = predictions_df[predictions_df['name'] == 'car']
-            if len(car_detections) > 0:
-                msg_car = "CAR PRESENT"          
-
-                # Iterate through each car detection to draw a rectangle if the car is in the space
-                for index, row in car_detections.iterrows():
-                    class_name = row['name']
-                    xmin, ymin, xmax, ymax = map(int, [row['xmin'], row['ymin'], row['xmax'], row['ymax']])
-                    
-                    if class_name == "car":
-                        # Draw rectangle around the detected car
-                        cv2.rectangle(frame, (xmin+rect[0], ymin+rect[1]), (xmax+rect[0], ymax+rect[1]), (255, 0, 0), 2)
-
-            else:
-                # Car is not in space
-                msg_car = "NO CAR PRESENT"
-
-            cv2.putText(frame, msg_car, (rect[0]+300, rect[1]-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,0,0), 2)
+            # Grab the Reference of Interest frame & hand it to the pre-trained model,
+            # unless the cached detection of the space is still valid or a detection is running
+            if not inference.in_flight_for(i) and captured_at >= space.next_inference:
+                # The model sees the space with its surroundings, see collect_detections()
+                window = context_window(rect, detection_margin, frame.shape[1], frame.shape[0])
+                roi = frame[window[1]:window[1]+window[3], window[0]:window[0]+window[2]]
+                with metrics.stage("cache_lookup"):
+                    cached_boxes, fingerprint = detection_cache.lookup(i, roi)
+                if cached_boxes is None:
+                    metrics.count("cache_misses")
+                    metrics.count("inferences")
+                    view.scheduler.inferences += 1
+                    space.next_inference = captured_at + inference_interval
+                    with metrics.stage("inference"):
+                        inference.submit(i, roi, (space.generation, fingerprint, window))
+                        collect_detections()
+                else:
+                    metrics.count("cache_hits")
+                    space.car_boxes = cached_boxes
+
+            # Keep the last status until the first detection of the space arrives
+            if space.car_boxes is None or inference.busy(i):
+                active = True
+            if space.car_boxes is not None:
+                space.msg_occu = "OCCUPIED"
+
+                if len(space.car_boxes) > 0:
+                    space.msg_car = "CAR PRESENT"          
+                else:
+                    # Car is not in space
+                    space.msg_car = "NO CAR PRESENT"
+
+                if not headless:
+                    cv2.putText(frame, space.msg_occu, (rect[0], rect[1]-10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,0,255), 2)
+                    cv2.putText(frame, space.msg_car, (rect[0]+300, rect[1]-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,0,0), 2)
+
+                    # Draw a rectangle around each car detected in the space
+                    for box in space.car_boxes:
+                        cv2.rectangle(frame, (int(box['xmin'])+rect[0], int(box['ymin'])+rect[1]),
+                                      (int(box['xmax'])+rect[0], int(box['ymax'])+rect[1]), (255, 0, 0), 2)
 
+        else:
+            space.msg_occu = "NOT OCCUPIED"
+            space.msg_car  = "NO CAR PRESENT"
+            if space.car_boxes is not None or inference.busy(i):
+                forget_detection(i)
+            occupancy.confirmed_occupied[slot] = False
+
+        formated_data = f"{space.msg_occu} - {space.msg_car}"
+
+        if space.msg_car != space.last_car or space.msg_occu != space.last_occu:
+            space.last_car = space.msg_car
+            space.last_occu = space.msg_occu
+            log(f"Status Update: {space.label} New status='{formated_data}'")
+            if first_status_at is None:
+                first_status_at = time.time()
+                log(f"Startup: first status {first_status_at - process_started:.2f}s after the {'restart' if restarted else 'start'}")
+                metrics.gauge("startup_seconds", round(first_status_at - process_started, 3))
+            # Write after data here
+            with metrics.stage("status_write"):
+                status.publish(space.name, data=formated_data)
+            live.publish("status", space.name, data=formated_data)
+
+    return active
+
+
+# Open the frame source of every camera. The capture stage runs on its own thread (or in the
+# watch dog's capture process) and only keeps the newest frame.
+for view in cameras:
+    if args.frame_bus:
+        view.frames = FrameRingReader(ring_path(args.frame_bus, view.index))
+        if not view.frames.open(timeout=60):
+            print(f"Error: No frames from camera {view.name} on the frame bus.")
+            log(f"No frames from camera {view.name} on the frame bus.", "ERROR")
+            exit(1)
     else:
-        msg_occu = "NOT OCCUPIED"
-        msg_car  = "NO CAR PRESENT"
-        confirmed_occupied = False
-
-    formated_data = f"{msg_occu} - {msg_car}"
-
-    if msg_car != last_car:
-        last_car = msg_car
-        log(f"Status Update: New status='{formated_data}'")
-        # Write after data here
-        write_text_to_file(data_output_fd, formated_data)
-    
-    if msg_occu != last_occu:
-        last_occu = msg_occu
-        log(f"Status Update: New status='{formated_data}'")
-        # Write after data here
-        write_text_to_file(data_output_fd, formated_data)
+        # Capture video from the webcam or replay a recording
+        cap = open_source(view.source, view.playback, view.fps)
+        if not cap.isOpened():
+            print("Error: Could not open webcam.")
+            log(f"Could not open webcam {view.name}.", "ERROR")
+            exit(1)
+        # A recording replayed as fast as possible keeps every frame
+        view.frames = FrameGrabber(cap, block=view.playback == "fast" and is_recording(view.source)).start()
+
+rate_limiter = RateLimiter(target_fps)
+
+# With several cameras only wait briefly on each one, so a slow camera does not hold up the others
+read_timeout = 5.0 if len(cameras) == 1 else 0.01
+running = True
+
+# Per-frame measurements of a benchmark run
+frame_latencies = []
+processing_times = []
+benchmark_start = time.time()
+
+while running:
+    rate_limiter.wait()
+
+    # Apply the detections that finished while the last frame was processed
+    collect_detections()
+
+    now = time.time()
+    checked = False
+    for view in cameras:
+        # A camera in the steady state skips frames until its next check
+        if not view.scheduler.due(now):
+            continue
+        checked = True
+        with metrics.stage("capture"):
+            ret, frame, captured_at = view.frames.read(read_timeout)
+        if not ret:
+            if view.frames.ended:
+                if is_recording(view.source):
+                    log(f"Recording of camera {view.name} ended.")
+                else:
+                    print("Error: Could not read frame from webcam.")
+                    log(f"Could not read frame from webcam {view.name}.", "ERROR")
+                running = False
+                break
+            continue
+
+        processing_start = time.perf_counter()
+        with metrics.stage("frame"):
+            active = process_frame(view, frame, captured_at)
+        view.scheduler.checked(captured_at, active)
+        view.frames.mark_done(captured_at)
+        metrics.count("frames")
+        if args.benchmark:
+            processing_times.append(time.perf_counter() - processing_start)
+            frame_latencies.append(view.frames.last_latency)
+
+        if not headless:
+            with metrics.stage("display"):
+                cv2.imshow(view.window, frame)
+
+    if not running:
+        break
+    if not checked:
+        # Every camera is steady, sleep until the first one is due again
+        time.sleep(min(max(min(view.scheduler.next_check for view in cameras) - now, 0.0), 0.1))
 
     current_time = time.time()
     elapsed_time_csv   = current_time - csv_write_timer
 
     # Basically a two second timer
-    if elapsed_time_csv > 2 and msg_occu and msg_occu is not None:
+    if elapsed_time_csv > 2:
         csv_write_timer = time.time()
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        csv_data = f"{msg_occu},{msg_car},{timestamp},{rectx},{recty},{rectw},{recth}"
-        append_text_to_file(csv_file_location, csv_data)
-        data = read_csv(csv_file_location)
-        times = find_longest_streak(csv_file_location)
-        # Read total csv
-        besttime = find_best_time_to_park_and_analytics(total_csv_location)
-        write_text_to_file(optimal_file_location, besttime)
-        if times:
-            start_time, end_time = times.split(',')
-            write_text_to_file(streak_file_location, f"{start_time} {end_time} {parse_datetime(end_time) - parse_datetime(start_time)}")
-        plot_and_save_graph(data, graph_file_location)
-
-
-    cv2.imshow('frame', frame)
-
-    # Move the rectangle based on key presses
-    # The box can move at any time while the application is running
-    key = cv2.waitKey(1) & 0xFF
-    if key == ord('q'):
-        log("User requested system shutdown. Shutting down...")
+        for view in cameras:
+            log(f"Capture stage {view.name}: {view.frames.stats()}", "DEBUG")
+            sampling = view.scheduler.stats(current_time)
+            log(f"Sampling {view.name}: {sampling}", "DEBUG")
+            metrics.gauge(f"check_rate_camera{view.index}", sampling["check_rate"])
+            metrics.gauge(f"inference_rate_camera{view.index}", sampling["inference_rate"])
+            # The timers, analytics and adaptive background change all the time
+            if view.occupancy.reference_frame is not None and current_time - view.checkpoint_saved_at >= checkpoint_interval:
+                with metrics.stage("checkpoint"):
+                    save_checkpoint(view)
+        if not inference_ready_logged and inference.ready_at is not None:
+            inference_ready_logged = True
+            log(f"Startup: inference ready {inference.ready_at - process_started:.2f}s after the {'restart' if restarted else 'start'}")
+            metrics.gauge("inference_ready_seconds", round(inference.ready_at - process_started, 3))
+        log(f"Detection cache: {detection_cache.stats()}", "DEBUG")
+        log(f"Inference pool: {inference.stats()}", "DEBUG")
+        for space in spaces:
+            if not space.msg_occu:
+                continue
+            rectx, recty, rectw, recth = space.rect
+            csv_data = f"{space.msg_occu},{space.msg_car},{timestamp},{rectx},{recty},{rectw},{recth}"
+            with metrics.stage("csv_write"):
+                if space.recorder is None:
+                    append_text_to_file(space.csv_file_location, csv_data)
+                    metrics.count("file_writes")
+                else:
+                    for event in space.recorder.add(csv_data):
+                        append_text_to_file(space.csv_file_location, event)
+                        metrics.count("file_writes")
+            with metrics.stage("analytics"):
+                space.session_analytics.add_row(csv_data)
+                data = space.session_analytics.read_csv()
+                times = space.session_analytics.find_longest_streak()
+            with metrics.stage("analytics_write"):
+                status.publish(space.name, optimal=space.besttime)
+                streak = None
+                if times:
+                    start_time, end_time = times.split(',')
+                    streak = f"{start_time} {end_time} {parse_datetime(end_time) - parse_datetime(start_time)}"
+                    status.publish(space.name, streak=streak)
+            with metrics.stage("live_publish"):
+                for status_car, sample_time, *_ in data[space.points_published:]:
+                    live.publish("point", space.name, time=sample_time.strftime("%Y-%m-%d %H:%M:%S"), car=status_car)
+                space.points_published = len(data)
+                if (streak, space.besttime) != space.analytics_published:
+                    space.analytics_published = (streak, space.besttime)
+                    live.publish("analytics", space.name, streak=streak, optimal=space.besttime)
+            if current_time - space.graph_rendered_at >= graph_interval:
+                space.graph_rendered_at = current_time
+                with metrics.stage("graph"):
+                    graph_renderer.submit(data, space.graph_file_location)
+
+
+    commands = control_file.poll(current_time)
+    if not headless:
+        # Move the rectangle based on key presses
+        # The box can move at any time while the application is running
+        with metrics.stage("display"):
+            key = cv2.waitKey(1) & 0xFF
+        command = key_command(key)
+        if command:
+            commands.append(command)
+
+    if not all(handle_command(command) for command in commands):
         break
-    elif key == ord('w'):  # Move up
-        rect[1] -= move_dist
-        rect = validate_position(rect, frame_width, frame_height)
-        reset_reference_frame()
-        log(f"Move Up: Space at X:{rect[0]} Y:{rect[1]}")
-    elif key == ord('s'):  # Move down
-        rect[1] += move_dist
-        rect = validate_position(rect, frame_width, frame_height)
-        reset_reference_frame()
-        log(f"Move Down: Space at X:{rect[0]} Y:{rect[1]}")
-    elif key == ord('a'):  # Move left
-        rect[0] -= move_dist
-        rect = validate_position(rect, frame_width, frame_height)
-        reset_reference_frame()
-        log(f"Move Left: Space at X:{rect[0]} Y:{rect[1]}")
-    elif key == ord('d'):  # Move right
-        rect[0] += move_dist
-        rect = validate_position(rect, frame_width, frame_height)
-        reset_reference_frame()
-        log(f"Move Right: Space at X:{rect[0]} Y:{rect[1]}")
-    elif key == ord('r'):  # Reset reference frame
-        reset_reference_frame()
-        log("User requests reference frame reset.")
-    elif key == ord('e'):
-        log("User throws an error. This is normal.")
-        raise ValueError('A planned error event is being requested. This is ok.')
-    
-    update_xml_tag_value(sys_config, "space-x", str(rect[0]))
-    update_xml_tag_value(sys_config, "space-y", str(rect[1]))
-
 
-cap.release()
-cv2.destroyAllWindows()
\ No newline at end of file
+    # Save moved spaces, at most once per second
+    config.maybe_flush()
+    if status.due(current_time):
+        with metrics.stage("status_files"):
+            status.flush(current_time)
+
+    metrics.maybe_write(current_time)
+    profiler.poll(current_time)
+
+
+# Write the runs that are still open
+for space in spaces:
+    if space.recorder is not None:
+        for event in space.recorder.flush():
+            append_text_to_file(space.csv_file_location, event)
+
+config.flush()
+status.flush()
+metrics.write()
+processing_cpu_time = time.thread_time()
+for view in cameras:
+    view.frames.stop()
+inference.close()
+if args.benchmark:
+    from ParkitBenchmark import write_run_report
+    write_run_report(args.benchmark, time.time() - benchmark_start, frame_latencies, processing_times,
+                     inference.stats(), processing_cpu_time,
+                     sum(getattr(view.frames, "cpu_time", 0.0) for view in cameras))
+if not headless:
+    cv2.destroyAllWindows()
+# The graph archived in the gallery shows the whole session
+if live_server:
+    for space in spaces:
+        graph_renderer.submit(space.session_analytics.read_csv(), space.graph_file_location)
+graph_renderer.close()
\ No newline at end of file
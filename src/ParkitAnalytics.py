@@ -0,0 +1,283 @@
+'''
+
+        +----------------------------+
+        |     ParkitAnalytics.py     |
+        +----------------------------+
+
+This module provides a stateful analytics object for the Parkit system. Instead of re-opening and
+re-parsing the CSV files on every update, the object is bootstrapped once from an existing CSV file
+and then fed each new row as it is appended. Every row updates the sliding-window car status, the
+current and longest occupancy streak, and the 15-minute unoccupied buckets in constant time.
+
+The results are identical to the ones produced by read_csv, find_longest_streak and
+find_best_time_to_park_and_analytics in CSVConvertGraphs.py for the same file.
+
+Runs written in the change-only recording mode (see EventLog.py) are applied as a whole, so a
+data file of runs gives the same results as the samples it stands for.
+
+The best time over the whole history store comes from its rollups, see RollupStore.py.
+
+'''
+
+import csv
+from collections import deque
+from datetime import datetime, timedelta
+import numpy as np
+from Adaptation import log
+from EventLog import expand_event, is_event
+
+RESTART_MARKER = "### SYSTEM RESTART ###"
+# One smoothed sample of read_csv() as a record, for checkpoints
+SAMPLE_DTYPE = np.dtype([("car", "?"), ("time", "<M8[s]"), ("rect", "<f8", (4,))])
+
+class OccupancyAnalytics:
+    """
+    Incrementally maintained occupancy analytics for one CSV data file.
+
+    :param window_size: Size of the sliding window used to smooth the car status.
+    :param keep_samples: Keep the smoothed samples used for plotting. History files that are only
+                         used for the best time to park can turn this off to save memory.
+    """
+
+    def __init__(self, window_size=5, keep_samples=True):
+        self.keep_samples = keep_samples
+
+        # read_csv state
+        self.data = []
+        self.window = deque(maxlen=window_size)
+        self.skip = False
+        self.skip_count = 0
+
+        # find_longest_streak state
+        self.longest_streak = 0
+        self.current_streak = 0
+        self.streak_start = None
+        self.streak_end = None
+        self.longest_streak_start = None
+        self.longest_streak_end = None
+        self.last_logged_streak = None
+
+        # find_best_time_to_park_and_analytics state
+        self.occupied_time = timedelta(0)
+        self.unoccupied_time = timedelta(0)
+        self.last_time = None
+        self.unoccupied_intervals = [0] * 96
+
+    def bootstrap(self, filename):
+        """
+        One-time load of an existing CSV file. The header line is skipped.
+
+        :param filename: The path to the CSV file.
+        :return: The number of rows read.
+        """
+        count = 0
+        with open(filename, 'r') as file:
+            reader = csv.reader(file)
+            next(reader, None)  # Skip header
+            for row in reader:
+                self.add_row(row)
+                count += 1
+        log(f"OccupancyAnalytics: bootstrapped {count} rows from {filename}")
+        return count
+
+    def checkpoint(self):
+        """
+        :return: (values, arrays): the state as JSON values and NumPy arrays, for restore(). The
+                 smoothed samples are not part of it, only their number, see samples().
+        """
+        values = {"skip": self.skip, "skip_count": self.skip_count,
+                  "longest_streak": self.longest_streak, "current_streak": self.current_streak,
+                  "streak_start": self.streak_start, "streak_end": self.streak_end,
+                  "longest_streak_start": self.longest_streak_start, "longest_streak_end": self.longest_streak_end,
+                  "last_logged_streak": self.last_logged_streak,
+                  "occupied_time": self.occupied_time.total_seconds(),
+                  "unoccupied_time": self.unoccupied_time.total_seconds(),
+                  "last_time": self.last_time.strftime('%Y-%m-%d %H:%M:%S') if self.last_time else None,
+                  "unoccupied_intervals": self.unoccupied_intervals,
+                  "samples": len(self.data)}
+        return values, {"window": np.array(self.window, dtype=bool)}
+
+    def samples(self, start=0):
+        """
+        :param start: Index of the first sample, the samples before it were saved already.
+        :return: The smoothed samples from start on, as an array of SAMPLE_DTYPE records.
+        """
+        data = self.data[start:]
+        samples = np.empty(len(data), dtype=SAMPLE_DTYPE)
+        if data:
+            samples["car"] = [sample[0] for sample in data]
+            samples["time"] = [sample[1] for sample in data]
+            samples["rect"] = [sample[2:] for sample in data]
+        return samples
+
+    def restore(self, values, arrays, samples=None):
+        """
+        Continues from a checkpoint() of the same file, instead of a bootstrap().
+
+        :param samples: The first values["samples"] records of samples(), if samples are kept.
+        """
+        for name in ("skip", "skip_count", "longest_streak", "current_streak", "streak_start", "streak_end",
+                     "longest_streak_start", "longest_streak_end", "unoccupied_intervals"):
+            setattr(self, name, values[name])
+        self.last_logged_streak = tuple(values["last_logged_streak"]) if values["last_logged_streak"] else None
+        self.occupied_time = timedelta(seconds=values["occupied_time"])
+        self.unoccupied_time = timedelta(seconds=values["unoccupied_time"])
+        self.last_time = parse_datetime(values["last_time"]) if values["last_time"] else None
+        self.window.clear()
+        self.window.extend(arrays["window"].tolist())
+        if self.keep_samples:
+            self.data = list(zip(samples["car"].tolist(), samples["time"].astype(object).tolist(),
+                                 *samples["rect"].T.tolist()))
+
+    def add_row(self, row):
+        """
+        Updates every analytic with one CSV row.
+
+        :param row: The CSV row as a list of strings, or a comma separated string.
+        """
+        if isinstance(row, str):
+            row = row.split(',')
+        if not row:
+            return
+        if is_event(row):
+            self.add_event(row)
+            return
+
+        time = None
+        if not row[0].startswith('#'):
+            time = datetime.strptime(row[2].strip(), '%Y-%m-%d %H:%M:%S')
+            self._update_streak(row)
+            self._update_buckets(row[1], time)
+        self._update_samples(row, time)
+
+    def add_event(self, row):
+        """
+        Updates every analytic with a run of identical samples.
+
+        :param row: The run as a list of strings, see EventLog.py.
+        """
+        start = datetime.strptime(row[2].strip(), '%Y-%m-%d %H:%M:%S')
+        end = datetime.strptime(row[7].strip(), '%Y-%m-%d %H:%M:%S')
+        count = int(row[8])
+
+        # Streak: only the first sample of a run can end or start a streak
+        self._update_streak([row[0], row[1], row[2]])
+        if row[1].strip() == "CAR PRESENT":
+            self.current_streak += count - 1
+            self.streak_end = row[7].strip()
+
+        # Buckets: the gap before the run, then the run itself, which never leaves its slot
+        self._update_buckets(row[1], start)
+        interval = end - start
+        if row[1] == 'NO CAR PRESENT':
+            self.unoccupied_time += interval
+            self.unoccupied_intervals[start.hour * 4 + start.minute // 15] += interval.total_seconds()
+        else:
+            self.occupied_time += interval
+        self.last_time = end
+
+        if self.keep_samples or self.skip:
+            for sample in expand_event(row):
+                self._update_samples(sample, datetime.strptime(sample[2], '%Y-%m-%d %H:%M:%S'))
+        else:
+            # Samples are not kept, only the window needs the last statuses
+            for _ in range(min(count, self.window.maxlen)):
+                self.window.append(row[1] == 'CAR PRESENT')
+
+    def _update_samples(self, row, time):
+        # Same skipping rules as read_csv: the four rows after a restart are ignored
+        if self.skip:
+            if self.skip_count < 4:
+                self.skip_count += 1
+                return
+            else:
+                self.skip = False
+                self.skip_count = 0
+
+        if row[0] == RESTART_MARKER:
+            self.skip = True
+            return
+
+        if row[0].startswith("#"):
+            return
+
+        self.window.append(row[1] == 'CAR PRESENT')
+        status_car = self.window.count(True) > len(self.window) / 2
+
+        if self.keep_samples:
+            self.data.append((status_car, time, float(row[3]), float(row[4]), float(row[5]), float(row[6])))
+
+    def _update_streak(self, row):
+        status = row[1].strip()
+        timestamp = row[2].strip()
+
+        if status == "CAR PRESENT":
+            self.current_streak += 1
+            if self.current_streak == 1:
+                self.streak_start = timestamp
+            self.streak_end = timestamp
+        else:
+            if self.current_streak > self.longest_streak:
+                self.longest_streak = self.current_streak
+                self.longest_streak_start = self.streak_start
+                self.longest_streak_end = self.streak_end
+            self.current_streak = 0
+
+    def _update_buckets(self, status, time):
+        if self.last_time is not None:
+            if (time - self.last_time).seconds <= 300:  # Allow for a gap of up to 5 minutes
+                interval = time - self.last_time
+                if status == 'NO CAR PRESENT':
+                    self.unoccupied_time += interval
+                    slot = time.hour * 4 + time.minute // 15
+                    self.unoccupied_intervals[slot] += interval.total_seconds()
+                else:
+                    self.occupied_time += interval
+
+        self.last_time = time
+
+    def read_csv(self):
+        """
+        :return: The smoothed samples, same as read_csv(filename).
+        """
+        return self.data
+
+    def find_longest_streak(self):
+        """
+        :return: "start,end" of the longest car streak, same as find_longest_streak(filename),
+                 or None if there has not been a streak yet.
+        """
+        longest_streak = self.longest_streak
+        start = self.longest_streak_start
+        end = self.longest_streak_end
+
+        # Include the streak that is still running
+        if self.current_streak > longest_streak:
+            longest_streak = self.current_streak
+            start = self.streak_start
+            end = self.streak_end
+
+        if start and end:
+            if (start, end) != self.last_logged_streak:
+                self.last_logged_streak = (start, end)
+                duration = parse_datetime(end) - parse_datetime(start)
+                log(f"Longest Streak: {longest_streak} times. Start: {start}. End: {end}. Duration: {duration}")
+            return f"{start},{end}"
+        return None
+
+    def find_best_time_to_park_and_analytics(self):
+        """
+        :return: "occupied%,unoccupied%,HH:MM", same as find_best_time_to_park_and_analytics(filename).
+        """
+        total_time = self.occupied_time + self.unoccupied_time
+        occupied_percentage = (self.occupied_time / total_time * 100) if total_time > timedelta(0) else 0
+        unoccupied_percentage = (self.unoccupied_time / total_time * 100) if total_time > timedelta(0) else 0
+
+        # The first slot wins a tie, like max() over the ordered dictionary
+        best_slot = self.unoccupied_intervals.index(max(self.unoccupied_intervals))
+        best_15_min_time = f"{best_slot // 4:02}:{best_slot % 4 * 15:02}"
+
+        return f"{occupied_percentage:.2f},{unoccupied_percentage:.2f},{best_15_min_time}"
+
+def parse_datetime(date_str):
+    return datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
@@ -0,0 +1,242 @@
+'''
+
+        +----------------------------+
+        |     ParkitBenchmark.py     |
+        +----------------------------+
+
+This script measures the whole detection pipeline on recorded clips, without a webcam. Every clip
+(a video file or a directory of images) is replayed as fast as possible through a headless
+detector, using a copy of the configuration whose data files go to a temporary directory:
+
+    python src/ParkitBenchmark.py clips/day.mp4 clips/night/ --output benchmark.json
+    python src/ParkitBenchmark.py clips/day.mp4 --output new.json --baseline benchmark.json
+
+For every clip the report holds the throughput (fps), the p50/p95/p99 latency from capture until
+the frame was processed, the processing time per frame, the YOLOv5 calls per minute, the peak
+RSS and the CPU time of the capture, processing and inference stages. With --baseline the run is
+compared to an earlier report and the script fails if a clip got slower than the tolerance.
+
+With --kernel only the occupancy check is measured, on frames of the clip and the configured
+spaces: the time per call and the memory it allocates, for the static reference and the adaptive
+background at every downscale factor.
+
+    python src/ParkitBenchmark.py --kernel clips/day.mp4
+
+'''
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+# Tags of files the detector writes, redirected to the temporary directory
+DATA_TAGS = ["log-file-location", "data-analytics-graph", "csv-file-location", "total-csv-location",
+             "history-location", "gallery-location", "system-output-location", "streak-file-location",
+             "optimal-file-location", "rframe-save-location", "checkpoint-location", "control-file",
+             "health-file-location", "status-record-location"]
+
+def percentiles(values):
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(np.asarray(values) * 1000, [50, 95, 99])
+    return {"p50": round(float(p50), 2), "p95": round(float(p95), 2), "p99": round(float(p99), 2)}
+
+def write_run_report(path, seconds, frame_latencies, processing_times, inference_stats, processing_cpu, capture_cpu):
+    """
+    Written by the detector at the end of a run started with --benchmark.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    workers = resource.getrusage(resource.RUSAGE_CHILDREN)
+    minutes = seconds / 60 if seconds > 0 else 0
+    report = {
+        "frames": len(frame_latencies),
+        "seconds": round(seconds, 3),
+        "fps": round(len(frame_latencies) / seconds, 2) if seconds > 0 else 0,
+        "latency_ms": percentiles(frame_latencies),
+        "processing_ms": percentiles(processing_times),
+        "yolo_calls": inference_stats["finished"],
+        "yolo_calls_per_minute": round(inference_stats["finished"] / minutes, 1) if minutes else 0,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": {"detector": round(own.ru_maxrss / 1024, 1),
+                        "inference_workers": round(workers.ru_maxrss / 1024, 1)},
+        "cpu_seconds": {"capture": round(capture_cpu, 3),
+                        "processing": round(processing_cpu, 3),
+                        "inference_workers": round(workers.ru_utime + workers.ru_stime, 3),
+                        "total": round(own.ru_utime + own.ru_stime + workers.ru_utime + workers.ru_stime, 3)},
+    }
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+
+def benchmark_config(config_path, clip, work_dir, inference_workers=None):
+    """
+    Writes a copy of the configuration that replays one clip headless into work_dir.
+
+    :return: The path of the copy.
+    """
+    tree = ET.parse(config_path)
+    root = tree.getroot()
+
+    # One camera replaying the clip, every space watches it
+    data = root.find("data")
+    camera, *others = list(root.iter("camera"))
+    for other in others:
+        data.remove(other)
+    camera.text = os.path.abspath(clip)
+    camera.attrib = {"playback": "fast"}
+    for space in root.iter("space-definition"):
+        space.attrib.pop("camera", None)
+
+    settings = {"headless": "true", "target-fps": "0", "status": "success", "frame-bus": "false"}
+    if inference_workers is not None:
+        settings["inference-workers"] = str(inference_workers)
+    for tag in DATA_TAGS:
+        element = root.find(f".//{tag}")
+        if element is not None:
+            settings[tag] = os.path.join(work_dir, os.path.basename(element.text.strip()))
+    for tag, value in settings.items():
+        element = root.find(f".//{tag}")
+        if element is not None:
+            element.text = value
+
+    path = os.path.join(work_dir, "ParkitConfiguration.xml")
+    tree.write(path)
+    return path
+
+def run_clip(config_path, clip, inference_workers=None):
+    work_dir = tempfile.mkdtemp(prefix="parkit-benchmark-")
+    try:
+        config = benchmark_config(config_path, clip, work_dir, inference_workers)
+        report_path = os.path.join(work_dir, "run.json")
+        started = time.time()
+        process = subprocess.run([sys.executable, "src/ObjectOccupancyDetector.py",
+                                  "--config", config, "--benchmark", report_path])
+        if process.returncode != 0 or not os.path.exists(report_path):
+            return {"clip": clip, "error": f"detector exited with code {process.returncode}"}
+        with open(report_path, "r") as file:
+            report = json.load(file)
+        report["clip"] = clip
+        report["wall_seconds"] = round(time.time() - started, 3)
+        return report
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def compare(results, baseline, tolerance):
+    """
+    :return: A description of every clip that got slower than the tolerance.
+    """
+    previous = {run["clip"]: run for run in baseline["runs"] if "error" not in run}
+    regressions = []
+    for run in results["runs"]:
+        old = previous.get(run["clip"])
+        if old is None or "error" in run:
+            continue
+        if run["fps"] < old["fps"] * (1 - tolerance):
+            regressions.append(f"{run['clip']}: fps {old['fps']} -> {run['fps']}")
+        if run["latency_ms"] and old["latency_ms"] and run["latency_ms"]["p95"] > old["latency_ms"]["p95"] * (1 + tolerance):
+            regressions.append(f"{run['clip']}: p95 latency {old['latency_ms']['p95']} -> {run['latency_ms']['p95']} ms")
+    return regressions
+
+def kernel_benchmark(config_path, clip, downscales=(1, 2, 4), calls=200):
+    """
+    Times SpaceOccupancyEngine.check_occupation() and measures the memory allocated per call.
+
+    :return: One result per background mode and downscale factor.
+    """
+    from Adaptation import get_space_definitions
+    from FrameGrabber import open_source
+    from SpaceOccupancy import SpaceOccupancyEngine
+
+    cap = open_source(clip, "fast")
+    frames = []
+    while len(frames) < 20:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        return [{"clip": clip, "error": "no frames"}]
+    rects = [[space["x"], space["y"], space["width"], space["height"]] for space in get_space_definitions(config_path)]
+
+    results = []
+    for learning_rate in (0.0, 0.01):
+        for downscale in downscales:
+            engine = SpaceOccupancyEngine(rects, [0] * len(rects), learning_rate=learning_rate, downscale=downscale)
+            engine.update_reference(frames[0])
+            for frame in frames:
+                engine.check_occupation(frame, 0.0)
+
+            started = time.perf_counter()
+            for i in range(calls):
+                engine.check_occupation(frames[i % len(frames)], 0.0)
+            seconds = time.perf_counter() - started
+
+            # Largest amount of memory held at once during a call, on top of what was held before it
+            tracemalloc.start()
+            allocated = 0
+            for frame in frames:
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                engine.check_occupation(frame, 0.0)
+                allocated = max(allocated, tracemalloc.get_traced_memory()[1] - before)
+            tracemalloc.stop()
+
+            results.append({"clip": clip, "background": "adaptive" if engine.adaptive else "static",
+                            "downscale": downscale, "us_per_call": round(seconds / calls * 1e6, 1),
+                            "allocated_kb_per_call": round(allocated / 1024, 1)})
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Park It! pipeline benchmark")
+    parser.add_argument("clips", nargs="+", help="video files or directories of images")
+    parser.add_argument("--config", default="src/ParkitConfiguration.xml", help="configuration to start from")
+    parser.add_argument("--output", default="benchmark.json", help="JSON report to write")
+    parser.add_argument("--inference-workers", type=int, help="override the inference-workers setting")
+    parser.add_argument("--baseline", help="earlier JSON report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown against the baseline")
+    parser.add_argument("--kernel", action="store_true", help="only measure the occupancy check")
+    args = parser.parse_args()
+
+    if args.kernel:
+        results = {"created": time.strftime("%Y-%m-%d %H:%M:%S"), "kernel": []}
+        for clip in args.clips:
+            for run in kernel_benchmark(args.config, clip):
+                results["kernel"].append(run)
+                print(", ".join(f"{key}={value}" for key, value in run.items()))
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+        return 0
+
+    results = {"created": time.strftime("%Y-%m-%d %H:%M:%S"), "runs": []}
+    for clip in args.clips:
+        run = run_clip(args.config, clip, args.inference_workers)
+        results["runs"].append(run)
+        if "error" in run:
+            print(f"{clip}: {run['error']}")
+        else:
+            print(f"{clip}: {run['frames']} frames, {run['fps']} fps, latency {run['latency_ms']} ms, "
+                  f"{run['yolo_calls_per_minute']} YOLO calls/min")
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+'''
+
+        +----------------------------+
+        |      ParkitControl.py      |
+        +----------------------------+
+
+This module lets an operator control a running detector without a keyboard or a window, which
+is needed in headless server mode. Commands are written to a control file, one per line, e.g.
+
+    echo "select A2" >> src/data/parkit-control.txt
+    echo "left" >> src/data/parkit-control.txt
+
+The detector picks the file up, runs the commands in order and deletes it. Key presses in the
+video window are translated to the same commands, so both paths behave identically:
+
+    quit                    (q)  shut the system down
+    select next|<n>|<name>  (n)  select the space that is moved
+    up|down|left|right      (w/s/a/d)  move the selected space by its move-dist
+    reset                   (r)  take a new reference frame for every space
+    profile [s] [sampling]       profile the detector for s seconds, see ParkitMetrics.py
+    error                   (e)  raise a planned error, used to test the watch dog
+
+'''
+
+import os
+
+from Adaptation import log
+
+# Key presses in the video window and the command they stand for
+KEY_COMMANDS = {
+    'q': "quit",
+    'n': "select next",
+    'w': "up",
+    's': "down",
+    'a': "left",
+    'd': "right",
+    'r': "reset",
+    'e': "error",
+}
+
+def key_command(key):
+    """
+    :param key: The key code returned by cv2.waitKey.
+    :return: The command of the key, or None.
+    """
+    if key == 0xFF:
+        return None
+    return KEY_COMMANDS.get(chr(key))
+
+class ControlFile:
+    """
+    Reads commands from a control file.
+
+    :param file_path: The control file.
+    :param poll_interval: Minimum seconds between two checks for the file.
+    """
+
+    def __init__(self, file_path, poll_interval=0.5):
+        self.file_path = file_path
+        self.poll_interval = poll_interval
+        self.last_poll = 0
+
+    def poll(self, now):
+        """
+        :param now: The current time in seconds.
+        :return: The commands written since the last call.
+        """
+        if now - self.last_poll < self.poll_interval:
+            return []
+        self.last_poll = now
+
+        # Take the file away first so commands appended meanwhile end up in a new file
+        work_path = self.file_path + ".work"
+        try:
+            os.replace(self.file_path, work_path)
+        except FileNotFoundError:
+            return []
+
+        with open(work_path, 'r') as file:
+            commands = [line.strip() for line in file if line.strip()]
+        os.remove(work_path)
+        log(f"Control file: {len(commands)} command(s) received")
+        return commands
@@ -0,0 +1,268 @@
+'''
+
+        +----------------------------+
+        |      ParkitMetrics.py      |
+        +----------------------------+
+
+This module contains the instrumentation of the detector's hot path. Every stage of the main loop
+(capture, occupancy check, inference, CSV writes, analytics, graphs, display) is timed into a
+histogram and events are counted (frames, inferences, cache hits, file writes):
+
+    with metrics.stage("occupancy"):
+        occupied, timed_out = occupancy.check_occupation(frame, now)
+    metrics.count("frames")
+
+When metrics are disabled, stage() returns a shared object that does nothing, so the cost is a
+method call per stage. When enabled, a JSON snapshot is written every few seconds (next to
+data.txt, where get_latest_data.php picks it up) and optionally a Prometheus text file.
+
+A Profiler can be started on demand with the "profile" command of the control file, without
+restarting the detector. It either runs cProfile on the main loop or samples the stacks of every
+thread, and writes its report after the requested number of seconds.
+
+'''
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from datetime import datetime
+
+from Adaptation import log
+
+# Upper bounds of the histogram buckets in seconds, the last bucket takes everything above
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        # Upper bound of the bucket that holds the quantile, like Prometheus' histogram_quantile
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + (self.max,), self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {"count": self.count,
+                "total_ms": round(self.sum * 1000, 3),
+                "mean_ms": round(self.sum / self.count * 1000, 3) if self.count else 0,
+                "p50_ms": round(self.quantile(0.5) * 1000, 3),
+                "p95_ms": round(self.quantile(0.95) * 1000, 3),
+                "max_ms": round(self.max * 1000, 3)}
+
+class _Stage:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_STAGE = _NoStage()
+
+class Metrics:
+    """
+    Timing histograms and counters of the main loop.
+
+    :param enabled: Record anything at all.
+    :param file_path: The JSON snapshot.
+    :param prometheus_path: Optional Prometheus text file, empty or None to skip it.
+    :param interval: Seconds between two snapshots.
+    """
+
+    def __init__(self, enabled, file_path, prometheus_path=None, interval=5.0):
+        self.enabled = enabled
+        self.file_path = file_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.stages = {}
+        self.counters = Counter()
+        self.gauges = {}
+        self.started = time.time()
+        self.last_write = self.started
+
+    def stage(self, name):
+        if not self.enabled:
+            return NO_STAGE
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stages[name] = Histogram()
+        return _Stage(histogram)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+
+    def gauge(self, name, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        uptime = time.time() - self.started
+        return {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "uptime": round(uptime, 1),
+                "fps": round(self.counters["frames"] / uptime, 2) if uptime > 0 else 0,
+                "stages": {name: histogram.summary() for name, histogram in self.stages.items()},
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges)}
+
+    def maybe_write(self, now):
+        """
+        Writes the snapshot files if the interval passed.
+        """
+        if not self.enabled or now - self.last_write < self.interval:
+            return
+        self.last_write = now
+        self.write()
+
+    def write(self):
+        if not self.enabled:
+            return
+        write_atomic(self.file_path, json.dumps(self.snapshot(), indent=2))
+        if self.prometheus_path:
+            write_atomic(self.prometheus_path, self.prometheus_text())
+
+    def prometheus_text(self):
+        lines = ["# TYPE parkit_stage_seconds histogram"]
+        for name, histogram in self.stages.items():
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'parkit_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'parkit_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {histogram.count}')
+            lines.append(f'parkit_stage_seconds_sum{{stage="{name}"}} {histogram.sum:.6f}')
+            lines.append(f'parkit_stage_seconds_count{{stage="{name}"}} {histogram.count}')
+        lines.append("# TYPE parkit_events_total counter")
+        for name, value in self.counters.items():
+            lines.append(f'parkit_events_total{{event="{name}"}} {value}')
+        lines.append("# TYPE parkit_gauge gauge")
+        for name, value in self.gauges.items():
+            lines.append(f'parkit_gauge{{name="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+def write_atomic(file_path, text):
+    # Readers never see a half written file
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, "w") as file:
+        file.write(text)
+    os.replace(temp_path, file_path)
+
+class Profiler:
+    """
+    On-demand profiler of a running detector.
+
+    :param path_prefix: Reports are written to <path_prefix>-<date>.txt (and .prof or .folded).
+    """
+
+    def __init__(self, path_prefix):
+        self.path_prefix = path_prefix
+        self.mode = None
+        self.stop_at = 0
+        self.profile = None
+        self.samples = None
+        self.thread = None
+
+    def start(self, seconds=30.0, mode="cprofile"):
+        """
+        :param seconds: How long to profile.
+        :param mode: "cprofile" profiles every call of the calling (main) thread, "sampling"
+                     records the stacks of every thread 100 times per second.
+        """
+        if self.mode is not None:
+            log("Profiler: already running", "WARNING")
+            return
+        self.mode = mode
+        self.stop_at = time.time() + seconds
+        if mode == "sampling":
+            self.samples = Counter()
+            self.thread = threading.Thread(target=self._sample, name="Profiler", daemon=True)
+            self.thread.start()
+        else:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        log(f"Profiler: {mode} started for {seconds} seconds")
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        while self.mode == "sampling":
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(stack))] += 1
+            time.sleep(0.01)
+
+    def poll(self, now):
+        """
+        Stops the profiler and writes the report once the time is up. Called from the main loop.
+        """
+        if self.mode is None or now < self.stop_at:
+            return
+        prefix = f"{self.path_prefix}-{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}"
+        mode = self.mode
+        self.mode = None
+        if mode == "sampling":
+            self.thread.join()
+            # Collapsed stacks, the input format of flame graph tools
+            with open(prefix + ".folded", "w") as file:
+                for stack, count in self.samples.most_common():
+                    file.write(f"{stack} {count}\n")
+            leaves = Counter()
+            for stack, count in self.samples.items():
+                leaves[stack.rsplit(";", 1)[-1]] += count
+            total = sum(leaves.values()) or 1
+            with open(prefix + ".txt", "w") as file:
+                for leaf, count in leaves.most_common(30):
+                    file.write(f"{count / total * 100:6.2f}%  {leaf}\n")
+            self.samples = None
+        else:
+            self.profile.disable()
+            self.profile.dump_stats(prefix + ".prof")
+            text = io.StringIO()
+            pstats.Stats(self.profile, stream=text).sort_stats("cumulative").print_stats(30)
+            with open(prefix + ".txt", "w") as file:
+                file.write(text.getvalue())
+            self.profile = None
+        log(f"Profiler: {mode} report written to {prefix}.txt")
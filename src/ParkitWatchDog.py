@@ -7,17 +7,38 @@
 This Python script serves as a watchdog for the Parkit system. It monitors the execution of 
 the main script 'ObjectOccupancyDetector.py', restarts it if it crashes, and logs system events. 
 The watchdog ensures that the system runs smoothly and handles any unexpected errors gracefully.
+
+With several cameras the watch dog supervises a group of processes:
+
+    - one capture process per camera publishing frames to the shared-memory frame bus (FrameBus.py),
+      if <frame-bus> is enabled
+    - <analysis-workers> detector processes, each analysing its own share of the cameras
+    - one model host keeping the YOLOv5 models loaded (ModelHost.py), if <model-host> is enabled,
+      so a restarted detector does not load the weights again
+    - one live server pushing the status to the web pages (LiveServer.py), if <live-server> is
+      enabled
+
+Every process is restarted on its own with an exponential backoff. A detector that exits normally
+(quit) shuts the whole system down. A health report of all processes is written every few seconds.
         
 '''
 
 from datetime import datetime
-import shutil
+import json
+import secrets
 import subprocess
 import time
 import os
 import xml.etree.ElementTree as ET
-from Adaptation import get_value_from_tag, update_xml_tag_value, log, write_text_to_file, append_text_to_file
-from CSVConvertGraphs import append_file_to_file
+from Adaptation import configure_logger, get_config, get_value_from_tag, get_camera_definitions, get_inference_model, get_space_definitions, space_file_path, update_xml_tag_value, log, write_text_to_file, append_text_to_file
+from HistoryStore import HistoryStore
+from RollupStore import RollupStore
+from GalleryIndex import GalleryIndex
+from StatusRecord import StatusRecord, status_record_location
+from ParkitAnalytics import OccupancyAnalytics
+from FrameBus import read_ring_status, ring_path
+from InferencePool import HOST_AUTHKEY_VARIABLE
+from LiveServer import LivePublisher
 
 def get_formatted_datetime():
     # Get current date and time
@@ -27,33 +48,93 @@ def get_formatted_datetime():
     return datetime_string
 
 
-def copy_and_rename_file(source, destination):
-    try:
-        # Move and rename the file
-        shutil.copy(source, destination)
-        log(f"File moved and renamed from {source} to {destination}")
-    except FileNotFoundError:
-        print("The source file does not exist.")
-    except Exception as e:
-        print(f"An error occurred: {e}")
+sys_config            = "src/ParkitConfiguration.xml"
+config                = get_config(sys_config)
+configure_logger(config.get("log-file-location", default="src/data/parkit.log"),
+                 config.get("log-level", default="INFO"))
 
 now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 log(f"Watch dog started at {now}")
 
-sys_config            = "src/ParkitConfiguration.xml"
 main_script           = "src/ObjectOccupancyDetector.py"
+capture_script        = "src/FrameBus.py"
+model_host_script     = "src/ModelHost.py"
+live_server_script    = "src/LiveServer.py"
 csv_file              = get_value_from_tag(sys_config, "csv-file-location")
 csv_columns           = get_value_from_tag(sys_config, "csv-column-names")
+if config.get("recording-mode", default="samples") == "events":
+    csv_columns      += ",endDateTime,samples"
 target_total_csv      = get_value_from_tag(sys_config, "total-csv-location")
+history_location      = get_value_from_tag(sys_config, "history-location")
 output_stream         = get_value_from_tag(sys_config, "system-output-location")
 log_file_location     = get_value_from_tag(sys_config, "log-file-location")
 gallery_location      = get_value_from_tag(sys_config, "gallery-location")
 graph_file_location   = get_value_from_tag(sys_config, "data-analytics-graph")
 streak_file_location  = get_value_from_tag(sys_config, "streak-file-location")
 optimal_file_location = get_value_from_tag(sys_config, "optimal-file-location")
-graph_base_name       = os.path.basename(graph_file_location)[0:-4]
+space_definitions     = get_space_definitions(sys_config)
+space_names           = [space["name"] for space in space_definitions]
+
+# Gallery - every stop adds one graph per space, the oldest ones are removed beyond these limits
+gallery_max_snapshots = config.get("gallery-max-snapshots", int, 0)
+gallery_max_megabytes = config.get("gallery-max-megabytes", float, 0.0)
+gallery_max_days      = config.get("gallery-max-days", float, 0.0)
+
+# Process layout: cameras without spaces are not started
+frame_bus             = config.get("frame-bus", default="false").lower() == "true"
+frame_bus_location    = config.get("frame-bus-location", default="/dev/shm")
+health_file_location  = config.get("health-file-location", default="src/data/parkit-health.json")
+cameras               = [camera for camera in get_camera_definitions(sys_config)
+                         if any(space["camera"] == camera["index"] for space in space_definitions)]
+analysis_workers      = max(1, min(config.get("analysis-workers", int, 1), len(cameras)))
+if frame_bus and not os.path.isdir(frame_bus_location):
+    frame_bus_location = "src/data"
+model_host            = config.get("model-host", default="false").lower() == "true"
+model_host_socket     = config.get("model-host-socket", default="src/data/parkit-model.sock")
+live_server           = config.get("live-server", default="false").lower() == "true"
+live_server_socket    = config.get("live-server-socket", default="src/data/parkit-live.sock")
+live                  = LivePublisher(live_server_socket if live_server else None)
+record_location       = status_record_location(config)
+
+def gallery_graph_name(space_name):
+    graph_base_name = os.path.basename(space_file_path(graph_file_location, space_name))[0:-4]
+    return graph_base_name + "-" + get_formatted_datetime() + ".png"
 
-gallery_graph         = gallery_location + "/" + graph_base_name + "-" + get_formatted_datetime() + ".png"
+def session_summary(space_name):
+    # Statistics of the session shown by the graph, kept in the gallery manifest
+    space_csv = space_file_path(csv_file, space_name)
+    if not os.path.exists(space_csv):
+        return {}
+    analytics = OccupancyAnalytics(keep_samples=False)
+    samples = analytics.bootstrap(space_csv)
+    occupied, vacant, best_time = analytics.find_best_time_to_park_and_analytics().split(",")
+    return {"samples": samples, "occupied_percentage": float(occupied), "vacant_percentage": float(vacant),
+            "best_time": best_time, "longest_streak": analytics.find_longest_streak()}
+
+def archive_graphs():
+    for name in space_names:
+        try:
+            gallery.add(space_file_path(graph_file_location, name), gallery_graph_name(name), name,
+                        summary=session_summary(name))
+        except Exception as e:
+            log(f"Gallery: could not archive the graph of {name or 'the space'}: {e}", "ERROR")
+    gallery.enforce_retention(gallery_max_snapshots, gallery_max_megabytes * 1024 * 1024, gallery_max_days)
+
+def write_loading_status(names=space_names):
+    for name in names:
+        write_text_to_file(space_file_path(output_stream, name), "Park-It is loading... ")
+        write_text_to_file(space_file_path(streak_file_location, name), "No Streak Available.")
+        status_record.write(name, data="Park-It is loading... ", streak="No Streak Available.")
+        live.publish("status", name, data="Park-It is loading... ")
+        live.publish("analytics", name, streak="No Streak Available.")
+
+def remove_status_files(names=space_names):
+    for name in names:
+        for path in (space_file_path(output_stream, name), space_file_path(streak_file_location, name)):
+            if os.path.exists(path):
+                os.remove(path)
+        status_record.write(name, data=None, streak=None)
+        live.publish("status", name, data=None)
 
 # Added protection as RunParkit script already performs this check.
 current_directory = os.path.basename(os.getcwd())
@@ -69,51 +150,205 @@ elif 'src' not in all_items:
     log("There was an error finding src directory.")
     exit()
 
-# Create CSV file and give column names
-if not os.path.exists(csv_file):
-    append_text_to_file(csv_file,csv_columns)
-else:
-    append_file_to_file(csv_file, target_total_csv)
-    os.remove(csv_file)
-    
+# Merge the last session of every space into the history store, then create the CSV file and
+# give column names. A total CSV of an older version is imported once and kept as .imported.
+history = HistoryStore(history_location)
+for name in space_names:
+    total_csv = space_file_path(target_total_csv, name)
+    if os.path.exists(total_csv):
+        history.import_csv(total_csv, name)
+        os.replace(total_csv, total_csv + ".imported")
+    space_csv = space_file_path(csv_file, name)
+    if os.path.exists(space_csv):
+        history.import_csv(space_csv, name)
+        os.remove(space_csv)
+    append_text_to_file(space_csv, csv_columns)
+
+# Roll up the merged rows, the detectors read the best time to park from the rollups
+rollups = RollupStore(history)
+for name in space_names:
+    rollups.update(name)
+
+
+# A gallery of an older version has no manifest yet
+gallery = GalleryIndex(gallery_location, config.get("gallery-thumbnail-width", int, 320))
+if not os.path.exists(gallery.manifest_path):
+    gallery.rebuild()
+
+# The status of every space in shared memory, written by the detectors
+status_record = StatusRecord.create(record_location, space_names)
 
 # Make sure there is a log file
 if not os.path.exists(log_file_location):
     open(log_file_location, "x")
 
+class ChildProcess:
+    """
+    A supervised process with its own restart backoff.
+
+    :param name: Name used in the log and the health report.
+    :param command: The command line of the process.
+    :param space_names: The spaces whose status the process writes, empty for capture processes.
+    :param ready_path: A socket the process opens once it is ready, the start waits up to 10 seconds for it.
+    """
+
+    def __init__(self, name, command, space_names=(), ready_path=None):
+        self.name = name
+        self.command = command
+        self.space_names = list(space_names)
+        self.ready_path = ready_path
+        self.process = None
+        self.started_at = 0
+        self.restart_at = 0
+        self.backoff = 3
+        self.restarts = 0
+
+    def start(self, restarted=False):
+        # A restarted detector continues with its saved reference frame
+        command = self.command + (["--restart"] if restarted and self.space_names else [])
+        # A socket left behind by a crash does not count as ready
+        if self.ready_path and os.path.exists(self.ready_path):
+            os.remove(self.ready_path)
+        self.process = subprocess.Popen(command)
+        self.started_at = time.time()
+        log(f"{self.name} started (pid {self.process.pid})")
+        deadline = time.time() + 10
+        while self.ready_path and not os.path.exists(self.ready_path) and time.time() < deadline and self.process.poll() is None:
+            time.sleep(0.1)
+        if self.space_names:
+            write_loading_status(self.space_names)
+
+    def crashed(self, returncode):
+        # Back off exponentially while the process keeps crashing, start over once it ran for a minute
+        if time.time() - self.started_at > 60:
+            self.backoff = 3
+        self.process = None
+        self.restart_at = time.time() + self.backoff
+        log(f"{self.name} crashed with code {returncode}. Restarting in {self.backoff}s...", "ERROR")
+        self.backoff = min(self.backoff * 2, 60)
+        self.restarts += 1
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+    def health(self):
+        running = self.process is not None and self.process.poll() is None
+        return {"name": self.name, "running": running, "pid": self.process.pid if running else None,
+                "uptime": round(time.time() - self.started_at, 1) if running else 0, "restarts": self.restarts}
+
+def remove_frame_bus():
+    for camera in cameras:
+        path = ring_path(frame_bus_location, camera["index"])
+        if frame_bus and os.path.exists(path):
+            os.remove(path)
+
+def remove_sockets():
+    for enabled, path in ((model_host, model_host_socket), (live_server, live_server_socket)):
+        if enabled and os.path.exists(path):
+            os.remove(path)
+
+def write_health_report(children):
+    report = {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+              "processes": [child.health() for child in children],
+              "spaces": status_record.snapshot()}
+    if frame_bus:
+        report["cameras"] = {camera["name"]: read_ring_status(ring_path(frame_bus_location, camera["index"]))
+                             for camera in cameras}
+    temp_path = health_file_location + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(report, file, indent=2)
+    os.replace(temp_path, health_file_location)
+    log(f"Health: {report}", "DEBUG")
+
+# Capture processes publish the frames, the model host serves the detections and the cameras are
+# shared round-robin between the workers
+children = []
+if live_server:
+    # Detectors only publish to a server that already listens
+    children.append(ChildProcess("Live server", ['python', live_server_script, sys_config], ready_path=live_server_socket))
+if model_host:
+    # Children inherit the key of the model host socket
+    os.environ[HOST_AUTHKEY_VARIABLE] = secrets.token_hex(16)
+    inference_model = get_inference_model(sys_config)
+    children.append(ChildProcess("Model host",
+                                 ['python', model_host_script, model_host_socket, inference_model["backend"],
+                                  inference_model["model"], inference_model["device"], str(inference_model["input_size"]),
+                                  config.get("inference-workers", default="auto"), config.get("min-confidence", default="0"),
+                                  config.get("model-load-timeout", default="300")]))
+if frame_bus:
+    for camera in cameras:
+        children.append(ChildProcess(f"Capture {camera['name']}",
+                                     ['python', capture_script, camera["source"], ring_path(frame_bus_location, camera["index"])]))
+for worker in range(analysis_workers):
+    group = [camera["index"] for camera in cameras[worker::analysis_workers]]
+    command = ['python', main_script, "--cameras", ",".join(str(index) for index in group)]
+    if frame_bus:
+        command += ["--frame-bus", frame_bus_location]
+    if model_host:
+        command += ["--model-host", model_host_socket]
+    children.append(ChildProcess(f"Detector {worker}", command,
+                                 [space["name"] for space in space_definitions if space["camera"] in group]))
+
 # Catch only keyboard exceptions so user can manually kill the process
 try:
-    while True:
-        process = subprocess.Popen(['python', main_script])
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log(f"System started at {now}")
-
-        write_text_to_file(output_stream, "Park-It is loading... ")
-        write_text_to_file(streak_file_location, "No Streak Available.")
-        process.wait()
-        # Once process finishes, check its return code, then handle
-        if process.returncode != 0:
-            print("System crashed. Restarting...")
-            update_xml_tag_value(sys_config, "status", "failed")
-            log("System crashed. Restarting...")
-            # Clean up
-            os.remove(output_stream)
-            os.remove(streak_file_location)
-            time.sleep(3)  
-        else:
-            update_xml_tag_value(sys_config, "status", "success")
-            log("System exiting safely...")
-            copy_and_rename_file(graph_file_location, gallery_graph)
-            # Clean up
-            os.remove(output_stream)
-            os.remove(streak_file_location)
-            break 
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    log(f"System started at {now}: {len(cameras)} camera(s), {analysis_workers} detector(s), frame-bus={frame_bus}, "
+        f"model-host={model_host}, live-server={live_server}")
+    for child in children:
+        child.start()
+
+    health_timer = 0
+    running = True
+    while running:
+        time.sleep(0.5)
+        for child in children:
+            if child.process is None:
+                if time.time() >= child.restart_at:
+                    child.start(restarted=True)
+                continue
+
+            returncode = child.process.poll()
+            if returncode is None:
+                continue
+            # Once a process finishes, check its return code, then handle
+            if returncode == 0 and child.space_names:
+                # The user quit the system
+                running = False
+                break
+            print(f"{child.name} crashed. Restarting...")
+            if child.space_names:
+                update_xml_tag_value(sys_config, "status", "failed")
+                # Clean up
+                remove_status_files(child.space_names)
+            child.crashed(returncode)
+
+        if running and time.time() - health_timer > 5:
+            health_timer = time.time()
+            write_health_report(children)
+
+    for child in children:
+        child.stop()
+    update_xml_tag_value(sys_config, "status", "success")
+    log("System exiting safely...")
+    archive_graphs()
+    # Clean up
+    remove_status_files()
+    remove_frame_bus()
+    remove_sockets()
 except KeyboardInterrupt:
     # Log the keyboard interrupt
-    log("System terminated with force. Keyboard interrupt.")
+    log("System terminated with force. Keyboard interrupt.", "WARNING")
     print("Program terminated by user.")
-    
-    copy_and_rename_file(graph_file_location, gallery_graph)
-    os.remove(output_stream)
-    os.remove(streak_file_location)
 
+    for child in children:
+        child.stop()
+    archive_graphs()
+    remove_status_files()
+    remove_frame_bus()
+    remove_sockets()
@@ -0,0 +1,218 @@
+'''
+
+        +----------------------------+
+        |       RollupStore.py       |
+        +----------------------------+
+
+This module keeps the occupancy history pre-aggregated, so the best time to park is found
+without reading every row of the history store:
+
+    <history-location>/rollup/
+        state.json          time of the last row rolled up, per space
+        <space id>/
+            2024-05.i4      31 days x 96 fifteen-minute slots x (occupied, vacant) seconds
+
+Every row adds the time since the previous row of its space to the slot of its own time, as
+occupied or vacant seconds depending on the car status of the row. Gaps of more than 5 minutes
+are not counted. These are the rules of find_best_time_to_park_and_analytics() of
+OccupancyAnalytics in ParkitAnalytics.py, so the best time over all cells is the same as over all
+rows, and the text of optimal.txt does not change.
+
+The watch dog rolls up the rows it has merged into the history store after every session, only
+the rows after the last rolled up one. Queries over any range of days, optionally only some
+days of the week, read at most 31 x 96 cells per month:
+
+    python src/RollupStore.py rebuild <history dir>
+    python src/RollupStore.py best <history dir> [space] [weekday 0-6]
+
+'''
+
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+from Adaptation import log
+from HistoryStore import CAR_BIT, HistoryStore
+
+SLOTS = 96
+SLOT_SECONDS = 900
+# Allowed gap between two rows, compared like timedelta.seconds
+MAX_GAP = 300
+CELL_DTYPE = np.dtype("<i4")
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+def format_best_time(occupied, vacant):
+    """
+    :param occupied: Occupied seconds per slot.
+    :param vacant: Vacant seconds per slot.
+    :return: "occupied%,unoccupied%,HH:MM", like OccupancyAnalytics.find_best_time_to_park_and_analytics().
+    """
+    total_time = int(occupied.sum() + vacant.sum())
+    unoccupied_time = int(vacant.sum())
+    occupied_time = total_time - unoccupied_time
+    occupied_percentage = (occupied_time / total_time * 100) if total_time > 0 else 0
+    unoccupied_percentage = (unoccupied_time / total_time * 100) if total_time > 0 else 0
+    # The first slot wins a tie
+    best_slot = int(np.argmax(vacant))
+    return f"{occupied_percentage:.2f},{unoccupied_percentage:.2f},{best_slot // 4:02}:{best_slot % 4 * 15:02}"
+
+class RollupStore:
+    """
+    Occupied and vacant seconds per space, day and 15-minute slot.
+
+    :param history: The HistoryStore whose rows are rolled up. Space ids are shared with it.
+    """
+
+    def __init__(self, history):
+        self.history = history
+        self.directory = os.path.join(history.directory, "rollup")
+        self.state_path = os.path.join(self.directory, "state.json")
+        os.makedirs(self.directory, exist_ok=True)
+        self.state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as file:
+                self.state = json.load(file)
+
+    def _month_path(self, space_id, month):
+        return os.path.join(self.directory, str(space_id), f"{month}.i4")
+
+    def _load(self, space_id, month):
+        path = self._month_path(space_id, month)
+        if not os.path.exists(path):
+            return np.zeros((31, SLOTS, 2), dtype=CELL_DTYPE)
+        return np.fromfile(path, dtype=CELL_DTYPE).reshape(31, SLOTS, 2)
+
+    def _save_state(self):
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.state, file)
+        os.replace(temp_path, self.state_path)
+
+    def update(self, space):
+        """
+        Rolls up the history rows of a space that came after the last rolled up row.
+
+        :param space: The space name, None for the unnamed space.
+        :return: The number of rows rolled up.
+        """
+        space = space or ""
+        space_id = self.history.space_id(space)
+        if space_id is None:
+            return 0
+        last = self.state.get(space)
+        rows = self.history.query(space, None if last is None else np.datetime64(last + 1, "s"))
+        if len(rows.time) == 0:
+            return 0
+        order = np.argsort(rows.time, kind="stable")
+        seconds = rows.time[order].view(np.int64)
+        car_present = (rows.status[order] & CAR_BIT) > 0
+
+        # The interval before every row, the first row of the space has none
+        previous = np.concatenate([[seconds[0] if last is None else last], seconds[:-1]])
+        interval = seconds - previous
+        interval[interval % 86400 > MAX_GAP] = 0
+        vacant = np.where(car_present, 0, interval)
+
+        # The rows are in time order, so every month is one run of them
+        days = seconds // 86400
+        months = days.astype("datetime64[D]").astype("datetime64[M]")
+        bounds = np.flatnonzero(months[1:] != months[:-1]) + 1
+        for first, last in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(seconds)]])):
+            month = months[first]
+            cells = self._load(space_id, str(month))
+            day_of_month = days[first:last] - month.astype("datetime64[D]").astype(np.int64)
+            cell = (day_of_month * SLOTS + seconds[first:last] % 86400 // SLOT_SECONDS) * 2
+            cells += (np.bincount(cell, weights=interval[first:last] - vacant[first:last], minlength=cells.size)
+                      + np.bincount(cell + 1, weights=vacant[first:last], minlength=cells.size)).astype(CELL_DTYPE).reshape(cells.shape)
+            path = self._month_path(space_id, str(month))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            cells.tofile(path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+        self.state[space] = int(seconds[-1])
+        self._save_state()
+        log(f"RollupStore: rolled up {len(seconds)} rows of {space or 'space'}")
+        return len(seconds)
+
+    def cells(self, space, start=None, end=None, weekdays=None):
+        """
+        :param space: The space name, None for the unnamed space.
+        :param start: First day included, a date or "YYYY-MM-DD".
+        :param end: First day excluded.
+        :param weekdays: Only these days of the week, 0 is Monday.
+        :return: The days (datetime64[D]) and their cells, days x 96 slots x (occupied, vacant).
+        """
+        space_id = self.history.space_id(space)
+        folder = os.path.join(self.directory, str(space_id))
+        if space_id is None or not os.path.isdir(folder):
+            return np.empty(0, dtype="datetime64[D]"), np.zeros((0, SLOTS, 2), dtype=np.int64)
+        start = None if start is None else np.datetime64(start, "D")
+        end = None if end is None else np.datetime64(end, "D")
+
+        days, cells = [], []
+        for name in sorted(os.listdir(folder)):
+            if not name.endswith(".i4"):
+                continue
+            month = np.datetime64(name[:-3], "M")
+            month_days = np.arange(month.astype("datetime64[D]"), (month + 1).astype("datetime64[D]"))
+            wanted = np.ones(len(month_days), dtype=bool)
+            if start is not None:
+                wanted &= month_days >= start
+            if end is not None:
+                wanted &= month_days < end
+            if weekdays is not None:
+                # 1970-01-01 was a Thursday
+                wanted &= np.isin((month_days.astype(np.int64) + 3) % 7, list(weekdays))
+            if not wanted.any():
+                continue
+            days.append(month_days[wanted])
+            cells.append(self._load(space_id, name[:-3])[:len(month_days)][wanted])
+        if not days:
+            return np.empty(0, dtype="datetime64[D]"), np.zeros((0, SLOTS, 2), dtype=np.int64)
+        return np.concatenate(days), np.concatenate(cells).astype(np.int64)
+
+    def best_time(self, space, start=None, end=None, weekdays=None):
+        """
+        :return: "occupied%,unoccupied%,HH:MM" over the selected days, the format of optimal.txt.
+        """
+        _, cells = self.cells(space, start, end, weekdays)
+        totals = cells.sum(axis=0)
+        return format_best_time(totals[:, 0], totals[:, 1])
+
+    def weekday_profile(self, space, start=None, end=None):
+        """
+        :return: Occupied fraction per day of the week and hour, 7 x 24 (NaN without data).
+        """
+        days, cells = self.cells(space, start, end)
+        weekday = (days.astype(np.int64) + 3) % 7
+        totals = np.zeros((7, 24, 2), dtype=np.int64)
+        np.add.at(totals, weekday, cells.reshape(len(days), 24, 4, 2).sum(axis=2))
+        seconds = totals.sum(axis=2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(seconds > 0, totals[:, :, 0] / seconds, np.nan)
+
+    def rebuild(self, spaces=None):
+        """
+        Rolls up the whole history again, e.g. after rows older than the last rolled up one were
+        imported.
+        """
+        shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        self.state = {}
+        for space in (spaces if spaces is not None else self.history.space_names):
+            self.update(space)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("rebuild", "best"):
+        print("Usage: python src/RollupStore.py rebuild|best <history dir> [space] [weekday 0-6]")
+        sys.exit(1)
+    rollups = RollupStore(HistoryStore(sys.argv[2]))
+    if sys.argv[1] == "rebuild":
+        rollups.rebuild()
+    else:
+        space_name = sys.argv[3] if len(sys.argv) > 3 else ""
+        weekday = [int(sys.argv[4])] if len(sys.argv) > 4 else None
+        print(rollups.best_time(space_name, weekdays=weekday))
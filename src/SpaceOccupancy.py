@@ -0,0 +1,345 @@
+'''
+
+        +----------------------------+
+        |     SpaceOccupancy.py      |
+        +----------------------------+
+
+This module contains the multi-space version of the Space Occupancy Monitor. All configured
+parking spaces are checked in one batched OpenCV/NumPy pass per frame:
+
+    1. The bounding box that covers every space is converted to grayscale (and optionally
+       downscaled) once, and a single absdiff/threshold against the grayscale reference is run.
+    2. An integral image of the thresholded difference gives the changed pixel count of every
+       space with four lookups, without looping over the spaces in Python.
+
+Every intermediate image is written into buffers that are allocated when the spaces change, so a
+check does not allocate memory proportional to the frame.
+
+Each space keeps its own occupied timer and confirmed state. The cost per frame is driven by
+the size of the covered area, not by the number of spaces.
+
+With a learning rate above 0 the static reference frame is replaced by an adaptive background
+model: a running mean and variance of every grayscale pixel, learned only while the space is
+vacant. A pixel counts as changed if it differs from the mean by more than the pixel threshold and
+by more than noise_factor standard deviations, after the brightness gain of the whole picture
+(camera auto exposure, dusk) has been taken out. Slow light changes over the day are absorbed into the
+background instead of starting the occupied timer and a YOLOv5 call.
+
+'''
+
+import cv2
+import numpy as np
+
+class ParkingSpace:
+    """
+    Per-space status and output files used by the main loop.
+    """
+
+    def __init__(self, name, rect, move_dist, occupied_timer):
+        self.name = name
+        self.rect = list(rect)
+        self.move_dist = move_dist
+        self.occupied_timer = occupied_timer
+
+        # System Status Messages
+        self.msg_occu = ""
+        self.msg_car = ""
+        self.last_occu = ""
+        self.last_car = ""
+
+        # Latest car boxes from the detector, None until the first detection arrives.
+        # The generation changes whenever the detection is dropped, so late results are ignored.
+        self.car_boxes = None
+        self.generation = 0
+        # Earliest time of the next YOLOv5 request of the space
+        self.next_inference = 0.0
+
+    @property
+    def label(self):
+        return self.name if self.name else "space"
+
+class SpaceOccupancyEngine:
+    """
+    Checks the occupancy of many rectangles with one pass over the frame.
+
+    :param rects: A list of [x, y, width, height] rectangles.
+    :param occupied_timers: Seconds a space has to stay occupied before it is confirmed.
+    :param pixel_threshold: Intensity difference for a pixel to count as changed.
+    :param area_ratio: Fraction of changed pixels for a space to count as occupied.
+    :param learning_rate: Weight of a new frame in the adaptive background model, 0 keeps a static
+                          reference frame.
+    :param noise_factor: Standard deviations of a pixel that still count as background.
+    :param exposure_compensation: Remove brightness changes of the whole picture before comparing.
+    :param downscale: The frame is compared at 1/downscale of its width and height.
+    """
+
+    def __init__(self, rects, occupied_timers, pixel_threshold=25, area_ratio=0.1,
+                 learning_rate=0.0, noise_factor=3.0, exposure_compensation=True, downscale=1):
+        self.pixel_threshold = pixel_threshold
+        self.area_ratio = area_ratio
+        self.learning_rate = learning_rate
+        self.adaptive = learning_rate > 0
+        self.noise_factor = noise_factor
+        self.exposure_compensation = exposure_compensation
+        self.downscale = max(int(downscale), 1)
+        self.occupied_timers = np.asarray(occupied_timers, dtype=np.float64)
+
+        count = len(rects)
+        self.occupied_start_time = np.full(count, np.nan)
+        self.confirmed_occupied = np.zeros(count, dtype=bool)
+        self.needs_reference = np.ones(count, dtype=bool)
+
+        self.rects = None
+        self.bbox = None
+        self.shape = None
+        # Grayscale reference pixels, or the background mean of the adaptive model
+        self.reference_frame = None
+        self.variance = None
+        self.last_diff = None
+        self.last_residual = None
+        self.last_changed = None
+        self.set_rects(rects)
+
+    def set_rects(self, rects):
+        """
+        Replaces the space rectangles. The reference pixels of spaces that did not move are kept.
+        """
+        rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+        x0 = int(rects[:, 0].min())
+        y0 = int(rects[:, 1].min())
+        x1 = int((rects[:, 0] + rects[:, 2]).max())
+        y1 = int((rects[:, 1] + rects[:, 3]).max())
+        bbox = (x0, y0, x1, y1)
+
+        # Corners of every space relative to the (downscaled) bounding box, used on the integral image
+        scale = self.downscale
+        shape = (max((y1 - y0) // scale, 1), max((x1 - x0) // scale, 1))
+        left = (rects[:, 0] - x0) // scale
+        top = (rects[:, 1] - y0) // scale
+        right = np.maximum(np.minimum((rects[:, 0] + rects[:, 2] - x0) // scale, shape[1]), left + 1)
+        bottom = np.maximum(np.minimum((rects[:, 1] + rects[:, 3] - y0) // scale, shape[0]), top + 1)
+
+        if self.rects is not None:
+            moved = np.any(rects != self.rects, axis=1)
+            self.needs_reference |= moved
+
+        if self.reference_frame is not None and bbox != self.bbox:
+            # Move the stored reference pixels into the new bounding box
+            self.reference_frame = self._move_pixels(self.reference_frame, shape, top, left)
+            if self.variance is not None:
+                self.variance = self._move_pixels(self.variance, shape, top, left)
+
+        self.rects = rects
+        self.bbox = bbox
+        self.left, self.top, self.right, self.bottom = left, top, right, bottom
+        self.area_limit = (right - left) * (bottom - top) * self.area_ratio
+        # The grayscale buffer has the full size of the bounding box, which can change while the
+        # downscaled shape stays the same
+        if shape != self.shape or self.gray.shape != (y1 - y0, x1 - x0):
+            self.shape = shape
+            self._allocate()
+
+    def _allocate(self):
+        # Every intermediate of a check is written into these buffers, a check allocates no frames
+        x0, y0, x1, y1 = self.bbox
+        self.gray = np.empty((y1 - y0, x1 - x0), dtype=np.uint8)
+        self.small = np.empty(self.shape, dtype=np.uint8) if self.downscale > 1 else self.gray
+        self.changed = np.empty(self.shape, dtype=np.uint8)
+        self.integral = np.empty((self.shape[0] + 1, self.shape[1] + 1), dtype=np.int32)
+        if self.adaptive:
+            self.gray_float = np.empty(self.shape, dtype=np.float32)
+            self.diff = np.empty(self.shape, dtype=np.float32)
+            self.residual = np.empty(self.shape, dtype=np.float32)
+            self.squared = np.empty(self.shape, dtype=np.float32)
+            self.limit = np.empty(self.shape, dtype=np.float32)
+            self.scratch = np.empty(self.shape, dtype=np.float32)
+            self.learn = np.empty(self.shape, dtype=np.uint8)
+            self.unlearned = np.empty(self.shape, dtype=np.uint8)
+        else:
+            self.diff = np.empty(self.shape, dtype=np.uint8)
+
+    def _move_pixels(self, pixels, shape, top, left):
+        moved = np.zeros(shape, dtype=pixels.dtype)
+        for i in np.flatnonzero(~self.needs_reference):
+            # Downscaled spaces may differ by a pixel at another offset
+            h = min(self.bottom[i] - self.top[i], shape[0] - top[i])
+            w = min(self.right[i] - self.left[i], shape[1] - left[i])
+            moved[top[i]:top[i]+h, left[i]:left[i]+w] = \
+                pixels[self.top[i]:self.top[i]+h, self.left[i]:self.left[i]+w]
+        return moved
+
+    def _grayscale(self, roi):
+        """
+        :param roi: The bounding box of the spaces in a BGR frame.
+        :return: The bounding box in grayscale and downscaled, in a reused buffer.
+        """
+        cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        if self.downscale > 1:
+            cv2.resize(self.gray, (self.shape[1], self.shape[0]), dst=self.small, interpolation=cv2.INTER_AREA)
+        return self.small
+
+    def reset_reference(self, index=None):
+        """
+        Requests a new reference for one space, or for every space if no index is given.
+        """
+        if index is None:
+            self.needs_reference[:] = True
+            self.confirmed_occupied[:] = False
+        else:
+            self.needs_reference[index] = True
+            self.confirmed_occupied[index] = False
+
+    def state(self):
+        """
+        :return: The array to save in case the system crashes, restored with load_reference().
+        """
+        if self.adaptive and self.reference_frame is not None:
+            return np.stack([self.reference_frame, self.variance])
+        return self.reference_frame
+
+    def load_reference(self, reference_frame):
+        """
+        Restores a previously saved reference or background model. It is ignored if the spaces
+        changed size since. A BGR reference frame of the bounding box is converted, and starts a new
+        background model.
+
+        :return: True if the reference was restored.
+        """
+        x0, y0, x1, y1 = self.bbox
+        if reference_frame is None:
+            return False
+        model = reference_frame.ndim == 3 and reference_frame.shape[0] == 2 and reference_frame.dtype == np.float32
+        if reference_frame.ndim == 3 and not model:
+            if reference_frame.shape[:2] != (y1 - y0, x1 - x0):
+                return False
+            reference_frame = self._grayscale(reference_frame).copy()
+        if (reference_frame.shape[1:] if model else reference_frame.shape) != self.shape:
+            return False
+
+        if not self.adaptive:
+            if model:
+                return False
+            self.reference_frame = reference_frame
+        elif model:
+            self.reference_frame = reference_frame[0].copy()
+            self.variance = reference_frame[1].copy()
+        else:
+            self.reference_frame = reference_frame.astype(np.float32)
+            self.variance = np.zeros_like(self.reference_frame)
+        self.needs_reference[:] = False
+        return True
+
+    def update_reference(self, frame):
+        """
+        Copies the current frame into the reference of every space that requested it.
+
+        :return: True if the reference changed and should be saved.
+        """
+        if not self.needs_reference.any():
+            return False
+
+        x0, y0, x1, y1 = self.bbox
+        gray = self._grayscale(frame[y0:y1, x0:x1])
+        if self.reference_frame is None:
+            self.reference_frame = gray.astype(np.float32) if self.adaptive else gray.copy()
+            if self.adaptive:
+                self.variance = np.zeros_like(self.reference_frame)
+        else:
+            for i in np.flatnonzero(self.needs_reference):
+                t, b, l, r = self.top[i], self.bottom[i], self.left[i], self.right[i]
+                self.reference_frame[t:b, l:r] = gray[t:b, l:r]
+                if self.adaptive:
+                    self.variance[t:b, l:r] = 0
+        self.needs_reference[:] = False
+        return True
+
+    def changed_pixel_counts(self, frame):
+        """
+        :return: The number of changed pixels inside every space, at the downscaled size.
+        """
+        x0, y0, x1, y1 = self.bbox
+        gray = self._grayscale(frame[y0:y1, x0:x1])
+
+        if self.adaptive:
+            changed = self._changed_pixels(gray)
+        else:
+            cv2.absdiff(gray, self.reference_frame, dst=self.diff)
+            cv2.threshold(self.diff, self.pixel_threshold, 1, cv2.THRESH_BINARY, dst=self.changed)
+            changed = self.changed
+        integral = cv2.integral(changed, sum=self.integral, sdepth=cv2.CV_32S)
+
+        return (integral[self.bottom, self.right] - integral[self.top, self.right]
+                - integral[self.bottom, self.left] + integral[self.top, self.left])
+
+    def _changed_pixels(self, gray):
+        gray_float = self.gray_float
+        np.copyto(gray_float, gray)
+        cv2.subtract(gray_float, self.reference_frame, dst=self.diff)
+        residual = self.diff
+        if self.exposure_compensation:
+            # Brightness gain of the whole picture. The median of a sparse grid ignores a car
+            # covering less than half of the picture.
+            grid = self.reference_frame[::4, ::4]
+            gain = float(np.median(gray_float[::4, ::4] / np.maximum(grid, 1.0)))
+            residual = cv2.scaleAdd(self.reference_frame, -gain, gray_float, dst=self.residual)
+        self.last_diff = self.diff
+        self.last_residual = residual
+
+        # |residual| > max(noise_factor * std, threshold), compared squared to skip the roots
+        cv2.multiply(residual, residual, dst=self.squared)
+        limit = cv2.multiply(self.variance, self.noise_factor ** 2, dst=self.limit)
+        cv2.max(limit, float(self.pixel_threshold) ** 2, dst=limit)
+        # 255 for a changed pixel, reduced to 1 for the integral image
+        cv2.compare(self.squared, limit, cv2.CMP_GT, dst=self.changed)
+        cv2.bitwise_and(self.changed, 1, dst=self.changed)
+        self.last_changed = self.changed
+        return self.changed
+
+    def _learn(self, occupied):
+        # Learn the background pixels of every vacant space. Changed pixels and occupied spaces keep
+        # their background, so a car is never blended into it.
+        learn = cv2.compare(self.last_changed, 0, cv2.CMP_EQ, dst=self.learn)
+        for i in np.flatnonzero(occupied | self.confirmed_occupied):
+            learn[self.top[i]:self.bottom[i], self.left[i]:self.right[i]] = 0
+
+        # Pixels that are not learned follow the brightness change of the learned ones, otherwise
+        # a space that was occupied during dusk would not match its background once it is vacant
+        grid = learn[::4, ::4] != 0
+        if grid.any():
+            change = 1.0 + self.learning_rate * float(np.median(self.last_diff[::4, ::4][grid] /
+                                                                np.maximum(self.reference_frame[::4, ::4][grid], 1.0)))
+            if change != 1.0:
+                unlearned = cv2.bitwise_not(learn, dst=self.unlearned)
+                cv2.multiply(self.reference_frame, change, dst=self.scratch)
+                cv2.copyTo(self.scratch, unlearned, dst=self.reference_frame)
+
+        # The mean follows the exposure, the variance only the noise around it
+        cv2.accumulateWeighted(self.gray_float, self.reference_frame, self.learning_rate, mask=learn)
+        cv2.accumulateWeighted(self.squared, self.variance, self.learning_rate, mask=learn)
+
+    def check_occupation(self, frame, now):
+        """
+        Checks every space and updates the occupied timers.
+
+        :param frame: The live video frame.
+        :param now: The current time in seconds.
+        :return: Two boolean arrays: spaces that are occupied, and spaces that have been occupied
+                 for longer than their occupied timer.
+        """
+        if self.reference_frame is None:
+            count = len(self.rects)
+            return np.zeros(count, dtype=bool), np.zeros(count, dtype=bool)
+
+        occupied = self.changed_pixel_counts(frame) > self.area_limit
+        if self.adaptive:
+            self._learn(occupied)
+
+        # Start the timers of newly occupied spaces and clear the vacant ones
+        starting = occupied & np.isnan(self.occupied_start_time)
+        self.occupied_start_time[starting] = now
+        self.occupied_start_time[~occupied] = np.nan
+        self.confirmed_occupied[~occupied] = False
+
+        with np.errstate(invalid='ignore'):
+            timed_out = occupied & (now - self.occupied_start_time > self.occupied_timers)
+        return occupied, timed_out
@@ -0,0 +1,241 @@
+'''
+
+        +----------------------------+
+        |      StatusRecord.py       |
+        +----------------------------+
+
+This module publishes the latest status of every space in a shared-memory record: a
+memory-mapped file (in /dev/shm by default) with a small header and one fixed-size slot per
+space, in the order of the configuration.
+
+    header  | magic | slots | slot size |
+    slot n  | seq | updated | flags | name | data | streak | optimal |
+
+data is the status line of data.txt, streak the line of streak.txt and optimal the line of
+optimal.txt. A flag bit is cleared for a value that is missing (a stopped detector has no status).
+
+Every slot has one writer at a time: the detector of its camera, or the watch dog while that
+detector is not running. A writer makes the sequence number of the slot odd, writes the values and
+makes it even again, so it never waits. Readers copy the slot and check that the sequence number
+was even and did not change while copying (a seqlock), so they always get the values of one
+write, never a half written line. scripts/get_latest_data.php reads the record the same way.
+
+The text files are still written for older readers, by StatusPublisher, at most every
+<status-files-interval> seconds and only when a value changed. They are replaced with a rename,
+so they are never seen half written either.
+
+'''
+
+import mmap
+import os
+import struct
+import time
+
+from Adaptation import log
+
+MAGIC = b"PKSTAT1\0"
+HEADER = struct.Struct("<8sII")
+HEADER_SIZE = 64
+SEQ = struct.Struct("<Q")
+PAYLOAD = struct.Struct("<dB7x64s64s128s64s")
+SLOT_SIZE = 384
+FIELDS = ("data", "streak", "optimal")
+# Offset of the name in a slot, after seq, updated and flags
+NAME_OFFSET = 24
+# Attempts of a reader before it gives up on a slot that is being written
+READ_ATTEMPTS = 100
+
+def _text(value):
+    return value.rstrip(b"\0").decode("utf-8", "replace")
+
+def status_record_location(config):
+    """
+    :param config: The configuration, see get_config().
+    :return: <status-record-location>, or a file in src/data on a system without its directory.
+    """
+    location = config.get("status-record-location", default="/dev/shm/parkit-status.rec")
+    if not os.path.isdir(os.path.dirname(location) or "."):
+        location = "src/data/parkit-status.rec"
+    return location
+
+def _slot_name(name):
+    # The name as it fits into its slot
+    return (name or "").encode()[:64].decode("utf-8", "ignore")
+
+class StatusRecord:
+    """
+    The status record of all spaces.
+
+    :param path: The record file, see create().
+    :param writable: Map the record for writing, readers map it read-only.
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        with open(path, "r+b" if writable else "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        magic, slots, slot_size = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or slot_size != SLOT_SIZE or len(self.map) < HEADER_SIZE + slots * SLOT_SIZE:
+            self.map.close()
+            raise ValueError(f"{path} is not a status record")
+        self.names = [_text(self.map[self._offset(slot) + NAME_OFFSET:self._offset(slot) + NAME_OFFSET + 64])
+                      for slot in range(slots)]
+
+    @classmethod
+    def create(cls, path, names):
+        """
+        Creates a record with one empty slot per space and opens it for writing.
+
+        :param names: The space names, None or "" for the unnamed space.
+        """
+        names = [_slot_name(name) for name in names]
+        # Build the file next to its final name and rename it, so readers never see a half
+        # initialised header
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.truncate(HEADER_SIZE + len(names) * SLOT_SIZE)
+            file.write(HEADER.pack(MAGIC, len(names), SLOT_SIZE))
+            for slot, name in enumerate(names):
+                file.seek(HEADER_SIZE + slot * SLOT_SIZE)
+                file.write(SEQ.pack(0) + PAYLOAD.pack(0.0, 0, name.encode(), b"", b"", b""))
+        os.replace(temp_path, path)
+        return cls(path, writable=True)
+
+    @classmethod
+    def open(cls, path, names):
+        """
+        Opens the record of these spaces for writing, and creates it if it does not exist yet
+        (a detector started without the watch dog) or belongs to another configuration.
+        """
+        names = [_slot_name(name) for name in names]
+        if os.path.exists(path):
+            try:
+                record = cls(path, writable=True)
+                if record.names == names:
+                    return record
+                record.close()
+            except (OSError, ValueError) as e:
+                log(f"Status record {path} is replaced: {e}", "WARNING")
+        return cls.create(path, names)
+
+    @staticmethod
+    def _offset(slot):
+        return HEADER_SIZE + slot * SLOT_SIZE
+
+    def write(self, name, **values):
+        """
+        Publishes new values of one space. Values that are not given keep their value, None
+        removes a value.
+
+        :param name: The space name.
+        :param values: data, streak and optimal.
+        """
+        name = _slot_name(name)
+        if name not in self.names:
+            return
+        offset = self._offset(self.names.index(name))
+        _, flags, raw_name, *texts = PAYLOAD.unpack_from(self.map, offset + SEQ.size)
+        for bit, field in enumerate(FIELDS):
+            if field in values:
+                if values[field] is None:
+                    flags &= ~(1 << bit)
+                    texts[bit] = b""
+                else:
+                    flags |= 1 << bit
+                    texts[bit] = str(values[field]).encode()
+        # An odd sequence marks the slot as being written. A writer that crashed in the middle
+        # left it odd, the next write starts from there.
+        seq = SEQ.unpack_from(self.map, offset)[0]
+        start = (seq + 1) | 1
+        SEQ.pack_into(self.map, offset, start)
+        PAYLOAD.pack_into(self.map, offset + SEQ.size, time.time(), flags, raw_name, *texts)
+        SEQ.pack_into(self.map, offset, start + 1)
+
+    def read(self, name):
+        """
+        :param name: The space name.
+        :return: A dictionary with the keys space, data, streak, optimal (None if missing) and
+                 updated (seconds since the epoch, 0 if never written), or None if the space is
+                 unknown or the slot was never seen without a write in progress.
+        """
+        name = _slot_name(name)
+        if name not in self.names:
+            return None
+        offset = self._offset(self.names.index(name))
+        for attempt in range(READ_ATTEMPTS):
+            before = SEQ.unpack_from(self.map, offset)[0]
+            if before % 2 == 0:
+                payload = self.map[offset + SEQ.size:offset + SEQ.size + PAYLOAD.size]
+                if SEQ.unpack_from(self.map, offset)[0] == before:
+                    updated, flags, _, *texts = PAYLOAD.unpack(payload)
+                    status = {"space": name, "updated": updated}
+                    for bit, field in enumerate(FIELDS):
+                        status[field] = _text(texts[bit]) if flags & (1 << bit) else None
+                    return status
+            if attempt > 10:
+                time.sleep(0.0001)
+        return None
+
+    def snapshot(self):
+        """
+        :return: read() of every space, in the order of the record.
+        """
+        return [self.read(name) for name in self.names]
+
+    def close(self):
+        self.map.close()
+
+class StatusPublisher:
+    """
+    Publishes the status of spaces to the record, and writes the text files of the older
+    readers at a throttled rate.
+
+    :param record: The StatusRecord, or None to only write the text files.
+    :param files: The text file of every value, {space name: {"data": path, "streak": path, "optimal": path}}.
+    :param interval: Minimum seconds between two writes of the text files.
+    """
+
+    def __init__(self, record, files, interval=2.0):
+        self.record = record
+        self.files = {name or "": paths for name, paths in files.items()}
+        self.interval = interval
+        self.pending = {}
+        self.written = {}
+        self.flushed_at = 0.0
+
+    def publish(self, name, **values):
+        """
+        :param values: data, streak and optimal. None removes a value and its text file.
+        """
+        if self.record is not None:
+            self.record.write(name, **values)
+        paths = self.files.get(name or "", {})
+        for field, value in values.items():
+            path = paths.get(field)
+            if path and (path in self.pending or path not in self.written or self.written[path] != value):
+                self.pending[path] = value
+
+    def due(self, now):
+        """
+        :return: True if text files are waiting and the interval has passed.
+        """
+        return bool(self.pending) and now - self.flushed_at >= self.interval
+
+    def flush(self, now=None):
+        """
+        Writes the text files whose value changed since they were written.
+        """
+        self.flushed_at = time.time() if now is None else now
+        for path, text in self.pending.items():
+            if path in self.written and self.written[path] == text:
+                continue
+            if text is None:
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                temp_path = f"{path}.{os.getpid()}.tmp"
+                with open(temp_path, "w") as file:
+                    file.write(text)
+                os.replace(temp_path, path)
+            self.written[path] = text
+        self.pending.clear()
@@ -0,0 +1,189 @@
+'''
+
+        +----------------------------+
+        |    VehicleDetection.py     |
+        +----------------------------+
+
+This module contains helpers around the YOLOv5 Object Detector:
+
+    1. detect_cars: runs the model on the picture of a space and returns the boxes of the cars as a
+    compact structured array, filtered directly on the raw prediction tensor (no pandas).
+    space_overlap tells how much of each box lies inside the parking space. The model has to see
+    more than the space for that: context_window pads the space by a margin, shift_boxes moves the
+    boxes found in it back to the coordinates of the space.
+
+    2. DetectionCache: remembers the last detection of every parking space together with a cheap
+    fingerprint of the space (a small grayscale thumbnail). While a car stays parked the picture
+    hardly changes, so the cached detection is reused and the full YOLOv5 pass only runs again
+    when the space changes past a threshold or the cached result gets too old.
+
+'''
+
+import time
+
+import cv2
+import numpy as np
+
+# Compact detection record: one row per box, coordinates relative to the picture of the space
+BOX_DTYPE = np.dtype([('xmin', np.int32), ('ymin', np.int32), ('xmax', np.int32), ('ymax', np.int32),
+                      ('confidence', np.float32), ('class_id', np.int16)])
+
+def class_ids(names, wanted):
+    """
+    :param names: The class names of the model, a dict {id: name} or a list.
+    :param wanted: The class names to keep, e.g. ("car",).
+    :return: An array of the matching class ids.
+    """
+    items = names.items() if isinstance(names, dict) else enumerate(names)
+    return np.array([class_id for class_id, name in items if name in wanted], dtype=np.int16)
+
+def filter_detections(predictions, wanted_ids, min_confidence=0.0):
+    """
+    Filters raw predictions by class and confidence without building a DataFrame.
+
+    :param predictions: An N x 6 array (or tensor) of xmin, ymin, xmax, ymax, confidence, class.
+    :param wanted_ids: The class ids to keep.
+    :param min_confidence: Minimum confidence of a kept box.
+    :return: A structured array with BOX_DTYPE.
+    """
+    if hasattr(predictions, "cpu"):
+        predictions = predictions.cpu().numpy()
+    predictions = np.asarray(predictions, dtype=np.float32).reshape(-1, 6)
+
+    keep = np.isin(predictions[:, 5].astype(np.int16), wanted_ids) & (predictions[:, 4] >= min_confidence)
+    kept = predictions[keep]
+
+    boxes = np.empty(len(kept), dtype=BOX_DTYPE)
+    coordinates = kept[:, :4].astype(np.int32)  # Truncates like int() did
+    boxes['xmin'] = coordinates[:, 0]
+    boxes['ymin'] = coordinates[:, 1]
+    boxes['xmax'] = coordinates[:, 2]
+    boxes['ymax'] = coordinates[:, 3]
+    boxes['confidence'] = kept[:, 4]
+    boxes['class_id'] = kept[:, 5]
+    return boxes
+
+def space_overlap(boxes, rect):
+    """
+    Measures how much of every box lies inside a parking space.
+
+    :param boxes: A structured array with BOX_DTYPE.
+    :param rect: The space as [x, y, width, height] in the same coordinates as the boxes.
+    :return: Two arrays: the IoU of every box with the space, and the coverage (fraction of the box
+             area that is inside the space).
+    """
+    x, y, w, h = rect
+    inter_w = np.clip(np.minimum(boxes['xmax'], x + w) - np.maximum(boxes['xmin'], x), 0, None)
+    inter_h = np.clip(np.minimum(boxes['ymax'], y + h) - np.maximum(boxes['ymin'], y), 0, None)
+    intersection = (inter_w * inter_h).astype(np.float64)
+
+    box_area = ((boxes['xmax'] - boxes['xmin']) * (boxes['ymax'] - boxes['ymin'])).astype(np.float64)
+    union = box_area + w * h - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = np.where(union > 0, intersection / union, 0.0)
+        coverage = np.where(box_area > 0, intersection / box_area, 0.0)
+    return iou, coverage
+
+def context_window(rect, margin, frame_width, frame_height):
+    """
+    :param rect: The space as [x, y, width, height].
+    :param margin: Padding on every side, as a fraction of the width and height of the space.
+    :return: [x, y, width, height] of the padded space, clipped to the frame.
+    """
+    x, y, w, h = rect
+    pad_x, pad_y = int(w * margin), int(h * margin)
+    x0, y0 = max(0, x - pad_x), max(0, y - pad_y)
+    x1, y1 = min(frame_width, x + w + pad_x), min(frame_height, y + h + pad_y)
+    return [x0, y0, x1 - x0, y1 - y0]
+
+def shift_boxes(boxes, dx, dy):
+    """
+    :return: A copy of the boxes moved by dx, dy.
+    """
+    boxes = boxes.copy()
+    boxes['xmin'] += dx
+    boxes['xmax'] += dx
+    boxes['ymin'] += dy
+    boxes['ymax'] += dy
+    return boxes
+
+# Run the pre-trained model on a space and return the boxes of the detected cars
+def detect_cars(model, roi, min_confidence=0.0, size=640):
+    results = model.predict(roi, size=size)
+
+    # Work on the raw prediction tensor of the single picture: xmin, ymin, xmax, ymax, confidence, class
+    return filter_detections(results.pred[0], class_ids(results.names, ("car",)), min_confidence)
+
+class DetectionCache:
+    """
+    Per-space cache of detection results keyed by an ROI fingerprint.
+
+    :param threshold: Mean absolute difference (0-255) between fingerprints above which the ROI
+                      counts as changed and the detection has to run again.
+    :param max_age: Seconds after which a cached detection expires even if the ROI did not change.
+    :param size: Side length of the grayscale thumbnail used as fingerprint.
+    """
+
+    def __init__(self, threshold=8.0, max_age=30.0, size=16):
+        self.threshold = threshold
+        self.max_age = max_age
+        self.size = size
+        self.entries = {}
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.changed = 0
+
+    def fingerprint(self, roi):
+        """
+        :return: A size x size grayscale thumbnail of the ROI.
+        """
+        gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY) if roi.ndim == 3 else roi
+        return cv2.resize(gray, (self.size, self.size), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def lookup(self, key, roi, now=None):
+        """
+        Returns the cached detection of a space if it is still valid for this ROI.
+
+        :param key: The space index or name.
+        :param roi: The current picture of the space.
+        :return: (result, fingerprint). result is None on a miss; pass the fingerprint to store().
+        """
+        now = time.time() if now is None else now
+        fingerprint = self.fingerprint(roi)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None, fingerprint
+
+        cached_fingerprint, result, stored_at = entry
+        if now - stored_at > self.max_age:
+            self.expired += 1
+            self.misses += 1
+            return None, fingerprint
+        if np.abs(fingerprint - cached_fingerprint).mean() > self.threshold:
+            self.changed += 1
+            self.misses += 1
+            return None, fingerprint
+
+        self.hits += 1
+        return result, fingerprint
+
+    def store(self, key, fingerprint, result, now=None):
+        self.entries[key] = (fingerprint, result, time.time() if now is None else now)
+
+    def invalidate(self, key=None):
+        """
+        Forgets the detection of one space, or of every space if no key is given.
+        """
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "expired": self.expired, "changed": self.changed,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0}
@@ -70,44 +70,72 @@ function formatEventDetails(eventString) {
 
 }
 
-function fetchData() {
-    fetch('scripts/get_latest_data.php')
-    .then(response => response.json())
-    .then(data => {
-        const dataContent = data.data;
-        let dataArray = dataContent.split(" - ");
-        const occupiedStatus = dataArray[0];
-        const spaceStatus = dataArray[1];
-        const streakContent = data.streak;
-        const sysStatus = data.sysstatus;
-        const occupiedPercentage = data.occupiedPercentage;
-        const unoccupiedPercentage = data.unoccupiedPercentage;
-        const optimalTime = data.optimalTime;
+function showData(data) {
+    const dataContent = data.data;
+    let dataArray = dataContent.split(" - ");
+    const occupiedStatus = dataArray[0];
+    const spaceStatus = dataArray[1];
+    const streakContent = data.streak;
+    const sysStatus = data.sysstatus;
+    const occupiedPercentage = data.occupiedPercentage;
+    const unoccupiedPercentage = data.unoccupiedPercentage;
+    const optimalTime = data.optimalTime;
+
+    document.getElementById('occupiedStatus').innerText = occupiedStatus;
+    document.getElementById('spaceStatus').innerText = spaceStatus;
+    if (streakContent != "N/A") {
+        document.getElementById('streakDisplay').innerText = formatEventDetails(streakContent);
+    } else {
+        document.getElementById('streakDisplay').innerText = "N/A";
+    }
+    document.getElementById('occupiedPercentage').innerText = occupiedPercentage + "% Occupied";
+    document.getElementById('unoccupiedPercentage').innerText = unoccupiedPercentage + "% Unoccupied";
+    document.getElementById('optimalTime').innerText = convertTime(optimalTime);
 
-        document.getElementById('occupiedStatus').innerText = occupiedStatus;
-        document.getElementById('spaceStatus').innerText = spaceStatus;
-        if (streakContent != "N/A") {
-            document.getElementById('streakDisplay').innerText = formatEventDetails(streakContent);
+    var status = document.getElementById('sysStatus');
+    if (sysStatus.includes("Online")) {
+        status.innerText = "Online";
+        // This will change the sysStarted id in live.html
+        if (data.started) {
+            document.getElementById('sysStarted').innerText = data.started;
         } else {
-            document.getElementById('streakDisplay').innerText = "N/A";
+            fetchAndParseCSV();
         }
-        document.getElementById('occupiedPercentage').innerText = occupiedPercentage + "% Occupied";
-        document.getElementById('unoccupiedPercentage').innerText = unoccupiedPercentage + "% Unoccupied";
-        document.getElementById('optimalTime').innerText = convertTime(optimalTime);
+    } else {
+        status.innerText = "Offline";
+        document.getElementById('sysStarted').innerText = "N/A";
+    }
+}
 
-        var status = document.getElementById('sysStatus');
-        if (sysStatus.includes("Online")) {
-            status.innerText = "Online";
-            // This will change the sysStarted id in live.html
-            fetchAndParseCSV();
-        } else {
-            status.innerText = "Offline";
-            document.getElementById('sysStarted').innerText = "N/A";
+function fetchData() {
+    fetch('scripts/get_latest_data.php')
+    .then(response => response.json())
+    .then(showData)
+    .catch(error => console.error('Error fetching data: ', error));
+}
+
+// The live server (LiveServer.py) pushes every status change of the space in ?space=, or of the
+// first space. Without it the PHP script is asked every second.
+function startLiveData() {
+    fetch('api/status')
+    .then(response => {
+        if (!response.ok) {
+            throw new Error('No live server');
         }
-        
+        return response.json();
     })
-    .catch(error => console.error('Error fetching data: ', error));
+    .then(status => {
+        const wanted = new URLSearchParams(window.location.search).get('space');
+        const space = wanted !== null ? wanted : (status.spaces.length > 0 ? status.spaces[0].space : '');
+        const events = new EventSource('api/events');
+        events.addEventListener('status', event => {
+            const data = JSON.parse(event.data);
+            if (data.space === space) {
+                showData(data);
+            }
+        });
+    })
+    .catch(() => setInterval(fetchData, 1000));
 }
 
-// Fetch the data every second
-setInterval(fetchData, 1000);
+window.addEventListener('load', startLiveData);
@@ -1,10 +1,42 @@
 <?php
 // Authentication and security checks here
 if ($_SERVER['REQUEST_METHOD'] === 'POST' && isset($_POST['file'])) {
-    $file = $_POST['file'];
-    $filePath = '../gallery/' . basename($file); // Prevent directory traversal
+    $directory = '../gallery';
+    $file = basename($_POST['file']); // Prevent directory traversal
+    $filePath = $directory . '/' . $file;
+    $manifestPath = $directory . '/manifest.json';
+    $found = false;
+
+    // The watch dog changes the manifest under the same lock (see GalleryIndex.py)
+    $lock = fopen($directory . '/manifest.lock', 'a');
+    flock($lock, LOCK_EX);
+    if (file_exists($manifestPath)) {
+        $manifest = json_decode(file_get_contents($manifestPath), true);
+        $kept = array();
+        foreach ($manifest['snapshots'] as $entry) {
+            if ($entry['file'] !== $file) {
+                $kept[] = $entry;
+                continue;
+            }
+            $found = true;
+            if ($entry['thumbnail'] && file_exists($directory . '/' . $entry['thumbnail'])) {
+                unlink($directory . '/' . $entry['thumbnail']);
+            }
+        }
+        if ($found) {
+            $manifest['snapshots'] = $kept;
+            file_put_contents($manifestPath . '.tmp', json_encode($manifest));
+            rename($manifestPath . '.tmp', $manifestPath);
+        }
+    }
     if (file_exists($filePath)) {
         unlink($filePath);
+        $found = true;
+    }
+    flock($lock, LOCK_UN);
+    fclose($lock);
+
+    if ($found) {
         echo json_encode(['success' => true]);
     } else {
         echo json_encode(['error' => 'File does not exist']);
@@ -3,29 +3,88 @@
 $filePath1 = '../data.txt';
 $filePath2 = '../streak.txt';
 $filePath3 = '../optimal.txt';
+$filePath4 = '../metrics.json';
+
+// The status record of the detectors (see StatusRecord.py), in /dev/shm or src/data
+$recordPaths = array('/dev/shm/parkit-status.rec', '../../data/parkit-status.rec');
+
+// Reads the status of one space (the first one by default) from the status record. Returns null
+// without a record, the text files are read instead.
+function read_status_record($paths, $space) {
+    foreach ($paths as $path) {
+        if (!file_exists($path) || !is_readable($path)) {
+            continue;
+        }
+        $handle = fopen($path, 'rb');
+        // Every read goes to the record, not to a buffered copy
+        stream_set_read_buffer($handle, 0);
+        $header = unpack('a8magic/Vslots/VslotSize', fread($handle, 16));
+        if ($header['magic'] !== "PKSTAT1\0") {
+            fclose($handle);
+            continue;
+        }
+        for ($slot = 0; $slot < $header['slots']; $slot++) {
+            $offset = 64 + $slot * $header['slotSize'];
+            // Seqlock: the sequence number is even and unchanged while the slot is copied
+            for ($attempt = 0; $attempt < 100; $attempt++) {
+                fseek($handle, $offset);
+                $before = unpack('P', fread($handle, 8))[1];
+                if ($before % 2 == 1) {
+                    usleep(100);
+                    continue;
+                }
+                $payload = fread($handle, 336);
+                fseek($handle, $offset);
+                if (unpack('P', fread($handle, 8))[1] == $before) {
+                    break;
+                }
+            }
+            if ($attempt == 100) {
+                continue;
+            }
+            $status = unpack('eupdated/Cflags/x7/a64name/a64data/a128streak/a64optimal', $payload);
+            $name = rtrim($status['name'], "\0");
+            if (($space === null || $name === $space) && $status['updated'] > 0) {
+                fclose($handle);
+                return array(
+                    'data' => ($status['flags'] & 1) ? rtrim($status['data'], "\0") : null,
+                    'streak' => ($status['flags'] & 2) ? rtrim($status['streak'], "\0") : null,
+                    'optimal' => ($status['flags'] & 4) ? rtrim($status['optimal'], "\0") : null);
+            }
+        }
+        fclose($handle);
+    }
+    return null;
+}
+
+$record = read_status_record($recordPaths, isset($_GET['space']) ? $_GET['space'] : null);
+if ($record === null) {
+    $record = array('data' => null, 'streak' => null, 'optimal' => null);
+    if (file_exists($filePath1) && is_readable($filePath1)) {
+        $record['data'] = trim(file_get_contents($filePath1));
+    }
+    if (file_exists($filePath2) && is_readable($filePath2)) {
+        $record['streak'] = trim(file_get_contents($filePath2));
+    }
+    if (file_exists($filePath3) && is_readable($filePath3)) {
+        $record['optimal'] = trim(file_get_contents($filePath3));
+    }
+}
 
 $data = array();
 
-// Read from filePath1
-if (file_exists($filePath1) && is_readable($filePath1)) {
-    $data['data'] = trim(file_get_contents($filePath1));
+if ($record['data'] !== null) {
+    $data['data'] = $record['data'];
     $data['sysstatus'] = "Online";
 } else {
     $data['data'] = 'N/A - N/A';
     $data['sysstatus'] = "Offline";
 }
 
-// Read from filePath2
-if (file_exists($filePath2) && is_readable($filePath2)) {
-    $data['streak'] = trim(file_get_contents($filePath2)); // Similarly, read the whole file
-} else {
-    $data['streak'] = 'N/A';
-}
+$data['streak'] = $record['streak'] !== null ? $record['streak'] : 'N/A';
 
-// Read from filePath3
-if (file_exists($filePath3) && is_readable($filePath3)) {
-    $content = file_get_contents($filePath3);
-    $fields = str_getcsv(trim($content)); // Use str_getcsv to parse the CSV-formatted string
+if ($record['optimal'] !== null) {
+    $fields = str_getcsv($record['optimal']); // Use str_getcsv to parse the CSV-formatted string
     $data['occupiedPercentage'] = isset($fields[0]) ? $fields[0] : 'NULL'; // Check if index exists
     $data['unoccupiedPercentage'] = isset($fields[1]) ? $fields[1] : 'NULL'; // Check if index exists
     $data['optimalTime'] = isset($fields[2]) ? $fields[2] : 'NULL'; // Check if index exists
@@ -35,6 +94,11 @@ if (file_exists($filePath3) && is_readable($filePath3)) {
     $data['optimalTime'] = 'NULL';
 }
 
+// Read the pipeline metrics, only written when metrics are enabled
+if (file_exists($filePath4) && is_readable($filePath4)) {
+    $data['metrics'] = json_decode(file_get_contents($filePath4), true);
+}
+
 // Return both values in JSON format
 echo json_encode($data);
 ?>
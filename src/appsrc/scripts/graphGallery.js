@@ -1,53 +1,128 @@
+// The gallery is listed page by page from its manifest (see GalleryIndex.py), by the live server
+// (LiveServer.py) or by the PHP script. Only the thumbnails of a page are loaded, the full graph
+// is loaded when it is shown.
+const PER_PAGE = 12;
 let images = [];
 let currentImageIndex = 0;
+let currentPage = 1;
+let pageCount = 1;
+let liveServer = null;
+// Other hosts need the token of the live server to delete a graph, opened as graphGallery.html?token=...
+const liveServerToken = new URLSearchParams(window.location.search).get('token');
+
+function listUrl(page) {
+    const params = new URLSearchParams({ page: page, per_page: PER_PAGE });
+    const start = document.getElementById('startDate').value;
+    const end = document.getElementById('endDate').value;
+    if (start) {
+        params.set('start', start);
+    }
+    if (end) {
+        params.set('end', end);
+    }
+    return (liveServer ? 'api/gallery?' : 'scripts/list_graphs.php?') + params.toString();
+}
 
-fetch('scripts/list_graphs.php')
+function loadPage(page, showIndex) {
+    if (liveServer === null) {
+        // Ask the live server first, the PHP script answers when it is not running
+        fetch('api/status')
+        .then(response => { liveServer = response.ok; })
+        .catch(() => { liveServer = false; })
+        .then(() => loadPage(page, showIndex));
+        return;
+    }
+    fetch(listUrl(page))
     .then(response => response.json())
-    .then(data => {
-        images = data;
+    .then(listing => {
+        images = listing.items;
+        currentPage = listing.page;
+        pageCount = listing.pages;
+        showThumbnails();
         if (images.length > 0) {
-            showImage(0);
-        } else{
-            var ele    = document.getElementById('gal');
-            var ele2   = document.getElementById('gallery-nav');
-            var newele = document.createElement('div');
-            var newH2  = document.createElement('h2');
-            newH2.textContent = 'No Saved Graphs!';
-            newele.appendChild(newH2);
-            ele.insertAdjacentElement('afterend', newele);
-            ele.remove();
-            ele2.remove();
+            showImage(showIndex === 'last' ? images.length - 1 : 0);
+        } else {
+            updateGalleryForNoImages();
         }
     })
     .catch(error => console.error('Unable to load images:', error));
+}
+
+function showThumbnails() {
+    const thumbnails = document.getElementById('thumbnails');
+    thumbnails.innerHTML = '';
+    images.forEach((image, index) => {
+        const img = document.createElement('img');
+        img.src = image.thumbnail_url;
+        img.title = formatDateString(image.file);
+        img.loading = 'lazy';
+        img.onclick = () => showImage(index);
+        thumbnails.appendChild(img);
+    });
+    document.getElementById('pageInfo').innerText = 'Page ' + currentPage + ' of ' + pageCount;
+    document.getElementById('prevPageButton').className = currentPage > 1 ? 'button button-blue' : 'button button-blue button-hidden';
+    document.getElementById('nextPageButton').className = currentPage < pageCount ? 'button button-blue' : 'button button-blue button-hidden';
+}
 
 function showImage(index) {
     currentImageIndex = index;
-    document.getElementById('galleryImage').src = images[index];
-    const filename = images[index].split('/').pop();
-    document.getElementById('caption').innerText = formatDateString(filename);
+    const image = images[index];
+    document.getElementById('gal').style.display = '';
+    document.getElementById('gallery-nav').style.display = '';
+    document.getElementById('galleryImage').src = image.url;
+    let caption = formatDateString(image.file);
+    if (image.summary && image.summary.samples) {
+        caption += ' | ' + image.summary.occupied_percentage.toFixed(1) + '% occupied, best time ' + image.summary.best_time;
+    }
+    document.getElementById('caption').innerText = caption;
+    Array.from(document.getElementById('thumbnails').children).forEach((thumbnail, i) => {
+        thumbnail.className = i === index ? 'selected' : '';
+    });
     updateNavigation();
 }
 
+// Newest first: Back shows older graphs, Next newer ones, across pages
 function updateNavigation() {
-    document.getElementById('prevButton').className = currentImageIndex > 0 ? 'button button-blue' : 'button button-blue button-hidden';
-    document.getElementById('nextButton').className = currentImageIndex < images.length - 1 ? 'button button-blue' : 'button button-blue button-hidden';
+    const hasNewer = currentImageIndex > 0 || currentPage > 1;
+    const hasOlder = currentImageIndex < images.length - 1 || currentPage < pageCount;
+    document.getElementById('prevButton').className = hasOlder ? 'button button-blue' : 'button button-blue button-hidden';
+    document.getElementById('nextButton').className = hasNewer ? 'button button-blue' : 'button button-blue button-hidden';
 }
 
 function nextImage() {
+    if (currentImageIndex > 0) {
+        showImage(currentImageIndex - 1);
+    } else if (currentPage > 1) {
+        loadPage(currentPage - 1, 'last');
+    }
+}
+
+function previousImage() {
     if (currentImageIndex < images.length - 1) {
         showImage(currentImageIndex + 1);
+    } else if (currentPage < pageCount) {
+        loadPage(currentPage + 1);
     }
 }
 
-function previousImage() {
-    if (currentImageIndex > 0) {
-        showImage(currentImageIndex - 1);
+function previousPage() {
+    if (currentPage > 1) {
+        loadPage(currentPage - 1);
     }
 }
 
+function nextPage() {
+    if (currentPage < pageCount) {
+        loadPage(currentPage + 1);
+    }
+}
+
+function applyFilter() {
+    loadPage(1);
+}
+
 function saveImage() {
-    const currentImage = images[currentImageIndex];
+    const currentImage = images[currentImageIndex].url;
     const link = document.createElement('a');
     link.href = currentImage;
     link.download = currentImage.split('/').pop();
@@ -83,7 +158,7 @@ function formatDateString(inputString) {
         hour: 'numeric', // e.g., 13
         minute: 'numeric', // e.g., 30
         second: 'numeric', // e.g., 35
-        hour12: true 
+        hour12: true
     };
 
     // Use toLocaleDateString for locale-specific output
@@ -103,28 +178,28 @@ function deleteImage() {
         return; // Stop the function if the user cancels.
     }
 
-    const formData = new FormData();
-    formData.append('file', currentImage);
+    let request;
+    if (liveServer) {
+        request = fetch('api/gallery/' + encodeURIComponent(currentImage.file), {
+            method: 'DELETE',
+            headers: liveServerToken ? { 'X-Parkit-Token': liveServerToken } : {}
+        });
+    } else {
+        const formData = new FormData();
+        formData.append('file', currentImage.file);
+        request = fetch('scripts/delete_graph.php', {
+            method: 'POST',
+            body: formData
+        });
+    }
 
-    fetch('scripts/delete_graph.php', {
-        method: 'POST',
-        body: formData
-    })
-    .then(response => {
-        if (!response.ok) {
-            throw new Error('Network response was not ok');
-        }
-        return response.json();
-    })
+    request
+    .then(response => response.json())
     .then(data => {
         if (data.success) {
             console.log('Image deleted successfully');
-            images.splice(currentImageIndex, 1); // Remove from local array
-            if (images.length > 0) {
-                showImage(currentImageIndex > 0 ? currentImageIndex - 1 : 0);
-            } else {
-                updateGalleryForNoImages();
-            }
+            // The manifest changed, the page is listed again
+            loadPage(images.length > 1 || currentPage === 1 ? currentPage : currentPage - 1);
         } else {
             console.error('Failed to delete image:', data.error);
         }
@@ -133,13 +208,9 @@ function deleteImage() {
 }
 
 function updateGalleryForNoImages() {
-    var ele    = document.getElementById('gal');
-    var ele2   = document.getElementById('gallery-nav');
-    var newele = document.createElement('div');
-    var newH2  = document.createElement('h2');
-    newH2.textContent = 'No Saved Graphs!';
-    newele.appendChild(newH2);
-    ele.insertAdjacentElement('afterend', newele);
-    ele.remove();
-    ele2.remove();
+    document.getElementById('gal').style.display = 'none';
+    document.getElementById('gallery-nav').style.display = 'none';
+    document.getElementById('pageInfo').innerText = 'No Saved Graphs!';
 }
+
+window.addEventListener('load', () => loadPage(1));
@@ -1,6 +1,39 @@
 <?php
-// Lists all the png file names in gallery
+// Lists one page of the gallery from its manifest (see GalleryIndex.py), newest first.
+// Parameters: page, per_page, start and end (YYYY-MM-DD) and space
 $directory = "../gallery";
-$images = glob($directory . "/*.png");
-echo json_encode($images);
+$manifestPath = $directory . "/manifest.json";
+
+$snapshots = array();
+if (file_exists($manifestPath) && is_readable($manifestPath)) {
+    $manifest = json_decode(file_get_contents($manifestPath), true);
+    $snapshots = isset($manifest['snapshots']) ? $manifest['snapshots'] : array();
+}
+
+// A day includes all of its times
+$start = isset($_GET['start']) ? $_GET['start'] : '';
+$end = isset($_GET['end']) ? $_GET['end'] : '';
+if (strlen($end) == 10) {
+    $end .= ' 23:59:59';
+}
+$space = isset($_GET['space']) ? $_GET['space'] : null;
+$snapshots = array_values(array_filter($snapshots, function ($entry) use ($start, $end, $space) {
+    $time = (string)$entry['time'];
+    return ($start === '' || $time >= $start) && ($end === '' || $time <= $end)
+        && ($space === null || $entry['space'] === $space);
+}));
+
+$perPage = isset($_GET['per_page']) ? max(1, intval($_GET['per_page'])) : 12;
+$total = count($snapshots);
+$pages = max(1, intval(ceil($total / $perPage)));
+$page = isset($_GET['page']) ? min(max(1, intval($_GET['page'])), $pages) : 1;
+
+$items = array_slice(array_reverse($snapshots), ($page - 1) * $perPage, $perPage);
+foreach ($items as &$item) {
+    $item['url'] = 'gallery/' . $item['file'];
+    $item['thumbnail_url'] = $item['thumbnail'] ? 'gallery/' . $item['thumbnail'] : $item['url'];
+}
+unset($item);
+
+echo json_encode(array('total' => $total, 'page' => $page, 'pages' => $pages, 'items' => $items));
 ?>
@@ -1,15 +1,164 @@
+// The live server (LiveServer.py) sends the history once and pushes every new sample, and the
+// graph is drawn here. Without the live server the PNG rendered by the detector is reloaded.
+const HISTORY_POINTS = 600;
+let chart = { space: null, step: 2, points: [] };
+let drawPending = false;
+
+function startLiveGraph() {
+    fetch('api/status')
+    .then(response => {
+        if (!response.ok) {
+            throw new Error('No live server');
+        }
+        return response.json();
+    })
+    .then(status => {
+        fillSpaceSelect(status.spaces);
+        loadHistory();
+        const events = new EventSource('api/events');
+        events.addEventListener('point', event => addPoint(JSON.parse(event.data)));
+    })
+    .catch(() => usePngGraph());
+}
+
+function usePngGraph() {
+    document.getElementById('dataCanvas').style.display = 'none';
+    document.getElementById('dataImage').style.display = '';
+    setInterval(updateImage, 2000);
+}
+
+function fillSpaceSelect(spaces) {
+    const select = document.getElementById('spaceSelect');
+    spaces.forEach(space => {
+        const option = document.createElement('option');
+        option.value = space.space;
+        option.text = space.space || 'Space';
+        select.appendChild(option);
+    });
+    select.style.display = spaces.length > 1 ? '' : 'none';
+    select.onchange = loadHistory;
+    chart.space = spaces.length > 0 ? spaces[0].space : '';
+}
+
+function loadHistory() {
+    chart.space = document.getElementById('spaceSelect').value;
+    fetch('api/history?space=' + encodeURIComponent(chart.space) + '&points=' + HISTORY_POINTS)
+    .then(response => response.json())
+    .then(history => {
+        chart.step = history.step;
+        chart.points = history.points;
+        scheduleDraw();
+    })
+    .catch(error => console.error('Error fetching the history: ', error));
+}
+
+function addPoint(point) {
+    if (point.space !== chart.space) {
+        return;
+    }
+    chart.points.push([point.time, point.car]);
+    // A long session is downsampled again instead of growing forever
+    if (chart.points.length > HISTORY_POINTS * 4) {
+        loadHistory();
+        return;
+    }
+    scheduleDraw();
+}
+
+function scheduleDraw() {
+    if (!drawPending) {
+        drawPending = true;
+        requestAnimationFrame(() => {
+            drawPending = false;
+            drawChart();
+        });
+    }
+}
+
+// Times are local wall clock seconds, so they are formatted as UTC
+function formatTime(seconds, withDate) {
+    const date = new Date(seconds * 1000);
+    const time = String(date.getUTCHours()).padStart(2, '0') + ':' + String(date.getUTCMinutes()).padStart(2, '0');
+    return withDate ? (date.getUTCMonth() + 1) + '/' + date.getUTCDate() + ' ' + time : time;
+}
+
+function drawChart() {
+    const canvas = document.getElementById('dataCanvas');
+    const ctx = canvas.getContext('2d');
+    const left = 110, right = 15, top = 40, bottom = 40;
+    const width = canvas.width - left - right;
+    const height = canvas.height - top - bottom;
+    const points = chart.points;
+
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+    ctx.fillStyle = '#333';
+    ctx.font = '18px Arial';
+    ctx.textAlign = 'center';
+    ctx.fillText('Parking Space Status', canvas.width / 2, 24);
+
+    // Axes and the two status levels
+    ctx.font = '12px Arial';
+    ctx.textAlign = 'right';
+    ctx.strokeStyle = '#ccc';
+    ctx.lineWidth = 1;
+    [[0, 'Space Vacant'], [1, 'Space Occupied']].forEach(([value, label]) => {
+        const y = top + height - value * height;
+        ctx.beginPath();
+        ctx.moveTo(left, y);
+        ctx.lineTo(left + width, y);
+        ctx.stroke();
+        ctx.fillText(label, left - 8, y + 4);
+    });
+    if (points.length === 0) {
+        ctx.textAlign = 'center';
+        ctx.fillText('No samples yet', left + width / 2, top + height / 2);
+        return;
+    }
+
+    const first = points[0][0];
+    const last = Math.max(points[points.length - 1][0], first + 1);
+    const x = time => left + (time - first) / (last - first) * width;
+    const y = value => top + height - value * height;
+
+    // Time axis
+    ctx.textAlign = 'center';
+    const withDate = last - first > 86400;
+    for (let tick = 0; tick <= 4; tick++) {
+        const time = first + (last - first) * tick / 4;
+        ctx.fillText(formatTime(time, withDate), x(time), top + height + 20);
+    }
+
+    // Every sample holds its value until the next one, gaps in the data stay empty
+    const gap = Math.max(chart.step, 2) * 3;
+    ctx.lineWidth = 4;
+    for (let i = 0; i < points.length; i++) {
+        const [time, value] = points[i];
+        const next = i + 1 < points.length ? points[i + 1] : null;
+        const end = next && next[0] - time <= gap ? next[0] : time + Math.min(chart.step, gap);
+        ctx.strokeStyle = value >= 0.5 ? 'red' : 'green';
+        ctx.beginPath();
+        ctx.moveTo(x(time), y(value));
+        ctx.lineTo(Math.min(x(end), left + width), y(value));
+        if (next && next[0] === end) {
+            ctx.lineTo(x(end), y(next[1]));
+        }
+        ctx.stroke();
+    }
+}
+
 function updateImage() {
     const img = document.getElementById('dataImage');
     img.src = './png/parkit-data-analytics-graph.png?time=' + new Date().getTime();
 }
-setInterval(updateImage, 2000);
 
 function saveImage() {
-    const img = document.getElementById('dataImage').src;
+    const canvas = document.getElementById('dataCanvas');
     const link = document.createElement('a');
-    link.href = img;
+    link.href = canvas.style.display === 'none' ? document.getElementById('dataImage').src : canvas.toDataURL('image/png');
     link.download = 'parkit-data-analytics-graph.png';
     document.body.appendChild(link);
     link.click();
     document.body.removeChild(link);
-}
\ No newline at end of file
+}
+
+window.addEventListener('load', startLiveGraph);